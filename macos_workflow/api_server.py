@@ -0,0 +1,382 @@
+"""
+Asynchronous, job-based HTTP API for the OCR engine.
+
+Clients upload an image, PDF or TIFF and get a job id back immediately. Jobs are persisted in
+a local SQLite table and processed by background workers sharing one OCREngine; clients poll
+for status, read finished pages while the rest of the document is still running, fetch the
+final markdown and can cancel a job (it stops at the next page boundary). The uploaded file is
+deleted once its job is done, failed or cancelled; the results stay in the database.
+
+    POST /jobs                 multipart: file, task | prompt, mode  -> {"job_id", "status"}
+    GET  /jobs/{id}            status and progress
+    GET  /jobs/{id}/pages      finished pages (?start=&limit=)
+    GET  /jobs/{id}/result     document markdown once the job is done
+    POST /jobs/{id}/cancel
+    POST /admin/profile        ?requests=N: profile the next N pages (see profiling.py)
+    GET  /admin/profile        capture status and recent trace files
+
+Usage:
+    python -m macos_workflow.api_server --port 8000 [--with-ui]
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+# Same project-root handling as app.py, so the DeepSeek_OCR package is importable.
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(_current_dir)
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from macos_workflow import config_macos as config
+from macos_workflow.headless import _page_files
+from macos_workflow.utils import PAGE_SEPARATOR, TIFF_EXTENSIONS, count_tiff_pages
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    filename TEXT,
+    prompt TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    total_pages INTEGER,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    job_id TEXT NOT NULL,
+    page_index INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (job_id, page_index)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+FINAL_STATES = ("done", "failed", "cancelled")
+
+
+def count_pages(input_path):
+    if input_path.lower().endswith(".pdf"):
+        import fitz
+        with fitz.open(input_path) as doc:
+            return len(doc)
+    if input_path.lower().endswith(TIFF_EXTENSIONS):
+        return count_tiff_pages(input_path)
+    return 1
+
+
+class JobStore:
+    """SQLite-backed job table. All methods are thread-safe."""
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def create(self, input_path, filename, prompt, mode):
+        job_id = uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO jobs (id, status, input_path, filename, prompt, mode, created_at) VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, input_path, filename, prompt, mode, time.time()))
+        return job_id
+
+    def get(self, job_id):
+        rows = self._execute(
+            "SELECT jobs.*, (SELECT COUNT(*) FROM pages WHERE job_id = jobs.id) AS pages_done FROM jobs WHERE id = ?",
+            (job_id,))
+        return dict(rows[0]) if rows else None
+
+    def claim_next(self):
+        """Atomically moves the oldest queued job to 'running' and returns it, or None."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                                       (time.time(), row["id"]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return dict(row) if row is not None else None
+
+    def set_total_pages(self, job_id, total_pages):
+        self._execute("UPDATE jobs SET total_pages = ? WHERE id = ?", (total_pages, job_id))
+
+    def add_page(self, job_id, page_index, text):
+        self._execute("INSERT OR REPLACE INTO pages (job_id, page_index, text) VALUES (?, ?, ?)", (job_id, page_index, text))
+
+    def pages(self, job_id, start=0, limit=None):
+        rows = self._execute(
+            "SELECT page_index, text FROM pages WHERE job_id = ? AND page_index >= ? ORDER BY page_index LIMIT ?",
+            (job_id, start, -1 if limit is None else limit))
+        return [{"index": row["page_index"], "text": row["text"]} for row in rows]
+
+    def finish(self, job_id, status, error=None):
+        self._execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                      (status, error, time.time(), job_id))
+
+    def finish_done(self, job_id):
+        """Marks a job whose pages all ran as done, or as cancelled if a cancel came in meanwhile."""
+        self._execute("UPDATE jobs SET status = CASE WHEN cancel_requested THEN 'cancelled' ELSE 'done' END, "
+                      "finished_at = ? WHERE id = ?", (time.time(), job_id))
+        return self.get(job_id)["status"]
+
+    def request_cancel(self, job_id):
+        """
+        Cancels a queued job right away (returns True); running jobs stop at the next page
+        boundary, or end as cancelled if their last page is already running. Jobs in a final
+        state are left as they are.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                self._conn.execute(
+                    "UPDATE jobs SET cancel_requested = 1, "
+                    "status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END, "
+                    "finished_at = CASE WHEN status = 'queued' THEN ? ELSE finished_at END "
+                    "WHERE id = ? AND status IN ('queued', 'running')", (time.time(), job_id))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row is not None and row["status"] == "queued"
+
+    def cancel_requested(self, job_id):
+        rows = self._execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,))
+        return bool(rows and rows[0]["cancel_requested"])
+
+    def requeue_interrupted(self):
+        """Jobs left 'running' by a previous process start over."""
+        self._execute("DELETE FROM pages WHERE job_id IN (SELECT id FROM jobs WHERE status = 'running')")
+        self._execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def remove_upload(input_path):
+    """Deletes a job's uploaded file once the job has reached a final state."""
+    try:
+        if os.path.exists(input_path):
+            os.remove(input_path)
+    except OSError as e:
+        logger.warning(f"Could not remove upload {input_path}: {e}")
+
+
+def process_job(engine, store, job):
+    """Runs one claimed job page by page, storing every finished page."""
+    resolution_params = config.RESOLUTION_PRESETS[job["mode"]]
+    store.set_total_pages(job["id"], count_pages(job["input_path"]))
+
+    tmp_paths = []
+    pages = engine.infer_pages(_page_files(job["input_path"], resolution_params, tmp_paths), job["prompt"], **resolution_params)
+    try:
+        for index, image_path, text in pages:
+            store.add_page(job["id"], index, text)
+            if image_path in tmp_paths and os.path.exists(image_path):
+                os.remove(image_path)
+            if store.cancel_requested(job["id"]):
+                raise JobCancelled()
+    finally:
+        pages.close()
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class JobWorkers:
+    """Background threads that claim queued jobs and run them on a shared engine."""
+    def __init__(self, engine, store, num_workers=1):
+        self.engine = engine
+        self.store = store
+        self.num_workers = max(1, num_workers)
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+        # Without continuous batching the engine runs one page at a time
+        self._engine_lock = contextlib.nullcontext() if config.CONTINUOUS_BATCHING_ENABLED else threading.Lock()
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._loop, name=f"ocr-job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            if not self.engine.ready.wait(timeout=1.0):
+                continue
+            job = self.store.claim_next()
+            if job is None:
+                self._wakeup.wait(timeout=1.0)
+                self._wakeup.clear()
+                continue
+
+            print(f"Job {job['id']}: started ({job['filename']}, mode {job['mode']}).")
+            try:
+                with self._engine_lock:
+                    process_job(self.engine, self.store, job)
+                print(f"Job {job['id']}: {self.store.finish_done(job['id'])}.")
+            except JobCancelled:
+                self.store.finish(job["id"], "cancelled")
+                print(f"Job {job['id']}: cancelled.")
+            except Exception as e:
+                logger.error(f"Job {job['id']} failed: {e}", exc_info=True)
+                self.store.finish(job["id"], "failed", error=str(e))
+            finally:
+                remove_upload(job["input_path"])
+
+
+def create_api(engine, store, workers):
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await asyncio.to_thread(workers.stop)
+
+    api = FastAPI(title="DeepSeek-OCR jobs", lifespan=lifespan)
+    upload_dir = config.API_UPLOAD_DIR or os.path.join(project_root, "output_macos", "uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+
+    def job_or_404(job_id):
+        job = store.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown job")
+        return job
+
+    @api.get("/health")
+    async def health():
+        if not engine.ready.is_set():
+            return JSONResponse({"status": "warming up"}, status_code=503)
+        return {"status": "ok", "warmup": engine.warmup_report}
+
+    @api.post("/jobs", status_code=202)
+    async def submit_job(file: UploadFile = File(...), task: str = Form("markdown"), prompt: str = Form(None),
+                         mode: str = Form("gundam")):
+        if mode not in config.RESOLUTION_PRESETS:
+            raise HTTPException(status_code=422, detail=f"Unknown mode '{mode}'")
+        if not prompt and task not in config.PROMPT_PRESETS:
+            raise HTTPException(status_code=422, detail=f"Unknown task '{task}'")
+        prompt = prompt or config.PROMPT_PRESETS[task]
+        if "<image>" not in prompt:
+            prompt = f"<image>\n{prompt}"
+
+        suffix = os.path.splitext(file.filename or "")[1].lower() or ".png"
+        input_path = os.path.join(upload_dir, f"{uuid.uuid4().hex}{suffix}")
+        with open(input_path, "wb") as f:
+            await asyncio.to_thread(shutil.copyfileobj, file.file, f)
+
+        job_id = await asyncio.to_thread(store.create, input_path, file.filename, prompt, mode)
+        workers.notify()
+        return {"job_id": job_id, "status": "queued"}
+
+    @api.get("/jobs/{job_id}")
+    async def job_status(job_id: str):
+        job = await asyncio.to_thread(job_or_404, job_id)
+        return {key: job[key] for key in ("id", "status", "filename", "mode", "total_pages", "pages_done",
+                                          "error", "created_at", "started_at", "finished_at")}
+
+    @api.get("/jobs/{job_id}/pages")
+    async def job_pages(job_id: str, start: int = 0, limit: int = None):
+        await asyncio.to_thread(job_or_404, job_id)
+        return {"pages": await asyncio.to_thread(store.pages, job_id, start, limit)}
+
+    @api.get("/jobs/{job_id}/result", response_class=PlainTextResponse)
+    async def job_result(job_id: str):
+        job = await asyncio.to_thread(job_or_404, job_id)
+        if job["status"] != "done":
+            raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+        pages = await asyncio.to_thread(store.pages, job_id)
+        return PAGE_SEPARATOR.join(page["text"] for page in pages)
+
+    @api.post("/jobs/{job_id}/cancel")
+    async def cancel_job(job_id: str):
+        job = await asyncio.to_thread(job_or_404, job_id)
+        if job["status"] not in FINAL_STATES:
+            if await asyncio.to_thread(store.request_cancel, job_id):
+                # Cancelled before a worker claimed it; running jobs remove their upload when they stop
+                await asyncio.to_thread(remove_upload, job["input_path"])
+        return {"job_id": job_id, "status": (await asyncio.to_thread(store.get, job_id))["status"]}
+
+    @api.post("/admin/profile")
+    async def arm_profiler(requests: int = 1):
+        return {"remaining": engine.profile_next(requests)}
+
+    @api.get("/admin/profile")
+    async def profiler_status():
+        return engine.profiler.status()
+
+    return api
+
+
+def build_app(engine, db_path=None, with_ui=False):
+    """The FastAPI app (with job workers started) for `engine`, optionally with the Gradio UI under /ui."""
+    store = JobStore(db_path or config.API_DB_PATH or os.path.join(project_root, "output_macos", "jobs.sqlite3"))
+    store.requeue_interrupted()
+    workers = JobWorkers(engine, store, config.API_WORKERS).start()
+    api = create_api(engine, store, workers)
+
+    if with_ui:
+        import gradio as gr
+        from macos_workflow import app as gradio_app
+        # The UI uses the same engine instead of loading a second copy of the model
+        gradio_app.ENGINE = engine
+        api = gr.mount_gradio_app(api, gradio_app.create_ui(), path="/ui")
+    return api
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the OCR engine as an asynchronous job API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--with-ui", action="store_true", help="Also serve the Gradio UI under /ui")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    from macos_workflow.ocr_engine_macos import OCREngine
+
+    # Serve /health right away and start on jobs once the engine is warm
+    engine = OCREngine(project_root=project_root, warmup="background" if config.WARMUP_ENABLED else False)
+    uvicorn.run(build_app(engine, with_ui=args.with_ui), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,10 +17,12 @@ project_root = os.path.dirname(_current_dir)
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
-# Import our workflow components
-from macos_workflow.ocr_engine_macos import OCREngine
+# Import our workflow components. The engine (torch, transformers and the model code) is
+# imported when it is first initialized, so the UI comes up without waiting for it.
 from macos_workflow import config_macos as config
-from macos_workflow.utils import re_match, draw_bounding_boxes, pdf_to_images, save_images_to_pdf
+from macos_workflow.utils import (parse_grounding, draw_grounding, count_pdf_pages, iter_pdf_images, save_images_to_pdf,
+                                  PAGE_SEPARATOR, TIFF_EXTENSIONS, count_tiff_pages, iter_tiff_pages, AnnotatedPDFWriter)
+from macos_workflow.figures import FigureExporter, format_markdown, write_markdown
 
 # --- Internationalization (i18n) Strings ---
 I18N_STRINGS = {
@@ -143,17 +145,17 @@ def update_language_choices(lang):
     """Update global choice dictionaries based on language."""
     global TASK_PROMPTS, RESOLUTION_MODES
     TASK_PROMPTS = {
-        get_i18n_text(lang, "task_markdown"): "<image>\n<|grounding|>Convert the document to markdown.",
-        get_i18n_text(lang, "task_free_ocr"): "<image>\nFree OCR.",
-        get_i18n_text(lang, "task_parse_figure"): "<image>\nParse the figure.",
-        get_i18n_text(lang, "task_describe_image"): "<image>\nDescribe this image in detail.",
+        get_i18n_text(lang, "task_markdown"): config.PROMPT_PRESETS["markdown"],
+        get_i18n_text(lang, "task_free_ocr"): config.PROMPT_PRESETS["free_ocr"],
+        get_i18n_text(lang, "task_parse_figure"): config.PROMPT_PRESETS["parse_figure"],
+        get_i18n_text(lang, "task_describe_image"): config.PROMPT_PRESETS["describe_image"],
         get_i18n_text(lang, "task_grounding"): ""
     }
     RESOLUTION_MODES = {
-        get_i18n_text(lang, "res_base"): {"base_size": 1024, "image_size": 1024, "crop_mode": False},
-        get_i18n_text(lang, "res_gundam"): {"base_size": 1024, "image_size": 640, "crop_mode": True},
-        get_i18n_text(lang, "res_large"): {"base_size": 1280, "image_size": 1280, "crop_mode": False},
-        get_i18n_text(lang, "res_small"): {"base_size": 640, "image_size": 640, "crop_mode": False},
+        get_i18n_text(lang, "res_base"): config.RESOLUTION_PRESETS["base"],
+        get_i18n_text(lang, "res_gundam"): config.RESOLUTION_PRESETS["gundam"],
+        get_i18n_text(lang, "res_large"): config.RESOLUTION_PRESETS["large"],
+        get_i18n_text(lang, "res_small"): config.RESOLUTION_PRESETS["small"],
     }
 
 # Initialize with default language
@@ -165,6 +167,7 @@ def initialize_engine(lang='简体中文'):
     if ENGINE is None:
         print(get_i18n_text(lang, "status_init_start"))
         try:
+            from macos_workflow.ocr_engine_macos import OCREngine
             ENGINE = OCREngine(project_root=project_root)
             print(get_i18n_text(lang, "status_init_done"))
         except Exception as e:
@@ -188,7 +191,6 @@ def run_image_ocr_task(image: Image.Image, task: str, custom_prompt: str, resolu
         prompt = f"<image>\n{prompt}"
 
     resolution_params = RESOLUTION_MODES[resolution_key]
-    config.BASE_SIZE, config.IMAGE_SIZE, config.CROP_MODE = resolution_params['base_size'], resolution_params['image_size'], resolution_params['crop_mode']
 
     try:
         with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_file:
@@ -197,19 +199,20 @@ def run_image_ocr_task(image: Image.Image, task: str, custom_prompt: str, resolu
 
         progress(0.5, desc=get_i18n_text(lang, "progress_infer"))
         start_time = time.time()
-        result_text = ENGINE.infer(image_path=tmp_image_path, prompt=prompt)
+        result_text = ENGINE.infer(image_path=tmp_image_path, prompt=prompt, **resolution_params)
         inference_time = time.time() - start_time
     finally:
         if 'tmp_image_path' in locals() and os.path.exists(tmp_image_path):
             os.remove(tmp_image_path)
 
     progress(0.9, desc=get_i18n_text(lang, "progress_postprocess"))
-    matches_ref, _, _ = re_match(result_text)
-    annotated_image = draw_bounding_boxes(image, matches_ref, tempfile.gettempdir()) if matches_ref else None
-
-    with tempfile.NamedTemporaryFile(mode='w+', suffix='.md', delete=False, encoding='utf-8') as tmp_md:
-        tmp_md.write(result_text)
-        md_path = tmp_md.name
+    boxes, labels = parse_grounding(result_text)
+    annotated_image = None
+    with FigureExporter() as exporter:
+        figure_paths = exporter.export(image, boxes, labels)
+        if len(boxes):
+            annotated_image = draw_grounding(image, boxes, labels)
+    md_path = write_markdown(exporter.job_dir, format_markdown(result_text, figure_paths))
 
     img_path = None
     if annotated_image:
@@ -236,48 +239,81 @@ def run_pdf_ocr_task(pdf_file, task: str, custom_prompt: str, resolution_key: st
         prompt = f"<image>\n{prompt}"
 
     resolution_params = RESOLUTION_MODES[resolution_key]
-    config.BASE_SIZE, config.IMAGE_SIZE, config.CROP_MODE = resolution_params['base_size'], resolution_params['image_size'], resolution_params['crop_mode']
 
-    page_images = pdf_to_images(pdf_path)
-    if not page_images:
+    if pdf_path.lower().endswith(TIFF_EXTENSIONS):
+        # Multi-page TIFFs are decoded frame by frame as the pipeline asks for pages
+        total_pages = count_tiff_pages(pdf_path)
+        page_source = iter_tiff_pages(pdf_path)
+    else:
+        # PDF pages are rendered one at a time as the pipeline asks for them
+        total_pages = count_pdf_pages(pdf_path)
+        page_source = iter_pdf_images(pdf_path, resolution=resolution_params)
+    if not total_pages:
         raise gr.Error(get_i18n_text(lang, "error_pdf_extract"))
 
-    all_md_results, annotated_pages = [], []
-    total_time = 0
+    all_md_results, md_results, annotated_pages = [], [], []
+    # Figure crops of every page are written in the background into this job's own folder
+    exporter = FigureExporter()
+    tmp_image_paths = []
+    pending_pages = {}
 
-    for i, page_image in enumerate(page_images):
-        progress(i / len(page_images), desc=get_i18n_text(lang, "progress_pdf_page", i=i+1, total=len(page_images)))
-        try:
+    pdf_writer, pdf_out_path = None, None
+    if config.PDF_OUTPUT_MODE == "vector" and not pdf_path.lower().endswith(TIFF_EXTENSIONS):
+        # Boxes go straight onto the source pages as they finish, no page images are kept
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_pdf:
+            pdf_out_path = tmp_pdf.name
+        pdf_writer = AnnotatedPDFWriter(pdf_path, pdf_out_path, text_layer=config.PDF_TEXT_LAYER)
+
+    def page_image_files():
+        # Pages are written lazily so the pipeline only keeps a few of them on disk ahead of the decoder.
+        for index, page_image in enumerate(page_source):
             with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_file:
                 page_image.save(tmp_file.name)
-                tmp_image_path = tmp_file.name
-            
-            start_time = time.time()
-            result_text = ENGINE.infer(image_path=tmp_image_path, prompt=prompt)
-            total_time += (time.time() - start_time)
+                tmp_image_paths.append(tmp_file.name)
+            pending_pages[index] = page_image
+            yield tmp_file.name
 
+    progress(0, desc=get_i18n_text(lang, "progress_pdf_page", i=1, total=total_pages))
+    start_time = time.time()
+    try:
+        for i, tmp_image_path, result_text in ENGINE.infer_pages(page_image_files(), prompt, total_pages=total_pages, **resolution_params):
+            if os.path.exists(tmp_image_path):
+                os.remove(tmp_image_path)
+
+            page_image = pending_pages.pop(i)
             all_md_results.append(result_text)
-            matches_ref, _, _ = re_match(result_text)
-            annotated_page = draw_bounding_boxes(page_image, matches_ref, tempfile.gettempdir()) if matches_ref else page_image
-            annotated_pages.append(annotated_page)
-        finally:
-            if 'tmp_image_path' in locals() and os.path.exists(tmp_image_path):
+            boxes, labels = parse_grounding(result_text)
+            figure_paths = exporter.export(page_image, boxes, labels)
+            md_results.append(format_markdown(result_text, figure_paths))
+            if pdf_writer is not None:
+                pdf_writer.add_page(i, result_text)
+            else:
+                annotated_page = page_image
+                if len(boxes):
+                    annotated_page = draw_grounding(page_image, boxes, labels)
+                annotated_pages.append(annotated_page)
+
+            if i + 1 < total_pages:
+                progress((i + 1) / total_pages, desc=get_i18n_text(lang, "progress_pdf_page", i=i+2, total=total_pages))
+    finally:
+        for tmp_image_path in tmp_image_paths:
+            if os.path.exists(tmp_image_path):
                 os.remove(tmp_image_path)
+        if pdf_writer is not None:
+            pdf_writer.close()
+        exporter.close()
+    total_time = time.time() - start_time
 
     progress(0.9, desc=get_i18n_text(lang, "progress_pdf_aggregate"))
-    final_md = "\n\n<--- Page Split --->\n\n".join(all_md_results)
-    
-    with tempfile.NamedTemporaryFile(mode='w+', suffix='.md', delete=False, encoding='utf-8') as tmp_md:
-        tmp_md.write(final_md)
-        md_path = tmp_md.name
+    final_md = PAGE_SEPARATOR.join(all_md_results)
+    md_path = write_markdown(exporter.job_dir, PAGE_SEPARATOR.join(md_results))
 
-    pdf_out_path = None
     if annotated_pages:
         with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_pdf:
             save_images_to_pdf(annotated_pages, tmp_pdf.name)
             pdf_out_path = tmp_pdf.name
 
-    status = get_i18n_text(lang, "status_pdf_success", pages=len(page_images), time=total_time)
+    status = get_i18n_text(lang, "status_pdf_success", pages=total_pages, time=total_time)
     return final_md, None, md_path, pdf_out_path, status
 
 def update_custom_prompt_visibility(task: str, lang: str):
@@ -319,7 +355,7 @@ def create_ui():
                 with gr.Row(equal_height=True):
                     with gr.Column(scale=1):
                         input_header_pdf = gr.Markdown("### 1. 输入配置")
-                        pdf_input = gr.File(label="上传PDF文件", file_types=['.pdf'])
+                        pdf_input = gr.File(label="上传PDF文件", file_types=['.pdf', *TIFF_EXTENSIONS])
                         task_selector_pdf = gr.Dropdown(label="🎯 选择任务", choices=list(TASK_PROMPTS.keys()), value=list(TASK_PROMPTS.keys())[0])
                         custom_prompt_pdf = gr.Textbox(label="✍️ 输入视觉定位指令", placeholder=get_i18n_text('简体中文', 'custom_prompt_placeholder'), visible=False, lines=3)
                         resolution_selector_pdf = gr.Dropdown(label="⚙️ 选择分辨率模式", choices=list(RESOLUTION_MODES.keys()), value=list(RESOLUTION_MODES.keys())[0])
@@ -0,0 +1,448 @@
+"""
+Iteration-level (continuous) batching for DeepseekOCRForCausalLM.
+
+Every request is prefilled on its own, with its own resolution mode, and then joins the
+running decode batch. Each decode step advances all running sequences by one token; finished
+sequences leave immediately and waiting requests are admitted into the freed slots, so a
+page that emits 50 tokens never waits for one that emits 4,000.
+
+The running batch shares one preallocated KV cache (`SlotKVCache`): sequence i of the batch
+owns row i of every layer's key/value buffer, right-padded to the buffer's capacity. A decode
+step writes only each row's new position and attends over a view of the buffers, with the
+attention mask hiding each row's padding, so no cached keys or values are copied per token.
+A sequence's cache is copied once when it joins (from its prefill) and at most once when
+another sequence leaves (to keep the rows compact).
+"""
+import contextlib
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+from transformers import LogitsProcessorList, NoRepeatNGramLogitsProcessor, RepetitionPenaltyLogitsProcessor
+from transformers.cache_utils import Cache
+
+from .routing_telemetry import context_key
+
+logger = logging.getLogger(__name__)
+
+STOP_STR = '<｜end▁of▁sentence｜>'
+
+
+class SequenceState:
+    """A submitted page together with its KV cache slot and timing information."""
+    def __init__(self, request_id, image_path, prompt, base_size, image_size, crop_mode, max_new_tokens):
+        self.request_id = request_id
+        self.image_path = image_path
+        self.prompt = prompt
+        self.base_size = base_size
+        self.image_size = image_size
+        self.crop_mode = crop_mode
+        self.max_new_tokens = max_new_tokens
+        self.future = Future()
+        self.routing_key = None
+        self.memory_estimate = 0
+        self.kv_row_bytes = 0
+        self.kv_reserved = 0
+        self.reservation = None
+
+        self.token_ids = []
+        self.prompt_length = 0
+        self.generated = []
+
+        self.submitted_at = time.time()
+        self.admitted_at = None
+        self.first_token_at = None
+        self.finished_at = None
+
+    def release_memory(self):
+        if self.reservation is not None:
+            self.reservation.release()
+            self.reservation = None
+        self.kv_reserved = 0
+
+    def timings(self):
+        return {
+            "request_id": self.request_id,
+            "queue_time": self.admitted_at - self.submitted_at,
+            "time_to_first_token": self.first_token_at - self.submitted_at,
+            "latency": self.finished_at - self.submitted_at,
+            "prompt_tokens": self.prompt_length,
+            "generated_tokens": len(self.generated),
+        }
+
+
+class SlotKVCache(Cache):
+    """
+    KV cache of the running batch: per layer, key and value buffers of shape
+    (rows, heads, capacity, head_dim). Row i holds the i-th running sequence, whose first
+    `lengths[i]` positions are valid. Buffers are allocated on the first `add` and grow (with
+    headroom, so rarely) when the longest sequence reaches the capacity.
+    """
+    def __init__(self, rows, growth=256):
+        super().__init__()
+        self.rows = rows
+        self.growth = growth
+        self.keys = []
+        self.values = []
+        self.lengths = []
+        self._width = 0
+        self._write_index = None
+
+    @property
+    def capacity(self):
+        return self.keys[0].shape[2] if self.keys else 0
+
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+    def _ensure_capacity(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity + self.capacity // 2)
+        capacity = -(-capacity // self.growth) * self.growth
+        for buffers in (self.keys, self.values):
+            for layer, old in enumerate(buffers):
+                new = old.new_zeros(old.shape[:2] + (capacity,) + old.shape[3:])
+                new[:, :, :old.shape[2]] = old
+                buffers[layer] = new
+
+    def add(self, layer_cache):
+        """Copies one sequence's prefill cache (a legacy tuple, batch size 1) into the next free row."""
+        length = layer_cache[0][0].shape[2]
+        if not self.keys:
+            capacity = -(-(length + 1) // self.growth) * self.growth
+            for key, value in layer_cache:
+                self.keys.append(key.new_zeros((self.rows, key.shape[1], capacity, key.shape[3])))
+                self.values.append(value.new_zeros((self.rows, value.shape[1], capacity, value.shape[3])))
+        self._ensure_capacity(length + 1)
+        row = len(self.lengths)
+        for layer, (key, value) in enumerate(layer_cache):
+            self.keys[layer][row, :, :length] = key[0]
+            self.values[layer][row, :, :length] = value[0]
+        self.lengths.append(length)
+        return row
+
+    def remove(self, row):
+        """Frees `row` by moving the last row into it. Frees the buffers once the batch is empty."""
+        last = len(self.lengths) - 1
+        if row != last:
+            length = self.lengths[last]
+            for buffers in (self.keys, self.values):
+                for buffer in buffers:
+                    buffer[row, :, :length] = buffer[last, :, :length]
+            self.lengths[row] = length
+        self.lengths.pop()
+        if not self.lengths:
+            self.reset()
+
+    def reset(self):
+        self.keys, self.values, self.lengths = [], [], []
+
+    def begin_step(self, device):
+        """
+        Prepares a decode step of all rows. Returns (attention_mask, position_ids): each row's
+        new token goes to position `lengths[i]`, and the mask covers the valid positions.
+        """
+        self._width = max(self.lengths) + 1
+        self._ensure_capacity(self._width)
+        lengths = torch.tensor(self.lengths, dtype=torch.long, device=device)
+        columns = torch.arange(self._width, device=device)
+        attention_mask = (columns.unsqueeze(0) <= lengths.unsqueeze(1)).long()
+        self._write_index = (torch.arange(len(self.lengths), device=device), lengths)
+        return attention_mask, lengths.unsqueeze(1)
+
+    def end_step(self):
+        self.lengths = [length + 1 for length in self.lengths]
+        self._write_index = None
+
+    # --- transformers Cache interface, used by the decoder layers during a decode step ---
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        rows, columns = self._write_index
+        key, value = self.keys[layer_idx], self.values[layer_idx]
+        key[rows, :, columns] = key_states[:, :, 0]
+        value[rows, :, columns] = value_states[:, :, 0]
+        return key[:len(self.lengths), :, :self._width], value[:len(self.lengths), :, :self._width]
+
+    def get_seq_length(self, layer_idx=0):
+        return self._width - 1
+
+    def get_max_length(self):
+        return None
+
+    def get_usable_length(self, new_seq_length, layer_idx=0):
+        return self._width - 1
+
+
+class ContinuousBatchScheduler:
+    """
+    Background scheduler that owns the model while running. Use `submit` from any thread;
+    it returns a Future resolving to the decoded text. Decoding is greedy, with the settings
+    the model's `generate_ocr` uses for its device.
+    """
+    def __init__(self, model, tokenizer, max_batch_size=4, max_prefills_per_step=1, max_new_tokens=4096,
+                 telemetry=None, memory_budget=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_prefills_per_step = max(1, max_prefills_per_step)
+        self.default_max_new_tokens = max_new_tokens
+        self.telemetry = telemetry
+        self.memory_budget = memory_budget
+
+        settings = model.ocr_decoding_settings(next(model.parameters()).device, eval_mode=True)
+        processors = []
+        if settings.get('repetition_penalty'):
+            processors.append(RepetitionPenaltyLogitsProcessor(settings['repetition_penalty']))
+        processors.append(NoRepeatNGramLogitsProcessor(settings['no_repeat_ngram_size']))
+        self.logits_processor = LogitsProcessorList(processors)
+        self.min_new_tokens = settings.get('min_new_tokens', 0)
+
+        self._waiting = deque()
+        # Ordered like the rows of the shared KV cache
+        self._running = []
+        self._cache = SlotKVCache(self.max_batch_size)
+        self._ids = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+        self._steps = 0
+        self._occupied_slots = 0
+        self._decode_seconds = 0.0
+        self._completed = deque(maxlen=1000)
+
+    # --- Public API ---
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="ocr-batch-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, image_path, prompt, base_size, image_size, crop_mode, max_new_tokens=None):
+        """
+        Queues one page and returns a Future for its text. With a memory budget the page may be
+        downgraded to a smaller resolution mode, and it is admitted only once its estimate fits.
+        """
+        max_new_tokens = max_new_tokens or self.default_max_new_tokens
+        estimate = None
+        if self.memory_budget is not None:
+            (base_size, image_size, crop_mode), estimate = self.memory_budget.plan(
+                image_path, (base_size, image_size, crop_mode), max_new_tokens, batch_size=self.max_batch_size)
+        seq = SequenceState(next(self._ids), image_path, prompt, base_size, image_size, crop_mode, max_new_tokens)
+        if estimate is not None:
+            seq.memory_estimate = estimate["activations"]
+            seq.kv_row_bytes = estimate["kv"]
+        if self.telemetry is not None:
+            seq.routing_key = context_key(prompt, base_size, image_size, crop_mode)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Batch scheduler is stopped.")
+            self._waiting.append(seq)
+            self._condition.notify_all()
+        return seq.future
+
+    def stats(self):
+        """Batch occupancy and per-request latency of recently completed requests."""
+        with self._condition:
+            completed = list(self._completed)
+            waiting, running = len(self._waiting), len(self._running)
+        latencies = sorted(c["latency"] for c in completed)
+        return {
+            "decode_steps": self._steps,
+            "mean_batch_occupancy": (self._occupied_slots / (self._steps * self.max_batch_size)) if self._steps else 0.0,
+            "decode_tokens_per_second": (self._occupied_slots / self._decode_seconds) if self._decode_seconds else None,
+            "waiting": waiting,
+            "running": running,
+            "completed": len(completed),
+            "mean_latency": (sum(latencies) / len(latencies)) if latencies else None,
+            "max_latency": latencies[-1] if latencies else None,
+            "requests": completed,
+        }
+
+    def kv_cache_bytes(self):
+        """Bytes allocated for the running batch's KV cache."""
+        return self._cache.nbytes()
+
+    # --- Scheduling loop ---
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._stopped and not self._waiting and not self._running:
+                    self._condition.wait()
+                if self._stopped:
+                    break
+                admitted = []
+                while self._waiting and len(self._running) + len(admitted) < self.max_batch_size \
+                        and len(admitted) < self.max_prefills_per_step:
+                    if self.memory_budget is not None:
+                        seq = self._waiting[0]
+                        kv_growth = self._kv_growth(seq, admitted)
+                        seq.reservation = self.memory_budget.try_reserve(seq.memory_estimate + kv_growth,
+                                                                         os.path.basename(seq.image_path))
+                        if seq.reservation is None:
+                            # Stays queued until a running sequence finishes and frees its share
+                            break
+                        seq.kv_reserved = kv_growth
+                    admitted.append(self._waiting.popleft())
+                if not admitted and not self._running:
+                    # Everything waiting is held back by memory used outside this scheduler
+                    self._condition.wait(timeout=0.1)
+                    continue
+
+            for seq in admitted:
+                self._run_guarded([seq], self._prefill, seq)
+            self._evict_finished()
+
+            if self._running:
+                running = list(self._running)
+                self._run_guarded(running, self._decode_step, running)
+                self._evict_finished()
+
+        self._fail_all(RuntimeError("Batch scheduler stopped."))
+
+    def _kv_growth(self, seq, admitted):
+        """
+        Bytes the shared KV cache grows by when `seq` joins: all its rows are padded to the
+        longest sequence. Reserved by the sequence that causes the growth. Call with the lock held.
+        """
+        batch = self._running + admitted
+        needed = self.max_batch_size * max([seq.kv_row_bytes] + [s.kv_row_bytes for s in batch])
+        return max(0, needed - sum(s.kv_reserved for s in batch))
+
+    def _run_guarded(self, sequences, step, *args):
+        """Runs a model step; on failure the affected sequences are failed instead of the loop."""
+        try:
+            step(*args)
+        except Exception as e:
+            logger.error(f"Batch scheduler step failed: {e}", exc_info=True)
+            for seq in sequences:
+                seq.release_memory()
+                if not seq.future.done():
+                    seq.future.set_exception(e)
+
+    def _fail_all(self, error):
+        with self._condition:
+            pending = list(self._waiting) + self._running
+            self._waiting.clear()
+            self._running = []
+            self._cache.reset()
+        for seq in pending:
+            seq.release_memory()
+            if not seq.future.done():
+                seq.future.set_exception(error)
+
+    def _evict_finished(self):
+        """Drops finished (or failed) sequences from the batch, keeping `_running` aligned with the cache rows."""
+        for row in range(len(self._running) - 1, -1, -1):
+            if self._running[row].future.done():
+                self._cache.remove(row)
+                self._running[row] = self._running[-1]
+                self._running.pop()
+
+    # --- Model steps ---
+
+    def _routing_context(self, sequences):
+        if self.telemetry is None:
+            return contextlib.nullcontext()
+        return self.telemetry.batch_context([seq.routing_key for seq in sequences])
+
+    def _next_token(self, seq, logits):
+        history = torch.tensor([seq.token_ids], dtype=torch.long, device=logits.device)
+        scores = self.logits_processor(history, logits.float().unsqueeze(0))
+        if len(seq.generated) < self.min_new_tokens:
+            scores[:, self.tokenizer.eos_token_id] = -float("inf")
+        return int(torch.argmax(scores, dim=-1).item())
+
+    def _append_token(self, seq, token_id):
+        seq.token_ids.append(token_id)
+        seq.generated.append(token_id)
+        if seq.first_token_at is None:
+            seq.first_token_at = time.time()
+
+        if token_id == self.tokenizer.eos_token_id or len(seq.generated) >= seq.max_new_tokens:
+            self._finish(seq)
+
+    def _finish(self, seq):
+        seq.release_memory()
+        seq.finished_at = time.time()
+        generated = [t for t in seq.generated if t != self.tokenizer.eos_token_id]
+        text = self.tokenizer.decode(generated)
+        if text.endswith(STOP_STR):
+            text = text[:-len(STOP_STR)]
+        with self._condition:
+            self._completed.append(seq.timings())
+        seq.future.set_result(text.strip())
+
+    @staticmethod
+    def _legacy_cache(past_key_values):
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        return past_key_values
+
+    def _prefill(self, seq):
+        """Runs the prompt (with its image) of one sequence and copies its KV cache into a free row."""
+        seq.admitted_at = time.time()
+        model_device = next(self.model.parameters()).device
+        inputs = self.model.prepare_ocr_inputs(
+            self.tokenizer, prompt=seq.prompt, image_file=seq.image_path,
+            base_size=seq.base_size, image_size=seq.image_size, crop_mode=seq.crop_mode,
+        )
+        seq.token_ids = inputs.input_ids.tolist()
+        seq.prompt_length = len(seq.token_ids)
+
+        with torch.no_grad(), self._routing_context([seq]):
+            outputs = self.model.model(
+                input_ids=inputs.input_ids.unsqueeze(0).to(model_device),
+                images=[(inputs.images_crop.to(model_device), inputs.images_ori.to(model_device))],
+                images_seq_mask=inputs.images_seq_mask.unsqueeze(0).to(model_device),
+                images_spatial_crop=inputs.images_spatial_crop,
+                use_cache=True,
+                return_dict=True,
+            )
+            logits = self.model.lm_head(outputs.last_hidden_state[:, -1, :])
+
+        self._cache.add(self._legacy_cache(outputs.past_key_values))
+        self._running.append(seq)
+        self._append_token(seq, self._next_token(seq, logits[0]))
+
+    def _decode_step(self, sequences):
+        """Advances every running sequence by one token in a single batched forward pass."""
+        start_time = time.perf_counter()
+        model_device = next(self.model.parameters()).device
+        attention_mask, position_ids = self._cache.begin_step(model_device)
+        input_ids = torch.tensor([[seq.token_ids[-1]] for seq in sequences], dtype=torch.long, device=model_device)
+
+        with torch.no_grad(), self._routing_context(sequences):
+            outputs = self.model.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                use_cache=True,
+                return_dict=True,
+            )
+            logits = self.model.lm_head(outputs.last_hidden_state[:, -1, :])
+        self._cache.end_step()
+
+        self._steps += 1
+        self._occupied_slots += len(sequences)
+        self._decode_seconds += time.perf_counter() - start_time
+
+        for i, seq in enumerate(sequences):
+            self._append_token(seq, self._next_token(seq, logits[i]))
@@ -7,6 +7,10 @@ Configuration for the DeepSeek-OCR macOS workflow.
 # Use "mps" for Apple Silicon GPU acceleration, or "cpu" for CPU.
 DEVICE = "cpu"
 
+# Weight precision: "float32", or "bfloat16" to halve memory (compare accuracy with
+# `python -m macos_workflow.sweep` first)
+MODEL_DTYPE = "float32"
+
 # --- Image Processing Settings ---
 # These are default values; the Gradio UI can override them dynamically.
 # Size for the global view of the image
@@ -15,8 +19,192 @@ BASE_SIZE = 1024
 IMAGE_SIZE = 640
 # Whether to use the dynamic tiling mode ("Gundam" mode)
 CROP_MODE = True
+# Decode large JPEGs / pyramidal TIFFs at a reduced resolution when the selected mode
+# does not need the full-size image. Off by default: the model then sees DCT-scaled pixels, so
+# compare accuracy first (python -m macos_workflow.evaluation ... --option reduced_decode)
+REDUCED_RESOLUTION_DECODE = False
+# Reuse a cached embedding for uniform (blank margin) tiles instead of running the vision encoder
+BLANK_TILE_MEMO = True
+# Drop global-view tokens that only cover the padding around non-square pages (changes what
+# the decoder sees; check with `python -m macos_workflow.evaluation` before enabling)
+PRUNE_PADDING_TOKENS = False
+
+# Resolution modes offered by the UI and the headless runners
+RESOLUTION_PRESETS = {
+    "base": {"base_size": 1024, "image_size": 1024, "crop_mode": False},
+    "gundam": {"base_size": 1024, "image_size": 640, "crop_mode": True},
+    "large": {"base_size": 1280, "image_size": 1280, "crop_mode": False},
+    "small": {"base_size": 640, "image_size": 640, "crop_mode": False},
+}
 
 # --- Prompt Settings ---
 # Default prompt for document processing
 DEFAULT_PROMPT = "<image>\n<|grounding|>Convert the document to markdown."
+# Prompts for the built-in tasks
+PROMPT_PRESETS = {
+    "markdown": "<image>\n<|grounding|>Convert the document to markdown.",
+    "free_ocr": "<image>\nFree OCR.",
+    "parse_figure": "<image>\nParse the figure.",
+    "describe_image": "<image>\nDescribe this image in detail.",
+}
+
+
+# --- Pipeline Settings ---
+# Overlap the vision encoder (SAM/CLIP) of the next page with decoding of the current page
+# when processing multi-page inputs.
+PIPELINE_ENABLED = True
+# Maximum number of encoded pages waiting for the decoder (bounded queue between the stages)
+PIPELINE_QUEUE_SIZE = 2
+# Worker threads in the vision stage pool. torch's intra-op threads are shared by both stages;
+# more workers give the vision stage a larger part of them.
+PIPELINE_VISION_WORKERS = 1
+
+# --- Continuous Batching Settings ---
+# Route requests through the iteration-level batching scheduler instead of one generate() call per page.
+# New pages join the running decode batch as soon as other sequences finish.
+CONTINUOUS_BATCHING_ENABLED = False
+# Maximum number of sequences decoded together
+BATCH_MAX_SIZE = 4
+# Maximum number of new sequences prefilled between two decode steps
+BATCH_MAX_PREFILLS_PER_STEP = 1
+# Default generation length limit for batched requests
+BATCH_MAX_NEW_TOKENS = 4096
+
+# --- PDF Rasterization Settings ---
+# Worker processes used to render PDF pages (None = min(4, CPU count))
+RASTER_WORKERS = None
+# Documents shorter than this are rendered in-process
+RASTER_PARALLEL_MIN_PAGES = 8
+
+# --- Annotated PDF Output ---
+# "vector": draw boxes as annotations on the source PDF pages (PDF input only)
+# "raster": re-encode every annotated page image into a new PDF
+PDF_OUTPUT_MODE = "vector"
+# Add the recognized text as an invisible, searchable text layer in vector mode
+PDF_TEXT_LAYER = True
+
+# --- Figure Export Settings ---
+# Threads encoding figure crops to JPEG while later pages are still decoding
+FIGURE_EXPORT_WORKERS = 4
+FIGURE_JPEG_QUALITY = 95
+# Job output folders (markdown + figure crops) older than this are deleted, unless a job still writes to them
+FIGURE_JOB_RETENTION_HOURS = 24
+# The purge runs in the background when the first job starts, then at most this often
+FIGURE_JOB_PURGE_INTERVAL_MINUTES = 60
+
+# --- Mixture-of-Experts Settings ---
+# Sort tokens by expert and run fused per-expert GEMMs instead of the stock MoE dispatch
+MOE_GROUPED_DISPATCH = True
+# Keep routed-expert weights in memory-mapped files and page them in when selected (CPU only).
+# The experts are then never fully loaded into RAM, at startup included (needs a safetensors checkpoint).
+# Implies grouped dispatch.
+EXPERT_PAGING_ENABLED = False
+# Where the per-layer expert files are written (None = <project root>/expert_cache)
+EXPERT_CACHE_DIR = None
+# Maximum number of experts (over all layers) kept resident. Enforced on Linux only: on macOS
+# evicted experts are released when the kernel chooses (see expert_paging.py)
+EXPERT_MAX_RESIDENT = 128
+# Record per-layer expert hit counts and load imbalance per task/resolution mode
+ROUTING_TELEMETRY_ENABLED = False
+# JSON export path (None = <output_macos>/routing_telemetry.json)
+ROUTING_TELEMETRY_PATH = None
+
+# --- Vision Encoder Backend ---
+# "torch": eager PyTorch; "onnx": ONNX Runtime on CPU (requires `pip install onnxruntime`)
+VISION_BACKEND = "torch"
+# Where exported encoder graphs are kept (None = <project root>/onnx_vision)
+VISION_ONNX_DIR = None
+# Use int8 dynamically quantized graphs
+VISION_ONNX_QUANTIZE = False
+# Compare ONNX and eager outputs at startup; sizes below the cosine threshold stay on PyTorch
+VISION_ONNX_PARITY_CHECK = True
+VISION_ONNX_MIN_COSINE = 0.99
+
+# --- Job API Settings ---
+# SQLite job table of `python -m macos_workflow.api_server` (None = output_macos/jobs.sqlite3)
+API_DB_PATH = None
+# Where uploaded documents are stored (None = output_macos/uploads)
+API_UPLOAD_DIR = None
+# Background job workers; more than one only overlaps work with continuous batching enabled
+API_WORKERS = 1
+
+# --- Distributed Work Queue Settings ---
+# A leased page is handed to another worker if not renewed within this time
+DISTRIBUTED_LEASE_SECONDS = 300
+# Attempts per page before the document is reported as failed
+DISTRIBUTED_MAX_ATTEMPTS = 3
+# Finished documents (results and page images) are deleted from a SQLite broker this long after
+# they were submitted; None keeps them
+DISTRIBUTED_RETENTION_HOURS = 24
+# Pages sent to the broker per request while a document is submitted (workers can start on the first ones)
+DISTRIBUTED_SUBMIT_BATCH_PAGES = 8
+# Worker calls to an unreachable broker are retried with exponential backoff (seconds, doubling up to the max)
+DISTRIBUTED_BROKER_RETRIES = 5
+DISTRIBUTED_RETRY_DELAY = 1.0
+DISTRIBUTED_RETRY_MAX_DELAY = 30.0
+
+# --- Priority Scheduling Settings ---
+# Queue pages in a priority scheduler: single images ("interactive") run before the next page
+# of a long document ("bulk"). Document pages then run one by one instead of pipelined.
+PRIORITY_SCHEDULING_ENABLED = False
+# Smallest share of pages bulk documents get while interactive pages keep arriving (0: none)
+PRIORITY_BULK_MIN_SHARE = 0.1
+# Expected output tokens per task preset, for the cost model
+EXPECTED_OUTPUT_TOKENS = {
+    "markdown": 1500,
+    "free_ocr": 1200,
+    "parse_figure": 600,
+    "describe_image": 300,
+    "default": 1000,
+}
+# How many prefill tokens one decoded token costs
+COST_DECODE_TOKEN_WEIGHT = 8
+
+# --- Memory Budget Settings ---
+# Admit requests only while their estimated peak memory fits this budget (in GB, for the whole
+# process including the model). None disables admission control.
+MEMORY_BUDGET_GB = None
+# Run a page that could never fit in a smaller resolution preset instead of as requested
+MEMORY_ALLOW_DOWNGRADE = True
+# Seconds a request may wait for memory before failing
+MEMORY_ADMISSION_TIMEOUT = 600
+
+# --- CPU Thread Settings ---
+# Profile written by `python -m macos_workflow.cpu_tuning autotune` (default: <project root>/cpu_profile.json)
+CPU_PROFILE_PATH = None
+# Overrides for the profile; None keeps the profile's value (or torch's default without one)
+CPU_THREADS = None
+CPU_INTEROP_THREADS = None
+# Pin each worker process to NUMA-local cores (OCR_WORKER_INDEX / OCR_WORKER_COUNT select the share;
+# processes started without them are never pinned)
+CPU_PIN_NUMA = None
+
+# --- Warmup Settings ---
+# Run synthetic pages through every mode and crop-grid shape at startup, so the first real
+# request does not pay for allocator growth and kernel setup. The engine reports ready after.
+WARMUP_ENABLED = False
+# Resolution presets to warm up (None: all of RESOLUTION_PRESETS)
+WARMUP_MODES = None
+# Tokens generated per warmup page
+WARMUP_MAX_NEW_TOKENS = 8
+
+# --- Startup Settings ---
+# Import-time budget in seconds per entry point, checked by `python -m macos_workflow.import_report`.
+# The engine's budget covers torch, transformers and the model code; the others should stay light
+# so that short-lived workers and the UI start quickly.
+STARTUP_IMPORT_BUDGET = {
+    "macos_workflow.headless": 0.5,
+    "macos_workflow.distributed": 0.5,
+    "macos_workflow.api_server": 2.0,
+    "macos_workflow.app": 5.0,
+    "macos_workflow.ocr_engine_macos": 8.0,
+}
 
+# --- Profiling Settings ---
+# Run the next N pages under torch.profiler (the OCR_PROFILE_NEXT environment variable and
+# POST /admin/profile on the job API do the same at runtime)
+PROFILE_NEXT_REQUESTS = 0
+# Where Chrome traces and operator tables go (default: output_macos/profiles)
+PROFILE_DIR = None
+# Operators listed in each table
+PROFILE_ROW_LIMIT = 30
@@ -0,0 +1,335 @@
+"""
+CPU thread, affinity and NUMA settings for the engine.
+
+`autotune` calibrates prefill and decode speed for each resolution mode over a range of
+intra-op thread counts, then measures aggregate throughput with several worker processes
+running side by side, each pinned to its own share of a NUMA node. The best settings are
+written to a JSON profile that `OCREngine` applies at startup (`apply_cpu_settings`).
+
+A worker process learns its place from OCR_WORKER_INDEX and OCR_WORKER_COUNT. Pinned
+workers are spread round-robin over the NUMA nodes, and the cores of a node are split evenly
+between the workers placed on it.
+
+Usage:
+    python -m macos_workflow.cpu_tuning autotune --modes gundam base --threads 2 4 8 --workers 1 2
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Same project-root handling as app.py, so the DeepSeek_OCR package is importable.
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(_current_dir)
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import torch
+
+from macos_workflow import config_macos as config
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cpulist(text):
+    """Parses a Linux cpulist such as "0-3,8-11" into a list of CPU ids."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def numa_nodes():
+    """{node: [cpu, ...]} restricted to the CPUs this process may use. One node where NUMA is not exposed."""
+    allowed = set(available_cpus())
+    nodes = {}
+    base = "/sys/devices/system/node"
+    if os.path.isdir(base):
+        for name in sorted(os.listdir(base)):
+            if not (name.startswith("node") and name[4:].isdigit()):
+                continue
+            with open(os.path.join(base, name, "cpulist")) as f:
+                cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in allowed]
+            if cpus:
+                nodes[int(name[4:])] = cpus
+    return nodes or {0: sorted(allowed)}
+
+
+def worker_cpus(worker_index, workers, nodes=None):
+    """The NUMA-local cores for worker `worker_index` of `workers`."""
+    nodes = nodes or numa_nodes()
+    node_ids = sorted(nodes)
+    node = node_ids[worker_index % len(node_ids)]
+    siblings = [i for i in range(workers) if i % len(node_ids) == worker_index % len(node_ids)]
+    cpus = nodes[node]
+    share = max(1, len(cpus) // len(siblings))
+    rank = siblings.index(worker_index)
+    return cpus[rank * share:(rank + 1) * share] or cpus
+
+
+def worker_identity():
+    """
+    (worker_index, workers) from OCR_WORKER_INDEX / OCR_WORKER_COUNT, or None when neither is
+    set, i.e. for a process that was not launched as one of several workers.
+    """
+    if "OCR_WORKER_INDEX" not in os.environ and "OCR_WORKER_COUNT" not in os.environ:
+        return None
+    index = int(os.environ.get("OCR_WORKER_INDEX", 0))
+    workers = int(os.environ.get("OCR_WORKER_COUNT", index + 1))
+    return index, max(workers, index + 1)
+
+
+def pin_worker(worker_index, workers):
+    """Restricts this process to its NUMA-local cores. Returns the CPU list, or None where unsupported."""
+    if not hasattr(os, "sched_setaffinity"):
+        logger.info("CPU affinity is not supported on this platform; not pinning.")
+        return None
+    cpus = worker_cpus(worker_index, workers)
+    os.sched_setaffinity(0, cpus)
+    return cpus
+
+
+def default_profile_path():
+    return config.CPU_PROFILE_PATH or os.path.join(project_root, "cpu_profile.json")
+
+
+def load_profile(path=None):
+    path = path or default_profile_path()
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def apply_cpu_settings(profile=None):
+    """
+    Applies the thread and affinity settings: config overrides first, then the autotune profile.
+    Must run before the first parallel torch op, since inter-op threads can only be set once.
+    Returns the settings that were applied.
+
+    Only processes launched as workers (OCR_WORKER_INDEX / OCR_WORKER_COUNT set) are pinned and
+    use the per-worker thread count; a standalone app or API server uses the profile's
+    single-process `threads` on all cores, whatever worker count the profile recommends.
+    """
+    profile = load_profile() if profile is None else profile
+    identity = worker_identity()
+    worker_index, workers = identity or (0, 1)
+    pin = identity is not None and (config.CPU_PIN_NUMA if config.CPU_PIN_NUMA is not None
+                                    else profile.get("pin_numa", False))
+
+    cpus = pin_worker(worker_index, workers) if pin else None
+    threads = config.CPU_THREADS or (profile.get("threads_per_worker") if workers > 1 else profile.get("threads"))
+    if cpus and threads:
+        threads = min(threads, len(cpus))
+    elif cpus:
+        threads = len(cpus)
+    if threads:
+        torch.set_num_threads(threads)
+
+    interop_threads = config.CPU_INTEROP_THREADS or profile.get("interop_threads")
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            logger.warning(f"Could not set inter-op threads: {e}")
+
+    return {"worker_index": worker_index, "workers": workers, "cpus": cpus,
+            "threads": torch.get_num_threads(), "interop_threads": torch.get_num_interop_threads()}
+
+
+# --- Calibration ---
+
+def measure_page(engine, image_path, prompt, mode, decode_tokens=32):
+    """
+    Times one page in `mode`. Returns {"prefill": seconds for vision plus prompt,
+    "decode": seconds per generated token, "generated": tokens}.
+    """
+    model, tokenizer = engine.model, engine.tokenizer
+    base_size, image_size, crop_mode = mode
+
+    t0 = time.perf_counter()
+    inputs = model.prepare_ocr_inputs(tokenizer, prompt=prompt, image_file=image_path,
+                                      base_size=base_size, image_size=image_size, crop_mode=crop_mode)
+    features = model.encode_ocr_inputs(inputs)
+    t1 = time.perf_counter()
+    model.generate_ocr(tokenizer, inputs, image_features=features, eval_mode=True, max_new_tokens=1)
+    t2 = time.perf_counter()
+    output_ids = model.generate_ocr(tokenizer, inputs, image_features=features, eval_mode=True,
+                                    max_new_tokens=decode_tokens)
+    t3 = time.perf_counter()
+
+    generated = max(1, output_ids.shape[1] - inputs.input_ids.shape[0])
+    # The second run repeats the prompt prefill; the rest of it is spent decoding
+    decode = max(0.0, (t3 - t2) - (t2 - t1)) / max(1, generated - 1)
+    return {"prefill": t2 - t0, "decode": decode, "generated": generated}
+
+
+def page_seconds(measurement, output_tokens):
+    return measurement["prefill"] + output_tokens * measurement["decode"]
+
+
+def calibrate_threads(engine, image_path, prompt, modes, thread_counts, decode_tokens=32):
+    """Returns {mode name: {threads: measurement}}, after one untimed warmup page per mode."""
+    previous = torch.get_num_threads()
+    results = {name: {} for name in modes}
+    try:
+        for name, mode in modes.items():
+            measure_page(engine, image_path, prompt, mode, decode_tokens=2)
+            for threads in thread_counts:
+                torch.set_num_threads(threads)
+                results[name][threads] = measure_page(engine, image_path, prompt, mode, decode_tokens)
+                m = results[name][threads]
+                print(f"  {name:>7} {threads:>3} threads: prefill {m['prefill']:.2f}s, decode {m['decode'] * 1000:.1f} ms/token")
+    finally:
+        torch.set_num_threads(previous)
+    return results
+
+
+def _run_workers(workers, threads, mode_name, image_path, task, decode_tokens):
+    """Runs `workers` pinned measuring processes at once. Returns their measurements."""
+    processes = []
+    for index in range(workers):
+        env = dict(os.environ, OCR_WORKER_INDEX=str(index), OCR_WORKER_COUNT=str(workers))
+        command = [sys.executable, "-m", "macos_workflow.cpu_tuning", "measure", image_path,
+                   "--mode", mode_name, "--task", task, "--threads", str(threads),
+                   "--decode-tokens", str(decode_tokens), "--pin"]
+        processes.append(subprocess.Popen(command, cwd=project_root, env=env, stdout=subprocess.PIPE, text=True))
+    measurements = []
+    for process in processes:
+        stdout, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"Calibration worker exited with code {process.returncode}")
+        measurements.append(json.loads(stdout.strip().splitlines()[-1]))
+    return measurements
+
+
+def autotune(engine, image_path, task, mode_names, thread_counts, worker_counts, decode_tokens=32):
+    """Calibrates and returns a profile (see `apply_cpu_settings`)."""
+    from .scheduler import expected_output_tokens
+
+    prompt = config.PROMPT_PRESETS[task]
+    if "<image>" not in prompt:
+        prompt = f"<image>\n{prompt}"
+    output_tokens = expected_output_tokens(prompt)
+    modes = {name: preset_mode(name) for name in mode_names}
+    cpus = available_cpus()
+    nodes = numa_nodes()
+
+    print(f"Calibrating {len(cpus)} CPUs on {len(nodes)} NUMA node(s), {output_tokens} expected output tokens per page.")
+    per_mode = calibrate_threads(engine, image_path, prompt, modes, thread_counts, decode_tokens)
+    # One thread count for all modes: the one with the least total page time across them
+    threads = min(thread_counts, key=lambda t: sum(page_seconds(per_mode[name][t], output_tokens) for name in modes))
+    best_pages_per_second = {1: 1.0 / page_seconds(per_mode[mode_names[0]][threads], output_tokens)}
+
+    for workers in worker_counts:
+        if workers <= 1:
+            continue
+        threads_per_worker = max(1, len(cpus) // workers)
+        print(f"  {workers} workers x {threads_per_worker} threads ({mode_names[0]})...")
+        measurements = _run_workers(workers, threads_per_worker, mode_names[0], image_path, task, decode_tokens)
+        best_pages_per_second[workers] = sum(1.0 / page_seconds(m, output_tokens) for m in measurements)
+
+    workers = max(best_pages_per_second, key=best_pages_per_second.get)
+    for count, pages_per_second in sorted(best_pages_per_second.items()):
+        print(f"  {count} worker(s): {pages_per_second * 3600:.0f} pages/hour")
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cpus": len(cpus),
+        "numa_nodes": len(nodes),
+        "threads": threads,
+        "interop_threads": 1,
+        "workers": workers,
+        "threads_per_worker": max(1, len(cpus) // workers),
+        "pin_numa": workers > 1,
+        "calibration": {
+            "task": task,
+            "per_mode": {name: {str(t): m for t, m in results.items()} for name, results in per_mode.items()},
+            "pages_per_hour": {str(count): pps * 3600 for count, pps in best_pages_per_second.items()},
+        },
+    }
+
+
+def preset_mode(name):
+    preset = config.RESOLUTION_PRESETS[name]
+    return preset["base_size"], preset["image_size"], preset["crop_mode"]
+
+
+def _calibration_image(path):
+    if path:
+        return path
+    from macos_workflow.warmup import synthetic_page
+    path = os.path.join(tempfile.gettempdir(), "deepseek_ocr_calibration.png")
+    synthetic_page().save(path)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tune CPU threads, worker processes and NUMA pinning.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    autotune_parser = subparsers.add_parser("autotune", help="Calibrate and write a CPU profile")
+    autotune_parser.add_argument("--image", help="Calibration page (default: a synthetic text page)")
+    autotune_parser.add_argument("--task", choices=sorted(config.PROMPT_PRESETS), default="free_ocr")
+    autotune_parser.add_argument("--modes", nargs="+", choices=sorted(config.RESOLUTION_PRESETS), default=["gundam"])
+    autotune_parser.add_argument("--threads", nargs="+", type=int,
+                                 help="Intra-op thread counts to try (default: powers of two up to the CPU count)")
+    autotune_parser.add_argument("--workers", nargs="+", type=int, default=[1, 2], help="Worker-process counts to try")
+    autotune_parser.add_argument("--decode-tokens", type=int, default=32)
+    autotune_parser.add_argument("--output", help="Profile path (default: CPU_PROFILE_PATH or cpu_profile.json)")
+
+    measure_parser = subparsers.add_parser("measure", help="Time one page and print JSON (used by autotune)")
+    measure_parser.add_argument("image")
+    measure_parser.add_argument("--task", choices=sorted(config.PROMPT_PRESETS), default="free_ocr")
+    measure_parser.add_argument("--mode", choices=sorted(config.RESOLUTION_PRESETS), default="gundam")
+    measure_parser.add_argument("--threads", type=int, required=True)
+    measure_parser.add_argument("--decode-tokens", type=int, default=32)
+    measure_parser.add_argument("--pin", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "measure":
+        profile = {"threads": args.threads, "threads_per_worker": args.threads, "pin_numa": args.pin}
+    else:
+        # Calibrate from a clean slate, not from a previous profile
+        profile = {}
+
+    from macos_workflow.ocr_engine_macos import OCREngine
+    engine = OCREngine(project_root=project_root, cpu_profile=profile)
+
+    if args.command == "measure":
+        prompt = config.PROMPT_PRESETS[args.task]
+        if "<image>" not in prompt:
+            prompt = f"<image>\n{prompt}"
+        mode = preset_mode(args.mode)
+        measure_page(engine, args.image, prompt, mode, decode_tokens=2)
+        print(json.dumps(measure_page(engine, args.image, prompt, mode, args.decode_tokens)))
+        return
+
+    cpus = len(available_cpus())
+    thread_counts = args.threads or sorted({2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus} | {cpus})
+    profile = autotune(engine, _calibration_image(args.image), args.task, args.modes, thread_counts,
+                       args.workers, args.decode_tokens)
+    output = args.output or default_profile_path()
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    print(f"{profile['workers']} worker(s) x {profile['threads_per_worker'] if profile['workers'] > 1 else profile['threads']} "
+          f"threads, NUMA pinning {'on' if profile['pin_numa'] else 'off'}. Profile written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,557 @@
+"""
+Multi-host page work queue.
+
+A coordinator splits a document into page tasks (the rendered page image travels with the
+task) and puts them on a broker a few pages at a time, as they are rendered, so neither side
+holds the whole document in memory. Stateless workers on any host lease a task, run `infer` and
+push the text back. Leases expire, so pages held by a crashed or stalled worker are handed
+out again, up to `max_attempts` times. The coordinator reassembles finished pages in page
+order, joined with PAGE_SEPARATOR like `run_pdf_ocr_task`.
+
+Brokers:
+    SQLiteBroker   a local database file; several processes on one box can share it
+    HTTPBroker     client for `serve_broker`, which exposes a SQLiteBroker over HTTP
+
+Usage:
+    python -m macos_workflow.distributed broker --host 0.0.0.0 --port 8100
+    python -m macos_workflow.distributed worker --broker http://coordinator:8100
+    python -m macos_workflow.distributed submit scan.pdf --broker http://coordinator:8100 --output scan.md
+(`--broker` also accepts a path to a SQLite file for single-box runs.) The broker listens on
+127.0.0.1 by default and has no authentication: expose it with --host only on a trusted network.
+"""
+import abc
+import argparse
+import base64
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+
+# Same project-root handling as app.py, so the DeepSeek_OCR package is importable.
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(_current_dir)
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from macos_workflow import config_macos as config
+from macos_workflow.headless import _page_files
+from macos_workflow.utils import PAGE_SEPARATOR
+
+logger = logging.getLogger(__name__)
+
+
+class PageTask:
+    """One leased page: its image bytes, the document's prompt and mode, and the lease token."""
+    def __init__(self, task_id, doc_id, page_index, payload, suffix, prompt, mode, lease_token, attempts):
+        self.task_id = task_id
+        self.doc_id = doc_id
+        self.page_index = page_index
+        self.payload = payload
+        self.suffix = suffix
+        self.prompt = prompt
+        self.mode = mode
+        self.lease_token = lease_token
+        self.attempts = attempts
+
+    def to_dict(self):
+        data = dict(self.__dict__)
+        data["payload"] = base64.b64encode(self.payload).decode("ascii")
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["payload"] = base64.b64decode(data["payload"])
+        return cls(**data)
+
+
+class Broker(abc.ABC):
+    """Interface shared by the broker implementations."""
+    @abc.abstractmethod
+    def create_document(self, prompt, mode):
+        """Registers a document whose pages follow with `add_pages`. Returns the document id."""
+
+    @abc.abstractmethod
+    def add_pages(self, doc_id, first_index, pages):
+        """Queues `pages` (list of (image bytes, file suffix)) as pages first_index, first_index + 1, ..."""
+
+    @abc.abstractmethod
+    def seal_document(self, doc_id, total_pages):
+        """Records that all `total_pages` pages have been added."""
+
+    @abc.abstractmethod
+    def lease(self, worker_id):
+        """Leases the next runnable page task, or returns None."""
+
+    @abc.abstractmethod
+    def renew(self, task_id, lease_token):
+        """Extends a lease. Returns False if the lease was lost."""
+
+    @abc.abstractmethod
+    def complete(self, task_id, lease_token, text):
+        """Stores a page result. Returns False if the lease was lost (the result is dropped)."""
+
+    @abc.abstractmethod
+    def fail(self, task_id, lease_token, error):
+        """Gives a task back for retry, or marks it failed once it is out of attempts."""
+
+    @abc.abstractmethod
+    def document(self, doc_id):
+        """
+        {"total_pages", "done", "failed", "errors", "pages": [text or None, ...]}, where
+        total_pages is None until the document is sealed.
+        """
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    prompt TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    total_pages INTEGER,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    doc_id TEXT NOT NULL,
+    page_index INTEGER NOT NULL,
+    payload BLOB NOT NULL,
+    suffix TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_token TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_runnable ON tasks (status, lease_expires);
+CREATE INDEX IF NOT EXISTS tasks_doc ON tasks (doc_id, page_index);
+"""
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker on a local SQLite file. Safe to share between threads and processes. Documents with
+    no page left to run are deleted `retention_hours` after they were created (checked at most
+    once an hour, when a worker asks for work); None keeps them.
+    """
+    PURGE_INTERVAL_SECONDS = 3600
+
+    def __init__(self, db_path, lease_seconds=300, max_attempts=3, retention_hours=None):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_hours = retention_hours
+        self._last_purge = None
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def create_document(self, prompt, mode):
+        doc_id = uuid.uuid4().hex
+        self._transaction(lambda conn: conn.execute(
+            "INSERT INTO documents (id, prompt, mode, total_pages, created_at) VALUES (?, ?, ?, NULL, ?)",
+            (doc_id, prompt, mode, time.time())))
+        return doc_id
+
+    def add_pages(self, doc_id, first_index, pages):
+        self._transaction(lambda conn: conn.executemany(
+            "INSERT INTO tasks (id, doc_id, page_index, payload, suffix, status) VALUES (?, ?, ?, ?, ?, 'queued')",
+            [(uuid.uuid4().hex, doc_id, first_index + offset, payload, suffix)
+             for offset, (payload, suffix) in enumerate(pages)]))
+
+    def seal_document(self, doc_id, total_pages):
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE documents SET total_pages = ? WHERE id = ?", (total_pages, doc_id)))
+
+    def purge_finished(self, max_age_hours):
+        """
+        Deletes documents created more than `max_age_hours` ago whose tasks are all done or
+        failed, together with their tasks. Returns the number of documents deleted.
+        """
+        def purge(conn):
+            finished = ("SELECT id FROM documents WHERE created_at < ? AND NOT EXISTS ("
+                        "SELECT 1 FROM tasks WHERE tasks.doc_id = documents.id AND tasks.status IN ('queued', 'leased'))")
+            cutoff = time.time() - max_age_hours * 3600
+            conn.execute(f"DELETE FROM tasks WHERE doc_id IN ({finished})", (cutoff,))
+            return conn.execute(f"DELETE FROM documents WHERE id IN ({finished})", (cutoff,)).rowcount
+        return self._transaction(purge)
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if self.retention_hours is None or \
+                (self._last_purge is not None and now - self._last_purge < self.PURGE_INTERVAL_SECONDS):
+            return
+        self._last_purge = now
+        deleted = self.purge_finished(self.retention_hours)
+        if deleted:
+            logger.info(f"Broker: deleted {deleted} finished documents older than {self.retention_hours} h.")
+
+    def lease(self, worker_id):
+        self._maybe_purge()
+
+        def take(conn):
+            now = time.time()
+            # Expired leases on tasks without attempts left are final failures
+            conn.execute("UPDATE tasks SET status = 'failed', error = COALESCE(error, 'lease expired') "
+                         "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, self.max_attempts))
+            row = conn.execute(
+                "SELECT tasks.*, documents.prompt, documents.mode FROM tasks JOIN documents ON documents.id = tasks.doc_id "
+                "WHERE tasks.status = 'queued' OR (tasks.status = 'leased' AND tasks.lease_expires < ?) "
+                "ORDER BY documents.created_at, tasks.page_index LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            token = uuid.uuid4().hex
+            conn.execute("UPDATE tasks SET status = 'leased', attempts = attempts + 1, lease_owner = ?, "
+                         "lease_token = ?, lease_expires = ? WHERE id = ?",
+                         (worker_id, token, now + self.lease_seconds, row["id"]))
+            return PageTask(row["id"], row["doc_id"], row["page_index"], row["payload"], row["suffix"],
+                            row["prompt"], row["mode"], token, row["attempts"] + 1)
+        return self._transaction(take)
+
+    def _update_leased(self, sql, params, task_id, lease_token):
+        def update(conn):
+            cursor = conn.execute(sql + " WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                                  (*params, task_id, lease_token))
+            return cursor.rowcount == 1
+        return self._transaction(update)
+
+    def renew(self, task_id, lease_token):
+        return self._update_leased("UPDATE tasks SET lease_expires = ?", (time.time() + self.lease_seconds,),
+                                   task_id, lease_token)
+
+    def complete(self, task_id, lease_token, text):
+        return self._update_leased("UPDATE tasks SET status = 'done', result = ?, payload = X'', lease_expires = NULL",
+                                   (text,), task_id, lease_token)
+
+    def fail(self, task_id, lease_token, error):
+        return self._update_leased(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, error = ?, "
+            "lease_expires = NULL", (self.max_attempts, error), task_id, lease_token)
+
+    def document(self, doc_id):
+        with self._lock:
+            document = self._conn.execute("SELECT total_pages FROM documents WHERE id = ?", (doc_id,)).fetchone()
+            rows = self._conn.execute("SELECT page_index, status, result, error FROM tasks WHERE doc_id = ? "
+                                      "ORDER BY page_index", (doc_id,)).fetchall()
+        if document is None:
+            return None
+        return {
+            "total_pages": document["total_pages"],
+            "done": sum(row["status"] == "done" for row in rows),
+            "failed": sum(row["status"] == "failed" for row in rows),
+            "errors": {row["page_index"]: row["error"] for row in rows if row["status"] == "failed"},
+            "pages": [row["result"] if row["status"] == "done" else None for row in rows],
+        }
+
+
+class HTTPBroker(Broker):
+    """Client for a broker served with `serve_broker`."""
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _call(self, method, **params):
+        request = urllib.request.Request(
+            f"{self.base_url}/{method}", data=json.dumps(params).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))["result"]
+
+    def create_document(self, prompt, mode):
+        return self._call("create_document", prompt=prompt, mode=mode)
+
+    def add_pages(self, doc_id, first_index, pages):
+        return self._call("add_pages", doc_id=doc_id, first_index=first_index,
+                          pages=[(base64.b64encode(payload).decode("ascii"), suffix) for payload, suffix in pages])
+
+    def seal_document(self, doc_id, total_pages):
+        return self._call("seal_document", doc_id=doc_id, total_pages=total_pages)
+
+    def lease(self, worker_id):
+        task = self._call("lease", worker_id=worker_id)
+        return PageTask.from_dict(task) if task else None
+
+    def renew(self, task_id, lease_token):
+        return self._call("renew", task_id=task_id, lease_token=lease_token)
+
+    def complete(self, task_id, lease_token, text):
+        return self._call("complete", task_id=task_id, lease_token=lease_token, text=text)
+
+    def fail(self, task_id, lease_token, error):
+        return self._call("fail", task_id=task_id, lease_token=lease_token, error=error)
+
+    def document(self, doc_id):
+        document = self._call("document", doc_id=doc_id)
+        if document:
+            document["errors"] = {int(k): v for k, v in document["errors"].items()}
+        return document
+
+
+def serve_broker(broker, host="127.0.0.1", port=8100):
+    """
+    Exposes `broker` over HTTP for `HTTPBroker` clients (blocking). There is no authentication:
+    bind to another interface only on a trusted network.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = self.path.strip("/")
+            params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            try:
+                if method == "add_pages":
+                    params["pages"] = [(base64.b64decode(payload), suffix) for payload, suffix in params["pages"]]
+                    result = broker.add_pages(**params)
+                elif method == "lease":
+                    task = broker.lease(**params)
+                    result = task.to_dict() if task else None
+                elif method in ("create_document", "seal_document", "renew", "complete", "fail", "document"):
+                    result = getattr(broker, method)(**params)
+                else:
+                    self.send_error(404)
+                    return
+            except Exception as e:
+                logger.error(f"Broker call {method} failed: {e}", exc_info=True)
+                self.send_error(500, str(e))
+                return
+            body = json.dumps({"result": result}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    print(f"Broker listening on http://{host}:{port}")
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+
+def open_broker(spec):
+    """`http(s)://...` -> HTTPBroker, anything else is a SQLite file path."""
+    if spec.startswith(("http://", "https://")):
+        return HTTPBroker(spec)
+    return SQLiteBroker(spec, lease_seconds=config.DISTRIBUTED_LEASE_SECONDS, max_attempts=config.DISTRIBUTED_MAX_ATTEMPTS,
+                        retention_hours=config.DISTRIBUTED_RETENTION_HOURS)
+
+
+# --- Coordinator ---
+
+def submit_document(broker, input_path, prompt, mode, batch_pages=None):
+    """
+    Renders the document's pages and queues one task per page, sending `batch_pages` pages
+    (DISTRIBUTED_SUBMIT_BATCH_PAGES) per broker call as they are rendered. Returns the document id.
+    """
+    batch_pages = batch_pages or config.DISTRIBUTED_SUBMIT_BATCH_PAGES
+    doc_id = broker.create_document(prompt, mode)
+    tmp_paths = []
+    batch = []
+    submitted = 0
+    try:
+        for page_path in _page_files(input_path, config.RESOLUTION_PRESETS[mode], tmp_paths):
+            with open(page_path, "rb") as f:
+                batch.append((f.read(), os.path.splitext(page_path)[1] or ".png"))
+            if page_path in tmp_paths:
+                os.remove(page_path)
+            if len(batch) == batch_pages:
+                broker.add_pages(doc_id, submitted, batch)
+                submitted += len(batch)
+                batch = []
+        if batch:
+            broker.add_pages(doc_id, submitted, batch)
+            submitted += len(batch)
+    finally:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    broker.seal_document(doc_id, submitted)
+    return doc_id
+
+
+def wait_for_document(broker, doc_id, poll_interval=2.0):
+    """Blocks until every page is done and returns the document markdown."""
+    while True:
+        document = broker.document(doc_id)
+        if document is None:
+            raise KeyError(f"Unknown document {doc_id}")
+        if document["failed"]:
+            raise RuntimeError(f"Pages failed permanently: {document['errors']}")
+        if document["total_pages"] is not None and document["done"] == document["total_pages"]:
+            return PAGE_SEPARATOR.join(document["pages"])
+        time.sleep(poll_interval)
+
+
+# --- Worker ---
+
+def _retry_delays():
+    delay = config.DISTRIBUTED_RETRY_DELAY
+    while True:
+        yield delay
+        delay = min(delay * 2, config.DISTRIBUTED_RETRY_MAX_DELAY)
+
+
+def call_with_retries(call, *args, stop_event=None, retries=None):
+    """
+    Runs a broker call, retrying failures (e.g. the broker being unreachable) with exponential
+    backoff. Raises the last error after `retries` retries (DISTRIBUTED_BROKER_RETRIES).
+    """
+    retries = config.DISTRIBUTED_BROKER_RETRIES if retries is None else retries
+    delays = _retry_delays()
+    for attempt in range(retries + 1):
+        try:
+            return call(*args)
+        except Exception as e:
+            if attempt == retries or (stop_event is not None and stop_event.is_set()):
+                raise
+            delay = next(delays)
+            logger.warning(f"Broker call {call.__name__} failed ({e}); retrying in {delay:.0f}s.")
+            if stop_event is not None:
+                stop_event.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+def run_worker(engine, broker, worker_id=None, idle_sleep=1.0, stop_event=None):
+    """
+    Leases and processes page tasks until `stop_event` is set. Broker outages do not stop the
+    worker: leasing keeps retrying, and a result that cannot be delivered is dropped with its
+    lease, so the page is handed out again once the lease expires.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    stop_event = stop_event or threading.Event()
+    renew_interval = max(1.0, config.DISTRIBUTED_LEASE_SECONDS / 3)
+    delays = _retry_delays()
+    print(f"Worker {worker_id} started.")
+
+    while not stop_event.is_set():
+        try:
+            task = broker.lease(worker_id)
+        except Exception as e:
+            delay = next(delays)
+            logger.warning(f"Could not lease a task ({e}); retrying in {delay:.0f}s.")
+            stop_event.wait(delay)
+            continue
+        delays = _retry_delays()
+        if task is None:
+            stop_event.wait(idle_sleep)
+            continue
+
+        # Keep the lease alive while the page is running
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(renew_interval):
+                try:
+                    if not broker.renew(task.task_id, task.lease_token):
+                        logger.warning(f"Lost the lease on task {task.task_id}.")
+                        return
+                except Exception as e:
+                    # Retried at the next interval; the lease outlives a few missed renewals
+                    logger.warning(f"Could not renew the lease on task {task.task_id}: {e}")
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        with tempfile.NamedTemporaryFile(suffix=task.suffix, delete=False) as tmp_file:
+            tmp_file.write(task.payload)
+            image_path = tmp_file.name
+        error = None
+        try:
+            text = engine.infer(image_path, task.prompt, **config.RESOLUTION_PRESETS[task.mode])
+        except Exception as e:
+            logger.error(f"Task {task.task_id} failed (attempt {task.attempts}): {e}", exc_info=True)
+            error = str(e)
+        finally:
+            done.set()
+            heartbeat_thread.join()
+            os.remove(image_path)
+
+        try:
+            if error is None:
+                if call_with_retries(broker.complete, task.task_id, task.lease_token, text, stop_event=stop_event):
+                    print(f"Worker {worker_id}: page {task.page_index + 1} of document {task.doc_id} done.")
+                else:
+                    logger.warning(f"Result of task {task.task_id} dropped: its lease was lost.")
+            else:
+                call_with_retries(broker.fail, task.task_id, task.lease_token, error, stop_event=stop_event)
+        except Exception as e:
+            logger.error(f"Could not report task {task.task_id} to the broker; it is retried after its lease "
+                         f"expires: {e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Distributed page work queue for DeepSeek-OCR.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    default_db = os.path.join(project_root, "output_macos", "broker.sqlite3")
+
+    broker_parser = subparsers.add_parser("broker", help="Serve a SQLite broker over HTTP")
+    broker_parser.add_argument("--db", default=default_db)
+    broker_parser.add_argument("--host", default="127.0.0.1",
+                               help="Interface to bind; the broker has no authentication, so use 0.0.0.0 only on a trusted network")
+    broker_parser.add_argument("--port", type=int, default=8100)
+
+    worker_parser = subparsers.add_parser("worker", help="Process page tasks")
+    worker_parser.add_argument("--broker", default=default_db)
+    worker_parser.add_argument("--worker-index", type=int, help="This worker's index on the host, for NUMA pinning")
+    worker_parser.add_argument("--workers", type=int, help="Worker processes on the host, for NUMA pinning")
+
+    submit_parser = subparsers.add_parser("submit", help="Queue a document and wait for its markdown")
+    submit_parser.add_argument("input")
+    submit_parser.add_argument("--broker", default=default_db)
+    submit_parser.add_argument("--task", choices=sorted(config.PROMPT_PRESETS), default="markdown")
+    submit_parser.add_argument("--mode", choices=sorted(config.RESOLUTION_PRESETS), default="gundam")
+    submit_parser.add_argument("--output", help="Markdown output path (default: print)")
+    args = parser.parse_args(argv)
+
+    if args.command == "broker":
+        os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+        serve_broker(SQLiteBroker(args.db, config.DISTRIBUTED_LEASE_SECONDS, config.DISTRIBUTED_MAX_ATTEMPTS,
+                                  config.DISTRIBUTED_RETENTION_HOURS),
+                     args.host, args.port)
+    elif args.command == "worker":
+        if args.worker_index is not None:
+            os.environ["OCR_WORKER_INDEX"] = str(args.worker_index)
+        if args.workers is not None:
+            os.environ["OCR_WORKER_COUNT"] = str(args.workers)
+        from macos_workflow.ocr_engine_macos import OCREngine
+        run_worker(OCREngine(project_root=project_root), open_broker(args.broker))
+    else:
+        prompt = config.PROMPT_PRESETS[args.task]
+        if "<image>" not in prompt:
+            prompt = f"<image>\n{prompt}"
+        broker = open_broker(args.broker)
+        doc_id = submit_document(broker, args.input, prompt, args.mode)
+        print(f"Queued {args.input} as document {doc_id}.")
+        markdown = wait_for_document(broker, doc_id)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(markdown)
+            print(f"Wrote {args.output}")
+        else:
+            print(markdown)
+
+
+if __name__ == "__main__":
+    main()
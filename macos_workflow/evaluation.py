@@ -0,0 +1,140 @@
+"""
+Accuracy harness for the optional fast paths of the model.
+
+Runs the same pages with an option off and then on, and reports character and word error
+rates, prompt length and latency for both. Ground truth is read from `<image stem>.md` or
+`<image stem>.txt` in --references; without it the output with the option off serves as
+the reference, so the report shows how much the option changes the text.
+
+Usage:
+    python -m macos_workflow.evaluation receipts/*.png --mode large --option prune_padding --references gt/
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+# Same project-root handling as app.py, so the DeepSeek_OCR package is importable.
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(_current_dir)
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from macos_workflow import config_macos as config
+
+# Model options that can be compared, and the module that carries each flag
+OPTIONS = {
+    "prune_padding": lambda engine: engine.model,
+    "reduced_decode": lambda engine: engine.model,
+    "blank_tile_memo": lambda engine: engine.model.model,
+}
+
+
+def edit_distance(hypothesis, reference):
+    """Levenshtein distance between two sequences."""
+    if len(hypothesis) < len(reference):
+        hypothesis, reference = reference, hypothesis
+    previous = list(range(len(reference) + 1))
+    for i, h in enumerate(hypothesis, 1):
+        current = [i]
+        for j, r in enumerate(reference, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (h != r)))
+        previous = current
+    return previous[-1]
+
+
+def _normalize(text):
+    return " ".join(text.split())
+
+
+def error_rates(hypothesis, reference):
+    """(character error rate, word error rate) after whitespace normalization."""
+    hypothesis, reference = _normalize(hypothesis), _normalize(reference)
+    cer = edit_distance(hypothesis, reference) / max(1, len(reference))
+    wer = edit_distance(hypothesis.split(), reference.split()) / max(1, len(reference.split()))
+    return cer, wer
+
+
+def load_reference(references_dir, image_path):
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    for extension in (".md", ".txt"):
+        path = os.path.join(references_dir, stem + extension)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+    return None
+
+
+def prompt_tokens(engine, image_path, prompt, resolution_params):
+    """Length of the prefill sequence for this page with the model's current options."""
+    inputs = engine.model.prepare_ocr_inputs(engine.tokenizer, prompt=prompt, image_file=image_path, **resolution_params)
+    return int(inputs.input_ids.numel())
+
+
+def compare(engine, image_paths, prompt, resolution_params, option, references_dir=None):
+    """
+    Runs every page with `option` off and on. Returns one dict per page with the prompt length,
+    latency and error rates of each run.
+    """
+    target = OPTIONS[option](engine)
+    previous = getattr(target, option, None)
+    pages = []
+    try:
+        for image_path in image_paths:
+            runs = {}
+            for enabled in (False, True):
+                setattr(target, option, enabled)
+                tokens = prompt_tokens(engine, image_path, prompt, resolution_params)
+                start_time = time.time()
+                text = engine.infer(image_path, prompt, **resolution_params)
+                runs["on" if enabled else "off"] = {"prompt_tokens": tokens, "seconds": time.time() - start_time, "text": text}
+
+            reference = load_reference(references_dir, image_path) if references_dir else None
+            for run in runs.values():
+                run["cer"], run["wer"] = error_rates(run["text"], reference if reference is not None else runs["off"]["text"])
+            pages.append({"image": image_path, "has_reference": reference is not None, **runs})
+            print(f"{os.path.basename(image_path)}: tokens {runs['off']['prompt_tokens']} -> {runs['on']['prompt_tokens']}, "
+                  f"{runs['off']['seconds']:.2f}s -> {runs['on']['seconds']:.2f}s, "
+                  f"CER {runs['off']['cer']:.4f} -> {runs['on']['cer']:.4f}")
+    finally:
+        setattr(target, option, previous)
+    return pages
+
+
+def summarize(pages):
+    def mean(state, key):
+        return sum(page[state][key] for page in pages) / len(pages) if pages else 0.0
+    return {state: {key: mean(state, key) for key in ("prompt_tokens", "seconds", "cer", "wer")} for state in ("off", "on")}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare accuracy and speed with a model option off and on.")
+    parser.add_argument("images", nargs="+", help="Page images")
+    parser.add_argument("--option", choices=sorted(OPTIONS), default="prune_padding")
+    parser.add_argument("--task", choices=sorted(config.PROMPT_PRESETS), default="free_ocr")
+    parser.add_argument("--mode", choices=sorted(config.RESOLUTION_PRESETS), default="large")
+    parser.add_argument("--references", help="Directory with <image stem>.md/.txt ground truth")
+    parser.add_argument("--output", help="Write the per-page report as JSON")
+    args = parser.parse_args(argv)
+
+    prompt = config.PROMPT_PRESETS[args.task]
+    if "<image>" not in prompt:
+        prompt = f"<image>\n{prompt}"
+
+    from macos_workflow.ocr_engine_macos import OCREngine
+    engine = OCREngine(project_root=project_root)
+    pages = compare(engine, args.images, prompt, config.RESOLUTION_PRESETS[args.mode], args.option, args.references)
+    summary = summarize(pages)
+    for state in ("off", "on"):
+        s = summary[state]
+        print(f"{args.option} {state:>3}: {s['prompt_tokens']:.0f} prompt tokens, {s['seconds']:.2f}s, "
+              f"CER {s['cer']:.4f}, WER {s['wer']:.4f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"option": args.option, "mode": args.mode, "summary": summary, "pages": pages}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+"""
+Memory-mapped expert weights for low-RAM hosts.
+
+The routed-expert weights of every MoE layer are written once to a cache file per layer
+(`<cache_dir>/<layer>.bin`, one page-aligned region per expert) and the expert modules are
+re-pointed at a memory map of that file. An expert's pages are only read when the router
+selects it, and an LRU cap shared by all layers bounds how many experts stay resident: the
+pages of the least recently used expert are dropped with `madvise(MADV_DONTNEED)` and
+re-read from the file the next time it is selected.
+
+The cap is only enforced on Linux, where MADV_DONTNEED drops the pages of the copy-on-write
+map at once. On macOS it is a hint the kernel may ignore, so evicted experts can stay resident
+until there is memory pressure: startup still avoids loading every expert, but resident memory
+can grow past the cap. A warning is logged there when paging is enabled.
+
+Experts are served to the grouped dispatch of moe.py through `MappedExpertWeights`.
+
+To keep the experts out of RAM at startup too, the engine builds the model with
+`load_without_experts`: parameters are allocated without being written (so their pages are
+never committed), every non-expert tensor is copied in from the safetensors checkpoint one at
+a time, and `enable_expert_paging(..., checkpoint=...)` writes the cache files straight from
+the checkpoint, one expert at a time. Peak memory at load is then about the non-expert weights
+plus one expert, instead of the whole model.
+"""
+import gc
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .moe import _moe_layers, enable_grouped_dispatch
+
+logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _major_faults():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_majflt if resource else 0
+
+
+class ExpertResidency:
+    """LRU bookkeeping of resident experts across all layers, with page-in statistics."""
+    def __init__(self, max_resident):
+        self.max_resident = max(1, max_resident)
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.page_ins = 0
+        self.evictions = 0
+        self.bytes_paged_in = 0
+        self._started_at = time.time()
+        self._major_faults_at_start = _major_faults()
+
+    def touch(self, key, nbytes, prefetch, release):
+        """Marks expert `key` as used, paging it in (and evicting the LRU expert) on a miss."""
+        with self._lock:
+            if key in self._resident:
+                self._resident.move_to_end(key)
+                self.hits += 1
+                return
+            self.page_ins += 1
+            self.bytes_paged_in += nbytes
+            self._resident[key] = release
+            evicted = []
+            while len(self._resident) > self.max_resident:
+                evicted.append(self._resident.popitem(last=False)[1])
+                self.evictions += 1
+        for evicted_release in evicted:
+            evicted_release()
+        prefetch()
+
+    def stats(self):
+        lookups = self.hits + self.page_ins
+        elapsed = max(time.time() - self._started_at, 1e-9)
+        return {
+            "resident": len(self._resident),
+            "max_resident": self.max_resident,
+            "lookups": lookups,
+            "hit_rate": (self.hits / lookups) if lookups else None,
+            "page_ins": self.page_ins,
+            "page_ins_per_second": self.page_ins / elapsed,
+            "mb_paged_in": self.bytes_paged_in / 2**20,
+            "evictions": self.evictions,
+            "major_faults": _major_faults() - self._major_faults_at_start,
+        }
+
+
+def _dtype_name(dtype):
+    return str(dtype).split(".")[-1]
+
+
+class ModuleExperts:
+    """Expert weights of one layer as loaded into its modules."""
+    def __init__(self, experts):
+        self.experts = experts
+        self.dtype = experts[0].gate_proj.weight.dtype
+
+    def __len__(self):
+        return len(self.experts)
+
+    def shapes(self, index):
+        expert = self.experts[index]
+        return expert.gate_proj.weight.shape, expert.up_proj.weight.shape, expert.down_proj.weight.shape
+
+    def samples(self, index):
+        """Leading gate and trailing down weights, for the cache fingerprint."""
+        expert = self.experts[index]
+        return expert.gate_proj.weight.detach().reshape(-1)[:64], expert.down_proj.weight.detach().reshape(-1)[-64:]
+
+    def weights(self, index):
+        expert = self.experts[index]
+        return expert.gate_proj.weight.detach(), expert.up_proj.weight.detach(), expert.down_proj.weight.detach()
+
+
+class CheckpointReader:
+    """Reads single tensors (or slices of them) from the safetensors files of a checkpoint."""
+    def __init__(self, model_path):
+        from safetensors import safe_open
+        self._safe_open = safe_open
+        index_path = os.path.join(model_path, "model.safetensors.index.json")
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.files = {key: os.path.join(model_path, name) for key, name in json.load(f)["weight_map"].items()}
+        else:
+            self.files = {}
+            for name in sorted(os.listdir(model_path)):
+                if name.endswith(".safetensors"):
+                    with safe_open(os.path.join(model_path, name), framework="pt") as f:
+                        self.files.update({key: os.path.join(model_path, name) for key in f.keys()})
+        if not self.files:
+            raise FileNotFoundError(f"No safetensors checkpoint in {model_path}")
+        self._handles = {}
+
+    def _handle(self, key):
+        path = self.files[key]
+        if path not in self._handles:
+            self._handles[path] = self._safe_open(path, framework="pt")
+        return self._handles[path]
+
+    def keys(self):
+        return self.files.keys()
+
+    def get(self, key):
+        return self._handle(key).get_tensor(key)
+
+    def slice(self, key):
+        return self._handle(key).get_slice(key)
+
+    def close(self):
+        self._handles.clear()
+
+
+class CheckpointExperts(ModuleExperts):
+    """
+    Expert weights of one layer read from the checkpoint, one expert at a time and cast to the
+    dtype of the (unwritten) expert modules.
+    """
+    def __init__(self, experts, reader, prefix):
+        super().__init__(experts)
+        self.reader = reader
+        self.prefix = prefix
+
+    def _key(self, index, projection):
+        return f"{self.prefix}.{index}.{projection}.weight"
+
+    def shapes(self, index):
+        return tuple(torch.Size(self.reader.slice(self._key(index, name)).get_shape())
+                     for name in ("gate_proj", "up_proj", "down_proj"))
+
+    def samples(self, index):
+        down = self.reader.slice(self._key(index, "down_proj"))
+        rows = down.get_shape()[0]
+        return (self.reader.slice(self._key(index, "gate_proj"))[0:1].reshape(-1)[:64].to(self.dtype),
+                down[rows - 1:rows].reshape(-1)[-64:].to(self.dtype))
+
+    def weights(self, index):
+        return tuple(self.reader.get(self._key(index, name)).to(self.dtype)
+                     for name in ("gate_proj", "up_proj", "down_proj"))
+
+
+def _layout(source):
+    """Byte layout of a layer's cache file; each expert region starts on a page boundary."""
+    element_size = torch.empty((), dtype=source.dtype).element_size()
+    fingerprint = hashlib.sha1()
+    regions = []
+    offset = 0
+    for index in range(len(source)):
+        gate_shape, up_shape, down_shape = source.shapes(index)
+        gate_up_shape = [gate_shape[0] + up_shape[0], gate_shape[1]]
+        gate_up_bytes = math.prod(gate_up_shape) * element_size
+        down_bytes = math.prod(down_shape) * element_size
+        regions.append({
+            "offset": offset,
+            "gate_rows": gate_shape[0],
+            "gate_up_shape": gate_up_shape,
+            "down_shape": list(down_shape),
+            "gate_up_bytes": gate_up_bytes,
+            "length": gate_up_bytes + down_bytes,
+        })
+        # Samples of the weights, so a cache built from other weights is not reused
+        for sample in source.samples(index):
+            fingerprint.update(sample.float().numpy().tobytes())
+        offset += math.ceil((gate_up_bytes + down_bytes) / mmap.PAGESIZE) * mmap.PAGESIZE
+    return {"dtype": _dtype_name(source.dtype), "size": offset, "fingerprint": fingerprint.hexdigest(), "experts": regions}
+
+
+def _write_cache(path, source, layout):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.truncate(layout["size"])
+        for index, region in enumerate(layout["experts"]):
+            f.seek(region["offset"])
+            for weight in source.weights(index):
+                f.write(weight.contiguous().view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, path)
+    with open(path + ".json", "w") as f:
+        json.dump(layout, f)
+
+
+def _cache_matches(path, layout):
+    if not (os.path.exists(path) and os.path.exists(path + ".json")):
+        return False
+    with open(path + ".json") as f:
+        return json.load(f) == layout
+
+
+class MappedExpertWeights:
+    """
+    Expert weight provider for moe.py backed by the memory-mapped cache file of one layer.
+    The cache is (re)written from `source` (default: the loaded expert modules) when missing or stale.
+    """
+    def __init__(self, layer_key, experts, cache_dir, residency, source=None):
+        self.layer_key = layer_key
+        self.residency = residency
+        self.act_fn = experts[0].act_fn
+
+        source = source or ModuleExperts(experts)
+        path = os.path.join(cache_dir, f"{layer_key}.bin")
+        layout = _layout(source)
+        if not _cache_matches(path, layout):
+            print(f"Writing expert cache {path}...")
+            _write_cache(path, source, layout)
+
+        with open(path, "rb") as f:
+            # Copy-on-write, so tensors over the map are writable without touching the file
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+        dtype = getattr(torch, layout["dtype"])
+
+        self._regions = []
+        self.gate_up = []
+        self.down = []
+        for expert, region in zip(experts, layout["experts"]):
+            start = region["offset"]
+            split = start + region["gate_up_bytes"]
+            gate_up = torch.from_numpy(buffer[start:split]).view(dtype).view(region["gate_up_shape"])
+            down = torch.from_numpy(buffer[split:start + region["length"]]).view(dtype).view(region["down_shape"])
+
+            # The modules keep working (e.g. the stock forward), but now over the mapped file
+            rows = region["gate_rows"]
+            expert.gate_proj.weight.data = gate_up[:rows]
+            expert.up_proj.weight.data = gate_up[rows:]
+            expert.down_proj.weight.data = down
+
+            self.gate_up.append(gate_up)
+            self.down.append(down)
+            self._regions.append((start, region["length"]))
+
+        for expert_index in range(len(self._regions)):
+            self._release(expert_index)
+
+    def __len__(self):
+        return len(self.gate_up)
+
+    def _advise(self, expert_index, advice_name):
+        advice = getattr(mmap, advice_name, None)
+        if advice is not None and hasattr(self._mmap, "madvise"):
+            start, length = self._regions[expert_index]
+            self._mmap.madvise(advice, start, length)
+
+    def _prefetch(self, expert_index):
+        self._advise(expert_index, "MADV_WILLNEED")
+
+    def _release(self, expert_index):
+        self._advise(expert_index, "MADV_DONTNEED")
+
+    def get(self, expert_index):
+        """Returns (gate_up, down) weights of one expert, paging it in if needed."""
+        self.residency.touch(
+            (self.layer_key, expert_index),
+            self._regions[expert_index][1],
+            lambda: self._prefetch(expert_index),
+            lambda: self._release(expert_index),
+        )
+        return self.gate_up[expert_index], self.down[expert_index]
+
+
+def load_without_experts(model_class, model_path, dtype):
+    """
+    Builds `model_class` from the safetensors checkpoint in `model_path` without reading the
+    routed experts. Their parameters stay allocated but unwritten, so they take no resident
+    memory until `enable_expert_paging(model, ..., checkpoint=model_path)` maps them.
+    """
+    from transformers import AutoConfig
+    from transformers.modeling_utils import no_init_weights
+
+    model_config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    with no_init_weights():
+        model = model_class._from_config(model_config, torch_dtype=dtype)
+
+    module_names = {id(module): name for name, module in model.named_modules()}
+    expert_prefixes = tuple(f"{module_names[id(layer)]}.experts." for layer in _moe_layers(model))
+    state = model.state_dict()
+    reader = CheckpointReader(model_path)
+    loaded = set()
+    with torch.no_grad():
+        for key in reader.keys():
+            if key in state and not key.startswith(expert_prefixes):
+                state[key].copy_(reader.get(key))
+                loaded.add(key)
+    reader.close()
+    model.tie_weights()
+
+    missing = [key for key in state if key not in loaded and not key.startswith(expert_prefixes)]
+    if missing:
+        logger.warning(f"{len(missing)} tensors not in the checkpoint were left uninitialized: {missing[:5]}")
+    return model.eval()
+
+
+def enable_expert_paging(model, cache_dir, max_resident=128, checkpoint=None):
+    """
+    Moves the routed experts of every MoE layer into memory-mapped cache files under
+    `cache_dir` and switches the layers to grouped dispatch. Caches are built from the loaded
+    experts, or with `checkpoint` (the model directory, for a model from `load_without_experts`)
+    from the safetensors files. Returns the shared `ExpertResidency`, whose `stats()` report
+    page-in rates.
+    """
+    if sys.platform == "darwin":
+        logger.warning("Expert paging: MADV_DONTNEED is only a hint on macOS, so the resident-expert cap "
+                       f"({max_resident}) is not enforced; evicted experts are dropped under memory pressure.")
+    os.makedirs(cache_dir, exist_ok=True)
+    residency = ExpertResidency(max_resident)
+    module_names = {id(module): name for name, module in model.named_modules()}
+    reader = CheckpointReader(checkpoint) if checkpoint else None
+
+    def weights_factory(layer):
+        name = module_names[id(layer)]
+        source = CheckpointExperts(layer.experts, reader, f"{name}.experts") if reader else None
+        return MappedExpertWeights(name.replace(".", "_"), layer.experts, cache_dir, residency, source)
+
+    try:
+        layers = enable_grouped_dispatch(model, weights_factory=weights_factory)
+    finally:
+        if reader is not None:
+            reader.close()
+    # Release the in-memory copies the experts were loaded into
+    gc.collect()
+    logger.info(f"Expert paging enabled on {layers} layers, at most {residency.max_resident} experts resident.")
+    return residency
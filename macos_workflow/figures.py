@@ -0,0 +1,172 @@
+"""
+Figure crop export for OCR jobs.
+
+Regions the model labels `image` are cropped from the page and written by a thread pool
+into a per-job directory, named by a hash of their pixels. A figure that repeats across
+pages (a logo in every header, say) is written only once, and concurrent jobs never share
+a folder. `format_markdown` then links the crops from the markdown, the way the
+`save_results` branch of the model's `infer` does.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config_macos as config
+from .utils import _GROUNDING_PATTERN, _parse_boxes, scale_boxes
+
+logger = logging.getLogger(__name__)
+
+
+# Present in a job directory while a FigureExporter writes to it; refreshed on every export
+IN_USE_MARKER = ".in_use"
+
+_purge_lock = threading.Lock()
+_last_purge = None
+
+
+def purge_job_dirs(root, max_age_hours):
+    """
+    Deletes job directories under `root` last modified more than `max_age_hours` ago. Directories
+    whose in-use marker was refreshed within that time are kept, however old the folder is.
+    """
+    cutoff = time.time() - max_age_hours * 3600
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if not name.startswith("job_") or not os.path.isdir(path) or os.path.getmtime(path) >= cutoff:
+                continue
+            marker = os.path.join(path, IN_USE_MARKER)
+            if os.path.exists(marker) and os.path.getmtime(marker) >= cutoff:
+                continue
+            shutil.rmtree(path)
+        except OSError as e:
+            logger.warning(f"Could not remove old job directory {path}: {e}")
+
+
+def _maybe_purge(root):
+    """Starts a background purge of `root` on first use and then every FIGURE_JOB_PURGE_INTERVAL_MINUTES."""
+    global _last_purge
+    if config.FIGURE_JOB_RETENTION_HOURS is None:
+        return
+    with _purge_lock:
+        now = time.monotonic()
+        if _last_purge is not None and now - _last_purge < config.FIGURE_JOB_PURGE_INTERVAL_MINUTES * 60:
+            return
+        _last_purge = now
+    threading.Thread(target=purge_job_dirs, args=(root, config.FIGURE_JOB_RETENTION_HOURS),
+                     name="figure-purge", daemon=True).start()
+
+
+def new_job_dir():
+    """
+    Creates a fresh output directory for one job under the system temp directory, marked in use
+    until its FigureExporter closes. Directories older than FIGURE_JOB_RETENTION_HOURS (their
+    results have long been downloaded) are purged in the background now and then.
+    """
+    root = os.path.join(tempfile.gettempdir(), "deepseek_ocr_jobs")
+    os.makedirs(root, exist_ok=True)
+    _maybe_purge(root)
+    job_dir = tempfile.mkdtemp(prefix="job_", dir=root)
+    open(os.path.join(job_dir, IN_USE_MARKER), "w").close()
+    return job_dir
+
+
+class FigureExporter:
+    """
+    Writes the figure crops of one job to `<job_dir>/images/<hash>.jpg`.
+    `export` returns the relative paths right away; the JPEG encoding happens in the pool.
+    """
+    def __init__(self, job_dir=None, max_workers=None):
+        self.job_dir = job_dir or new_job_dir()
+        self.images_dir = os.path.join(self.job_dir, "images")
+        os.makedirs(self.images_dir, exist_ok=True)
+        self._marker = os.path.join(self.job_dir, IN_USE_MARKER)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or config.FIGURE_EXPORT_WORKERS,
+                                            thread_name_prefix="figure-export")
+        self._written = {}
+        self._lock = threading.Lock()
+
+    def _save(self, crop, path):
+        crop.convert('RGB').save(path, format='JPEG', quality=config.FIGURE_JPEG_QUALITY)
+
+    def export(self, image, boxes, labels):
+        """
+        Schedules the `image`-labelled boxes of a parsed page (see `utils.parse_grounding`)
+        and returns their paths relative to the job directory, in box order. Boxes that cannot
+        be cropped (empty after scaling to the page) are logged and get None.
+        """
+        self._touch_marker()
+        if 'image' not in labels or not len(boxes):
+            return []
+        figure_boxes = scale_boxes(boxes[boxes[:, 0] == labels.index('image')], *image.size)
+
+        paths = []
+        for box in figure_boxes.tolist():
+            x1, y1, x2, y2 = box
+            if x2 <= x1 or y2 <= y1:
+                logger.warning(f"Skipping empty figure box {box} on a {image.size[0]}x{image.size[1]} page")
+                paths.append(None)
+                continue
+            crop = image.crop(box)
+            digest = hashlib.sha1(f"{crop.mode}{crop.size}".encode() + crop.tobytes()).hexdigest()[:20]
+            relative_path = f"images/{digest}.jpg"
+            with self._lock:
+                if digest not in self._written:
+                    self._written[digest] = self._executor.submit(
+                        self._save, crop, os.path.join(self.job_dir, relative_path))
+            paths.append(relative_path)
+        return paths
+
+    def _touch_marker(self):
+        # Only directories from new_job_dir carry a marker; a long job keeps its own fresh
+        if os.path.exists(self._marker):
+            os.utime(self._marker)
+
+    def close(self):
+        """Waits for all pending writes; failed writes are logged, not raised."""
+        self._executor.shutdown(wait=True)
+        for digest, future in self._written.items():
+            error = future.exception()
+            if error is not None:
+                logger.error(f"Could not save figure {digest}: {error}")
+        try:
+            os.remove(self._marker)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def format_markdown(text, figure_paths=()):
+    """
+    Turns model output into markdown: `image` blocks become links to the exported crops (in
+    the order `FigureExporter.export` returned them) and other grounding tags are removed.
+    """
+    remaining = iter(figure_paths)
+
+    def replace(match):
+        if match.group(1) != 'image':
+            return ''
+        boxes = len(_parse_boxes(match.group(2)))
+        return ''.join(f'![]({path})\n' for path in (next(remaining, None) for _ in range(boxes)) if path)
+
+    markdown = _GROUNDING_PATTERN.sub(replace, text)
+    return markdown.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+
+
+def write_markdown(job_dir, markdown, name="result.md"):
+    """Writes the markdown next to the job's `images` folder, so relative links resolve."""
+    md_path = os.path.join(job_dir, name)
+    with open(md_path, 'w', encoding='utf-8') as f:
+        f.write(markdown)
+    return md_path
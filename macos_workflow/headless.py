@@ -0,0 +1,115 @@
+"""
+Headless OCR runner for images and PDFs, without the Gradio UI.
+
+Usage:
+    python -m macos_workflow.headless scan.pdf photo.jpg --task markdown --mode gundam --output out/
+
+With --batch every page is submitted to the continuous batching scheduler, so pages of all
+inputs share the running decode batch.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Same project-root handling as app.py, so the DeepSeek_OCR package is importable.
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(_current_dir)
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from macos_workflow import config_macos as config
+from macos_workflow.utils import iter_pdf_images, iter_tiff_pages, count_tiff_pages, PAGE_SEPARATOR, TIFF_EXTENSIONS
+
+
+def _page_files(input_path, resolution_params, tmp_paths):
+    """
+    Yields one image path per page; PDF and multi-page TIFF pages are rendered one at a time
+    into temporary files.
+    """
+    if input_path.lower().endswith(".pdf"):
+        pages = iter_pdf_images(input_path, resolution=resolution_params)
+    elif input_path.lower().endswith(TIFF_EXTENSIONS) and count_tiff_pages(input_path) > 1:
+        pages = iter_tiff_pages(input_path)
+    else:
+        # Single images are read by the model itself (see REDUCED_RESOLUTION_DECODE)
+        yield input_path
+        return
+    for page_image in pages:
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_file:
+            page_image.save(tmp_file.name)
+            tmp_paths.append(tmp_file.name)
+        yield tmp_file.name
+
+
+def run(engine, input_paths, prompt, mode, output_dir):
+    """OCRs every input and writes `<name>.md` into `output_dir`. Returns the written paths."""
+    os.makedirs(output_dir, exist_ok=True)
+    resolution_params = config.RESOLUTION_PRESETS[mode]
+    written = []
+
+    for input_path in input_paths:
+        start_time = time.time()
+        tmp_paths = []
+        try:
+            results = [text for _, _, text in engine.infer_pages(_page_files(input_path, resolution_params, tmp_paths), prompt, **resolution_params)]
+        finally:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        md_path = os.path.join(output_dir, os.path.splitext(os.path.basename(input_path))[0] + ".md")
+        with open(md_path, "w", encoding="utf-8") as f:
+            f.write(PAGE_SEPARATOR.join(results))
+        written.append(md_path)
+        print(f"{input_path}: {len(results)} page(s) in {time.time() - start_time:.2f} seconds -> {md_path}")
+
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run DeepSeek-OCR on images and PDFs without the UI.")
+    parser.add_argument("inputs", nargs="+", help="Image or PDF files")
+    parser.add_argument("--task", choices=sorted(config.PROMPT_PRESETS), default="markdown")
+    parser.add_argument("--prompt", help="Custom prompt; overrides --task")
+    parser.add_argument("--mode", choices=sorted(config.RESOLUTION_PRESETS), default="gundam")
+    parser.add_argument("--output", default=os.path.join(project_root, "output_macos", "headless"))
+    parser.add_argument("--batch", action="store_true", help="Use the continuous batching scheduler")
+    args = parser.parse_args(argv)
+
+    prompt = args.prompt or config.PROMPT_PRESETS[args.task]
+    if "<image>" not in prompt:
+        prompt = f"<image>\n{prompt}"
+    if args.batch:
+        config.CONTINUOUS_BATCHING_ENABLED = True
+
+    from macos_workflow.ocr_engine_macos import OCREngine
+    engine = OCREngine(project_root=project_root)
+    run(engine, args.inputs, prompt, args.mode, args.output)
+
+    if engine.batch_scheduler is not None and engine.batch_scheduler.stats()["completed"]:
+        stats = engine.batch_scheduler.stats()
+        print(f"Batch occupancy: {stats['mean_batch_occupancy']:.0%} over {stats['decode_steps']} decode steps, "
+              f"{stats['decode_tokens_per_second'] or 0:.1f} decode tokens/s, "
+              f"mean latency {stats['mean_latency']:.2f}s, max latency {stats['max_latency']:.2f}s")
+        engine.batch_scheduler.stop()
+
+    telemetry_path = engine.export_routing_telemetry()
+    if telemetry_path:
+        print(f"Routing telemetry written to {telemetry_path}")
+
+    if engine.expert_residency is not None:
+        stats = engine.expert_residency.stats()
+        print(f"Expert paging: {stats['page_ins']} page-ins ({stats['page_ins_per_second']:.2f}/s, "
+              f"{stats['mb_paged_in']:.0f} MB), hit rate {stats['hit_rate'] or 0:.0%}, {stats['evictions']} evictions")
+
+    memory = engine.memory_report()
+    if memory and memory["requests"]:
+        print(f"Memory: peak observed/estimated {memory['mean_observed_over_estimate']:.2f} mean, "
+              f"{memory['max_observed_over_estimate']:.2f} max over {len(memory['requests'])} requests "
+              f"(budget {memory['budget_mb']:.0f} MB, model {memory['baseline_rss_mb']:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
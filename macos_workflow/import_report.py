@@ -0,0 +1,105 @@
+"""
+Import-time report for the workflow's entry points.
+
+Each module is imported in a fresh interpreter under `python -X importtime`, and the report
+lists the packages that took longest (cumulative time of the top-level imports they pulled
+in) next to the total, checked against STARTUP_IMPORT_BUDGET. The exit status is 1 when an
+entry point is over its budget, so the report can gate a CI job.
+
+Usage:
+    python -m macos_workflow.import_report
+    python -m macos_workflow.import_report macos_workflow.ocr_engine_macos --top 20
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(_current_dir)
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from macos_workflow import config_macos as config
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure_imports(module, python=None):
+    """
+    Imports `module` in a new interpreter. Returns (wall seconds, entries), where each entry is
+    {"name", "self_us", "cumulative_us", "depth"} in the order `-X importtime` reports them.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [project_root, env.get("PYTHONPATH")]))
+    start_time = time.perf_counter()
+    result = subprocess.run([python or sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=project_root, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - start_time
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            entries.append({
+                "name": match.group(4),
+                "self_us": int(match.group(1)),
+                "cumulative_us": int(match.group(2)),
+                # -X importtime indents nested imports by two spaces per level
+                "depth": (len(match.group(3)) - 1) // 2,
+            })
+    return wall, entries
+
+
+def package_totals(entries, own_package="macos_workflow"):
+    """
+    Import seconds per top-level package, as pulled in by `own_package`: the cumulative time
+    of the imports made directly from its modules (or from the top level). `own_package`
+    itself counts only its self time.
+    """
+    totals = {}
+    ancestors = []
+    # -X importtime lists children before their parent; walk it parent first
+    for entry in reversed(entries):
+        while ancestors and ancestors[-1][0] >= entry["depth"]:
+            ancestors.pop()
+        package = entry["name"].split(".")[0]
+        if package == own_package:
+            totals[package] = totals.get(package, 0.0) + entry["self_us"] / 1e6
+        elif all(ancestor == own_package for _, ancestor in ancestors):
+            totals[package] = totals.get(package, 0.0) + entry["cumulative_us"] / 1e6
+        ancestors.append((entry["depth"], package))
+    return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+
+def report(module, top=10):
+    """Prints the report for one module. Returns True when it is within its budget."""
+    wall, entries = measure_imports(module)
+    imported = sum(entry["cumulative_us"] for entry in entries if entry["depth"] == 0) / 1e6
+    budget = config.STARTUP_IMPORT_BUDGET.get(module)
+    within = budget is None or imported <= budget
+
+    status = "" if budget is None else f" (budget {budget:.1f}s{'' if within else ', OVER'})"
+    print(f"{module}: {imported:.2f}s importing, {wall:.2f}s interpreter wall time, "
+          f"{len(entries)} modules{status}")
+    for package, seconds in list(package_totals(entries, module.split(".")[0]).items())[:top]:
+        print(f"  {seconds:7.3f}s  {package}")
+    return within
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report import time of the workflow's entry points.")
+    parser.add_argument("modules", nargs="*", help="Modules to import (default: those in STARTUP_IMPORT_BUDGET)")
+    parser.add_argument("--top", type=int, default=10, help="Packages listed per module")
+    args = parser.parse_args(argv)
+
+    results = [report(module, args.top) for module in args.modules or config.STARTUP_IMPORT_BUDGET]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
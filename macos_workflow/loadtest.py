@@ -0,0 +1,344 @@
+"""
+Load generator for the job API and the Gradio UI.
+
+Replays a corpus of images, PDFs and TIFFs against a running instance. Requests arrive as a
+Poisson process at --rate per second, with the task and resolution mode of each drawn from
+the configured mix, and at most --users of them in flight. Latency is measured from each
+request's scheduled arrival, so time spent waiting for a free user counts too.
+
+    p50/p95/p99 latency   arrival to final result
+    queue time            job API: created -> started on the server; Gradio: until processing starts
+    throughput            completed requests and pages per second of wall time
+    error rate            failed requests, by error
+
+`serve` starts the API (and optionally the UI) on a stub engine that sleeps for a modelled
+page time instead of running the model, so the harness works offline and without weights.
+
+Usage:
+    python -m macos_workflow.loadtest serve --port 8000 --with-ui
+    python -m macos_workflow.loadtest run corpus/ --url http://127.0.0.1:8000 --rate 0.5 --users 20 --duration 300
+    python -m macos_workflow.loadtest run corpus/ --target gradio --url http://127.0.0.1:8000/ui --requests 50
+"""
+import argparse
+import json
+import math
+import mimetypes
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(_current_dir)
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from macos_workflow import config_macos as config
+from macos_workflow.scheduler import estimate_page_cost
+from macos_workflow.utils import TIFF_EXTENSIONS
+from macos_workflow.warmup import synthetic_page
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+FINAL_STATES = ("done", "failed", "cancelled")
+
+
+# --- Stub engine ---
+
+class StubEngine:
+    """
+    Stands in for OCREngine without a model. A page sleeps for a time proportional to its
+    estimated cost (see scheduler.py), scaled so that a gundam-mode A4 page with the markdown
+    task takes `seconds_per_page`, and at most `concurrency` pages run at once.
+    """
+    def __init__(self, seconds_per_page=2.0, concurrency=1, seed=0):
+        self.ready = threading.Event()
+        self.ready.set()
+        self.warmup_report = None
+        self.memory_budget = None
+        self.batch_scheduler = None
+        self._slots = threading.Semaphore(max(1, concurrency))
+        self._rng = random.Random(seed)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reference_page = os.path.join(tmp_dir, "reference.png")
+            synthetic_page().save(reference_page)
+            gundam = config.RESOLUTION_PRESETS["gundam"]
+            reference_cost = estimate_page_cost(reference_page, config.PROMPT_PRESETS["markdown"],
+                                                gundam["base_size"], gundam["image_size"], gundam["crop_mode"])
+        self.seconds_per_cost = seconds_per_page / reference_cost
+
+    def run_page(self, image_path, prompt, base_size, image_size, crop_mode, max_new_tokens=None):
+        seconds = estimate_page_cost(image_path, prompt, base_size, image_size, crop_mode) * self.seconds_per_cost
+        with self._slots:
+            time.sleep(seconds * self._rng.uniform(0.8, 1.2))
+        return f"# {os.path.basename(image_path)}\n\nStub output ({base_size}/{image_size}/crop={crop_mode})."
+
+    def infer(self, image_path, prompt, base_size=None, image_size=None, crop_mode=None, max_new_tokens=None,
+              priority="interactive"):
+        return self.run_page(image_path, prompt,
+                             config.BASE_SIZE if base_size is None else base_size,
+                             config.IMAGE_SIZE if image_size is None else image_size,
+                             config.CROP_MODE if crop_mode is None else crop_mode, max_new_tokens)
+
+    def infer_pages(self, image_paths, prompt, base_size=None, image_size=None, crop_mode=None,
+                    priority="bulk", total_pages=None):
+        for index, image_path in enumerate(image_paths):
+            yield index, image_path, self.infer(image_path, prompt, base_size, image_size, crop_mode)
+
+
+# --- Clients ---
+
+def _multipart(fields, file_field, file_path):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+    content_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    with open(file_path, "rb") as f:
+        payload = f.read()
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                 f'filename="{os.path.basename(file_path)}"\r\nContent-Type: {content_type}\r\n\r\n'.encode("utf-8")
+                 + payload + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class APIClient:
+    """Submits a job and polls it until it reaches a final state."""
+    def __init__(self, base_url, poll_interval=0.5, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def _json(self, request):
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def run(self, file_path, task, mode):
+        """Returns (queue seconds, pages). Raises on failure."""
+        body, content_type = _multipart({"task": task, "mode": mode}, "file", file_path)
+        request = urllib.request.Request(f"{self.base_url}/jobs", data=body, headers={"Content-Type": content_type},
+                                         method="POST")
+        job_id = self._json(request)["job_id"]
+        while True:
+            job = self._json(f"{self.base_url}/jobs/{job_id}")
+            if job["status"] in FINAL_STATES:
+                break
+            time.sleep(self.poll_interval)
+        if job["status"] != "done":
+            raise RuntimeError(f"job {job['status']}: {job.get('error') or ''}".strip())
+        return job["started_at"] - job["created_at"], job["total_pages"] or job["pages_done"]
+
+
+class GradioClient:
+    """
+    Calls the UI's image and PDF endpoints through gradio_client. Dropdown values are sent in
+    the UI's default language, which is what the server resolves them against.
+    """
+    LANG = "简体中文"
+
+    def __init__(self, url, poll_interval=0.05):
+        from gradio_client import Client
+        from gradio_client.utils import Status
+        from macos_workflow import app as gradio_app
+
+        self.client = Client(url, verbose=False)
+        self.poll_interval = poll_interval
+        self.running_states = {Status.PROCESSING, Status.PROGRESS, Status.ITERATING, Status.FINISHED}
+        self.task_labels = {name: gradio_app.get_i18n_text(self.LANG, f"task_{name}") for name in config.PROMPT_PRESETS}
+        self.mode_labels = {name: gradio_app.get_i18n_text(self.LANG, f"res_{name}") for name in config.RESOLUTION_PRESETS}
+
+    def run(self, file_path, task, mode):
+        try:
+            from gradio_client import handle_file
+        except ImportError:  # gradio_client < 1.0
+            from gradio_client import file as handle_file
+        is_image = file_path.lower().endswith(IMAGE_EXTENSIONS)
+        submitted = time.time()
+        job = self.client.submit(handle_file(file_path), self.task_labels[task], "", self.mode_labels[mode], self.LANG,
+                                 api_name="/run_image_ocr_task" if is_image else "/run_pdf_ocr_task")
+        started = None
+        while not job.done():
+            if started is None and job.status().code in self.running_states:
+                started = time.time()
+            time.sleep(self.poll_interval)
+        job.result()
+        return (started or time.time()) - submitted, None
+
+
+# --- Load generation ---
+
+def collect_corpus(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        else:
+            files.append(path)
+    supported = IMAGE_EXTENSIONS + TIFF_EXTENSIONS + ('.pdf',)
+    return [f for f in files if f.lower().endswith(supported)]
+
+
+def parse_mix(text, choices):
+    """"markdown=0.7,free_ocr=0.3" -> {"markdown": 0.7, "free_ocr": 0.3}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in choices:
+            raise ValueError(f"Unknown choice '{name}' (expected one of {', '.join(sorted(choices))})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run_load(client, corpus, tasks, modes, rate, users=20, duration=None, requests=None, seed=0):
+    """Generates the load and returns one record per request."""
+    rng = random.Random(seed)
+    records = []
+    lock = threading.Lock()
+
+    def one(arrival, file_path, task, mode):
+        record = {"file": os.path.basename(file_path), "task": task, "mode": mode, "arrival": arrival}
+        try:
+            record["queue_time"], record["pages"] = client.run(file_path, task, mode)
+            record["ok"] = True
+        except Exception as e:
+            record["ok"] = False
+            record["error"] = f"{type(e).__name__}: {e}"[:200]
+        record["latency"] = time.time() - arrival
+        with lock:
+            records.append(record)
+        status = "ok" if record["ok"] else record["error"]
+        print(f"  {record['file']} {task}/{mode}: {record['latency']:.2f}s {status}")
+
+    start_time = time.time()
+    next_arrival = start_time
+    sent = 0
+    with ThreadPoolExecutor(max_workers=users, thread_name_prefix="load-user") as executor:
+        while (requests is None or sent < requests) and (duration is None or next_arrival - start_time < duration):
+            time.sleep(max(0.0, next_arrival - time.time()))
+            executor.submit(one, next_arrival, rng.choice(corpus),
+                            rng.choices(list(tasks), weights=list(tasks.values()))[0],
+                            rng.choices(list(modes), weights=list(modes.values()))[0])
+            sent += 1
+            next_arrival += rng.expovariate(rate)
+    return records, time.time() - start_time
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values` (0 < q <= 100)."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def _distribution(values):
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+            "mean": sum(values) / len(values) if values else None, "max": max(values) if values else None}
+
+
+def summarize(records, wall_seconds):
+    ok = [r for r in records if r["ok"]]
+    errors = {}
+    for r in records:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    summary = {
+        "requests": len(records),
+        "completed": len(ok),
+        "error_rate": (len(records) - len(ok)) / len(records) if records else 0.0,
+        "errors": errors,
+        "wall_seconds": wall_seconds,
+        "requests_per_second": len(ok) / wall_seconds if wall_seconds else 0.0,
+        "pages_per_second": sum(r["pages"] or 1 for r in ok) / wall_seconds if wall_seconds else 0.0,
+        "latency": _distribution([r["latency"] for r in ok]),
+        "queue_time": _distribution([r["queue_time"] for r in ok if r.get("queue_time") is not None]),
+        "by_mix": {},
+    }
+    for key in sorted({f"{r['task']}/{r['mode']}" for r in records}):
+        group = [r for r in records if f"{r['task']}/{r['mode']}" == key]
+        summary["by_mix"][key] = {
+            "requests": len(group),
+            "errors": sum(not r["ok"] for r in group),
+            "latency": _distribution([r["latency"] for r in group if r["ok"]]),
+        }
+    return summary
+
+
+def _format_distribution(d):
+    if d["p50"] is None:
+        return "n/a"
+    return f"p50 {d['p50']:.2f}s, p95 {d['p95']:.2f}s, p99 {d['p99']:.2f}s, max {d['max']:.2f}s"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the job API or the Gradio UI.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Serve the API (and UI) on a stub engine")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--with-ui", action="store_true")
+    serve_parser.add_argument("--seconds-per-page", type=float, default=2.0,
+                              help="Stub time of a gundam-mode A4 page with the markdown task")
+    serve_parser.add_argument("--concurrency", type=int, default=1, help="Pages the stub engine runs at once")
+
+    run_parser = subparsers.add_parser("run", help="Generate load against a running instance")
+    run_parser.add_argument("corpus", nargs="+", help="Images, PDFs, TIFFs or directories of them")
+    run_parser.add_argument("--target", choices=["api", "gradio"], default="api")
+    run_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    run_parser.add_argument("--rate", type=float, default=0.5, help="Mean arrivals per second")
+    run_parser.add_argument("--users", type=int, default=20, help="Maximum requests in flight")
+    run_parser.add_argument("--duration", type=float, help="Seconds to generate arrivals for")
+    run_parser.add_argument("--requests", type=int, help="Number of requests to send")
+    run_parser.add_argument("--tasks", default="markdown=0.6,free_ocr=0.3,describe_image=0.1")
+    run_parser.add_argument("--modes", default="gundam=0.7,base=0.2,small=0.1")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", help="Write records and summary as JSON")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        import uvicorn
+        from macos_workflow.api_server import build_app
+        engine = StubEngine(args.seconds_per_page, args.concurrency)
+        db_path = os.path.join(tempfile.mkdtemp(prefix="deepseek_ocr_loadtest_"), "jobs.sqlite3")
+        uvicorn.run(build_app(engine, db_path=db_path, with_ui=args.with_ui), host=args.host, port=args.port)
+        return
+
+    if args.duration is None and args.requests is None:
+        parser.error("run needs --duration or --requests")
+    corpus = collect_corpus(args.corpus)
+    if not corpus:
+        parser.error("no images, PDFs or TIFFs in the corpus")
+    tasks = parse_mix(args.tasks, config.PROMPT_PRESETS)
+    modes = parse_mix(args.modes, config.RESOLUTION_PRESETS)
+    client = APIClient(args.url) if args.target == "api" else GradioClient(args.url)
+
+    print(f"Load: {args.rate}/s Poisson arrivals, up to {args.users} users, {len(corpus)} corpus files, "
+          f"target {args.target} at {args.url}")
+    records, wall_seconds = run_load(client, corpus, tasks, modes, args.rate, args.users, args.duration,
+                                     args.requests, args.seed)
+    summary = summarize(records, wall_seconds)
+
+    print(f"\n{summary['completed']}/{summary['requests']} completed in {wall_seconds:.1f}s, "
+          f"error rate {summary['error_rate']:.1%}")
+    print(f"Throughput: {summary['requests_per_second']:.3f} requests/s, {summary['pages_per_second']:.3f} pages/s")
+    print(f"Latency:    {_format_distribution(summary['latency'])}")
+    print(f"Queue time: {_format_distribution(summary['queue_time'])}")
+    for key, group in summary["by_mix"].items():
+        print(f"  {key:<24} {group['requests']:>4} requests, {group['errors']} errors, {_format_distribution(group['latency'])}")
+    for error, count in summary["errors"].items():
+        print(f"  {count} x {error}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "records": records}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
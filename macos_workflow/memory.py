@@ -0,0 +1,275 @@
+"""
+Memory-aware admission control.
+
+`MemoryEstimator` predicts the peak working memory of one request from the model config,
+the page's resolution mode and crop grid, the batch size and `max_new_tokens`:
+
+    vision    the largest encoder batch (all crop tiles at once, or the global view),
+              dominated by SAM's global-attention score matrices
+    prefill   prompt activations, attention scores and the full-vocabulary logits
+    kv        key/value cache for prompt + max_new_tokens, one row of it
+
+Continuous batching keeps every running page in one KV cache whose rows are all allocated
+and padded to the longest page, so the batch size multiplies the KV term only.
+
+`MemoryBudget` admits requests against a configured budget on top of the RSS measured after
+the model was loaded. A request that does not fit waits until running requests release
+their reservation; one that could never fit is downgraded to the largest resolution preset
+that does. Live RSS is sampled in the background, both to account for memory the estimates
+missed and to record each request's observed peak next to its estimate (`report`).
+"""
+import logging
+import os
+import sys
+import threading
+import time
+
+from PIL import Image
+
+from . import config_macos as config
+from .resolution import num_queries, select_crop_grid, vision_token_count
+
+logger = logging.getLogger(__name__)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MB = 2 ** 20
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    if resource is not None:
+        # Peak rather than current RSS; bytes on macOS, KiB elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    return 0
+
+
+def _oriented_size(image_path):
+    """Image size after `ImageOps.exif_transpose`, which the model applies before tiling."""
+    with Image.open(image_path) as image:
+        width, height = image.size
+        # EXIF orientations 5-8 swap the axes
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+class MemoryEstimator:
+    """Peak-memory model of one request, in bytes."""
+    # SAM ViT-B and CLIP-L as built by deepencoder
+    SAM_DIM, SAM_HEADS = 768, 12
+    CLIP_DIM, CLIP_HEADS = 1024, 16
+    # Live copies of a layer's activations (residual, norm, MLP expansion)
+    ACTIVATION_COPIES = 8
+    PROMPT_TEXT_TOKENS = 64
+
+    def __init__(self, model_config, dtype_bytes=4):
+        self.dtype_bytes = dtype_bytes
+        self.layers = getattr(model_config, "num_hidden_layers", 12)
+        self.hidden = getattr(model_config, "hidden_size", 1280)
+        self.heads = getattr(model_config, "num_attention_heads", 10)
+        self.kv_heads = getattr(model_config, "num_key_value_heads", None) or self.heads
+        self.head_dim = getattr(model_config, "head_dim", None) or self.hidden // self.heads
+        self.vocab = getattr(model_config, "vocab_size", 129280)
+
+    def _view_bytes(self, view_size):
+        patches = (view_size // 16) ** 2
+        clip_tokens = num_queries(view_size) ** 2
+        sam = patches * patches * self.SAM_HEADS * 4 * 2 + patches * self.SAM_DIM * self.dtype_bytes * self.ACTIVATION_COPIES
+        clip = clip_tokens * clip_tokens * self.CLIP_HEADS * 4 * 2 + clip_tokens * self.CLIP_DIM * self.dtype_bytes * self.ACTIVATION_COPIES
+        return sam + clip
+
+    def estimate(self, width, height, base_size, image_size, crop_mode, max_new_tokens, batch_size=1):
+        """
+        Returns {"vision", "prefill", "kv", "activations", "total", "grid", "prompt_tokens"}.
+        `total` counts `batch_size` KV rows of this page's length, as in a shared batch cache.
+        """
+        grid = select_crop_grid(width, height, image_size, crop_mode)
+        if crop_mode:
+            tiles = grid[0] * grid[1] if grid != (1, 1) else 0
+            vision = max(tiles * self._view_bytes(image_size), self._view_bytes(base_size))
+        else:
+            vision = self._view_bytes(image_size)
+
+        prompt_tokens = vision_token_count(base_size, image_size, crop_mode, grid) + self.PROMPT_TEXT_TOKENS
+        prefill = (prompt_tokens * self.vocab * 4
+                   + prompt_tokens * prompt_tokens * self.heads * 4
+                   + prompt_tokens * self.hidden * self.dtype_bytes * self.ACTIVATION_COPIES)
+        kv = self.layers * 2 * self.kv_heads * self.head_dim * (prompt_tokens + max_new_tokens) * self.dtype_bytes
+        # Vision and prefill peaks do not overlap, and pages are prefilled one at a time; the KV
+        # cache lives through both decode and prefill
+        activations = max(vision, prefill)
+        total = activations + batch_size * kv
+        return {"vision": vision, "prefill": prefill, "kv": kv, "activations": activations, "total": total,
+                "grid": grid, "prompt_tokens": prompt_tokens}
+
+
+class Reservation:
+    """Budget held by one request. Use as a context manager or call `release`."""
+    def __init__(self, budget, nbytes, label):
+        self.budget = budget
+        self.nbytes = nbytes
+        self.label = label
+        self.started_at = time.time()
+        self.start_rss = current_rss()
+        self.peak_rss = self.start_rss
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.budget._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class MemoryBudget:
+    """Admits, queues or downgrades requests so their estimated peaks fit `budget_bytes`."""
+    def __init__(self, estimator, budget_bytes, allow_downgrade=True, sample_interval=0.05, kv_bytes_fn=None):
+        self.estimator = estimator
+        self.budget_bytes = budget_bytes
+        self.allow_downgrade = allow_downgrade
+        self.sample_interval = sample_interval
+        self.kv_bytes_fn = kv_bytes_fn
+        self.baseline_rss = current_rss()
+
+        self._active = []
+        self._condition = threading.Condition()
+        self._records = []
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    @property
+    def capacity(self):
+        return max(0, self.budget_bytes - self.baseline_rss)
+
+    def start(self):
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample, name="memory-sampler", daemon=True)
+            self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _sample(self):
+        while not self._stopped.wait(self.sample_interval):
+            rss = current_rss()
+            with self._condition:
+                for reservation in self._active:
+                    reservation.peak_rss = max(reservation.peak_rss, rss)
+
+    # --- Planning ---
+
+    def plan(self, image_path, mode, max_new_tokens=None, batch_size=1):
+        """
+        Returns (mode, estimate) for one page: the requested mode, or a smaller resolution
+        preset if the requested one could not fit the budget even with nothing else running.
+        `batch_size` is the row count of the KV cache the page will share (see `estimate`).
+        """
+        max_new_tokens = max_new_tokens or config.BATCH_MAX_NEW_TOKENS
+        width, height = _oriented_size(image_path)
+        estimate = self.estimator.estimate(width, height, *mode, max_new_tokens, batch_size)
+        if estimate["total"] <= self.capacity or not self.allow_downgrade:
+            return mode, estimate
+
+        candidates = []
+        for name, preset in config.RESOLUTION_PRESETS.items():
+            preset_mode = (preset["base_size"], preset["image_size"], preset["crop_mode"])
+            preset_estimate = self.estimator.estimate(width, height, *preset_mode, max_new_tokens, batch_size)
+            if preset_estimate["total"] <= self.capacity:
+                candidates.append((preset_estimate["total"], name, preset_mode, preset_estimate))
+        if not candidates:
+            logger.warning(f"{os.path.basename(image_path)} exceeds the memory budget in every mode; running it as requested.")
+            return mode, estimate
+        _, name, new_mode, new_estimate = max(candidates)
+        print(f"Memory budget: downgrading {os.path.basename(image_path)} to '{name}' "
+              f"({estimate['total'] / MB:.0f} MB -> {new_estimate['total'] / MB:.0f} MB estimated).")
+        return new_mode, new_estimate
+
+    # --- Admission ---
+
+    def _available(self):
+        reserved = sum(r.nbytes for r in self._active)
+        # Memory the estimates did not account for still counts against the budget
+        unaccounted = max(0, current_rss() - self.baseline_rss - reserved)
+        return self.capacity - reserved - unaccounted
+
+    def try_reserve(self, nbytes, label=""):
+        """Reserves `nbytes` if they fit now (or nothing else is running). Returns a Reservation or None."""
+        with self._condition:
+            if self._active and nbytes > self._available():
+                return None
+            reservation = Reservation(self, nbytes, label)
+            self._active.append(reservation)
+            return reservation
+
+    def reserve(self, nbytes, label="", timeout=None):
+        """Blocks until `nbytes` fit, then reserves them."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._active and nbytes > self._available():
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"Memory budget: could not admit {label} within {timeout}s.")
+                self._condition.wait(timeout=min(1.0, remaining) if remaining is not None else 1.0)
+            reservation = Reservation(self, nbytes, label)
+            self._active.append(reservation)
+            return reservation
+
+    def _release(self, reservation):
+        with self._condition:
+            if reservation in self._active:
+                self._active.remove(reservation)
+            self._records.append({
+                "label": reservation.label,
+                "estimate_mb": reservation.nbytes / MB,
+                "observed_peak_mb": max(0, reservation.peak_rss - reservation.start_rss) / MB,
+                "seconds": time.time() - reservation.started_at,
+            })
+            del self._records[:-1000]
+            self._condition.notify_all()
+
+    # --- Reporting ---
+
+    def status(self):
+        with self._condition:
+            reserved = sum(r.nbytes for r in self._active)
+            active = len(self._active)
+        return {
+            "budget_mb": self.budget_bytes / MB,
+            "baseline_rss_mb": self.baseline_rss / MB,
+            "rss_mb": current_rss() / MB,
+            "reserved_mb": reserved / MB,
+            "active_requests": active,
+            "kv_cache_mb": (self.kv_bytes_fn() / MB) if self.kv_bytes_fn else None,
+        }
+
+    def report(self):
+        """Estimated versus observed peak memory of recent requests."""
+        with self._condition:
+            records = list(self._records)
+        ratios = [r["observed_peak_mb"] / r["estimate_mb"] for r in records if r["estimate_mb"]]
+        return {
+            "requests": records,
+            "mean_observed_over_estimate": sum(ratios) / len(ratios) if ratios else None,
+            "max_observed_over_estimate": max(ratios) if ratios else None,
+        }
@@ -0,0 +1,228 @@
+"""
+Grouped expert dispatch for the DeepseekV2 mixture-of-experts layers.
+
+The stock `DeepseekV2MoE` inference path gathers the routed copies of every token, runs each
+expert's gate, up and down projections as separate calls, concatenates the outputs, scatters
+them back and then weights and sums a (tokens x top_k x hidden) buffer. `grouped_moe` sorts
+the token slots by expert once, skips experts that received no tokens, runs the gate and up
+projections of an expert as a single GEMM over its contiguous block of tokens and
+accumulates the weighted result straight into the output with `index_add_`.
+
+Expert weights are read through a provider (`ModuleExpertWeights` by default), so they can be
+served from somewhere other than the loaded modules.
+
+Benchmark against the stock dispatch on CPU:
+    python -m macos_workflow.moe --tokens 1 8 64 512 --threads 8
+"""
+import argparse
+import logging
+import time
+import types
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+
+class ModuleExpertWeights:
+    """
+    Serves expert weights from the loaded expert modules. The gate and up projection weights
+    of each expert are fused into one (2 * intermediate, hidden) tensor; the modules' own
+    parameters become views into it, so no weight is stored twice.
+    """
+    def __init__(self, experts):
+        self.act_fn = experts[0].act_fn
+        self.gate_up = []
+        self.down = []
+        for expert in experts:
+            gate, up = expert.gate_proj.weight, expert.up_proj.weight
+            gate_up = torch.cat([gate.data, up.data], dim=0)
+            expert.gate_proj.weight = torch.nn.Parameter(gate_up[:gate.shape[0]], requires_grad=False)
+            expert.up_proj.weight = torch.nn.Parameter(gate_up[gate.shape[0]:], requires_grad=False)
+            self.gate_up.append(gate_up)
+            self.down.append(expert.down_proj.weight)
+
+    def __len__(self):
+        return len(self.gate_up)
+
+    def get(self, expert_index):
+        """Returns (gate_up, down) weights of one expert."""
+        return self.gate_up[expert_index], self.down[expert_index]
+
+
+@torch.no_grad()
+def grouped_moe(hidden_states, topk_idx, topk_weight, weights):
+    """
+    Routed-expert output for `hidden_states` (tokens, hidden), given the gate's `topk_idx` and
+    `topk_weight` (tokens, top_k) and an expert weight provider.
+    """
+    top_k = topk_idx.shape[1]
+    flat_experts = topk_idx.reshape(-1)
+    order = flat_experts.argsort(stable=True)
+    slot_tokens = order // top_k
+    slot_weights = topk_weight.reshape(-1)[order].unsqueeze(-1)
+    counts = torch.bincount(flat_experts, minlength=len(weights)).tolist()
+
+    sorted_tokens = hidden_states.index_select(0, slot_tokens)
+    output = torch.zeros(hidden_states.shape, dtype=topk_weight.dtype, device=hidden_states.device)
+
+    start = 0
+    for expert_index, count in enumerate(counts):
+        if count == 0:
+            continue
+        end = start + count
+        gate_up, down = weights.get(expert_index)
+        gate, up = F.linear(sorted_tokens[start:end], gate_up).chunk(2, dim=-1)
+        expert_out = F.linear(weights.act_fn(gate) * up, down)
+        output.index_add_(0, slot_tokens[start:end], expert_out.to(output.dtype) * slot_weights[start:end])
+        start = end
+
+    return output.to(hidden_states.dtype)
+
+
+def _grouped_forward(self, hidden_states):
+    """Replacement for `DeepseekV2MoE.forward` outside training."""
+    if self.training:
+        return self._stock_forward(hidden_states)
+
+    identity = hidden_states
+    orig_shape = hidden_states.shape
+    topk_idx, topk_weight, _ = self.gate(hidden_states)
+    y = grouped_moe(hidden_states.view(-1, orig_shape[-1]), topk_idx, topk_weight, self.expert_weights)
+    y = y.view(*orig_shape)
+    if self.config.n_shared_experts is not None:
+        y = y + self.shared_experts(identity)
+    return y
+
+
+def _moe_layers(model):
+    return [m for m in model.modules() if hasattr(m, "experts") and hasattr(m, "gate")]
+
+
+def enable_grouped_dispatch(model, weights_factory=None):
+    """
+    Switches every MoE layer of `model` to grouped dispatch. `weights_factory(layer)` builds
+    the expert weight provider of a layer (default: `ModuleExpertWeights(layer.experts)`).
+    Returns the number of layers switched.
+    """
+    weights_factory = weights_factory or (lambda layer: ModuleExpertWeights(layer.experts))
+    layers = _moe_layers(model)
+    for layer in layers:
+        if hasattr(layer, "_stock_forward"):
+            continue
+        layer.expert_weights = weights_factory(layer)
+        layer._stock_forward = layer.forward
+        layer.forward = types.MethodType(_grouped_forward, layer)
+    return len(layers)
+
+
+def disable_grouped_dispatch(model):
+    """Restores the stock MoE forward on every patched layer."""
+    for layer in _moe_layers(model):
+        if hasattr(layer, "_stock_forward"):
+            layer.forward = layer._stock_forward
+            del layer._stock_forward, layer.expert_weights
+
+
+# --- Benchmark ---
+
+class _Expert(torch.nn.Module):
+    """Same layout as DeepseekV2MLP."""
+    def __init__(self, hidden_size, intermediate_size):
+        super().__init__()
+        self.gate_proj = torch.nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.up_proj = torch.nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.down_proj = torch.nn.Linear(intermediate_size, hidden_size, bias=False)
+        self.act_fn = torch.nn.SiLU()
+
+    def forward(self, x):
+        return self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
+
+
+@torch.no_grad()
+def stock_moe(experts, x, topk_ids, topk_weight):
+    """The dispatch of `DeepseekV2MoE.moe_infer`, used as the benchmark baseline."""
+    cnts = topk_ids.new_zeros((topk_ids.shape[0], len(experts)))
+    cnts.scatter_(1, topk_ids, 1)
+    tokens_per_expert = cnts.sum(dim=0).cpu().numpy()
+    idxs = topk_ids.view(-1).argsort()
+    sorted_tokens = x[idxs // topk_ids.shape[1]]
+
+    outputs = []
+    start_idx = 0
+    for i, num_tokens in enumerate(tokens_per_expert):
+        end_idx = start_idx + num_tokens
+        if num_tokens == 0:
+            continue
+        outputs.append(experts[i](sorted_tokens[start_idx:end_idx]))
+        start_idx = end_idx
+
+    outs = torch.cat(outputs, dim=0) if len(outputs) else sorted_tokens.new_empty(0)
+    new_x = torch.empty_like(outs)
+    new_x[idxs] = outs
+    return (new_x.view(*topk_ids.shape, -1).type(topk_weight.dtype)
+            .mul_(topk_weight.unsqueeze(dim=-1)).sum(dim=1).type(new_x.dtype))
+
+
+def _time(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(tokens=(1, 8, 64, 512), num_experts=64, top_k=6, hidden_size=1280, intermediate_size=896,
+              dtype=torch.float32, repeats=20, seed=0):
+    """Times stock and grouped dispatch on random routing. Returns one dict per token count."""
+    torch.manual_seed(seed)
+    experts = torch.nn.ModuleList(_Expert(hidden_size, intermediate_size) for _ in range(num_experts)).to(dtype).eval()
+    weights = ModuleExpertWeights(experts)
+
+    results = []
+    for num_tokens in tokens:
+        x = torch.randn(num_tokens, hidden_size, dtype=dtype)
+        scores = torch.randn(num_tokens, num_experts).softmax(dim=-1)
+        topk_weight, topk_idx = torch.topk(scores, k=top_k, dim=-1)
+
+        stock_s = _time(lambda: stock_moe(experts, x, topk_idx, topk_weight), repeats)
+        grouped_s = _time(lambda: grouped_moe(x, topk_idx, topk_weight, weights), repeats)
+        max_diff = (stock_moe(experts, x, topk_idx, topk_weight).float()
+                    - grouped_moe(x, topk_idx, topk_weight, weights).float()).abs().max().item()
+        results.append({
+            "tokens": num_tokens,
+            "active_experts": int(topk_idx.unique().numel()),
+            "stock_ms": stock_s * 1000,
+            "grouped_ms": grouped_s * 1000,
+            "speedup": stock_s / grouped_s,
+            "max_abs_diff": max_diff,
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare stock and grouped MoE dispatch on CPU.")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1, 8, 64, 512])
+    parser.add_argument("--experts", type=int, default=64)
+    parser.add_argument("--top-k", type=int, default=6)
+    parser.add_argument("--hidden-size", type=int, default=1280)
+    parser.add_argument("--intermediate-size", type=int, default=896)
+    parser.add_argument("--dtype", choices=["float32", "bfloat16"], default="float32")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    print(f"{args.experts} experts, top-{args.top_k}, hidden {args.hidden_size}, intermediate {args.intermediate_size}, "
+          f"{args.dtype}, {torch.get_num_threads()} threads")
+    print(f"{'tokens':>8} {'experts':>8} {'stock ms':>10} {'grouped ms':>11} {'speedup':>8} {'max diff':>10}")
+    for r in benchmark(args.tokens, args.experts, args.top_k, args.hidden_size, args.intermediate_size,
+                       getattr(torch, args.dtype), args.repeats):
+        print(f"{r['tokens']:>8} {r['active_experts']:>8} {r['stock_ms']:>10.2f} {r['grouped_ms']:>11.2f} "
+              f"{r['speedup']:>7.2f}x {r['max_abs_diff']:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import sys
 import os
+import contextlib
+import threading
 import torch
 from transformers import AutoTokenizer
 import logging
@@ -8,6 +10,7 @@ import logging
 # We can directly import the custom model class.
 from DeepSeek_OCR.modeling_deepseekocr import DeepseekOCRForCausalLM
 from . import config_macos as config
+from .profiling import ProfilerCapture
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +19,11 @@ class OCREngine:
     A simplified OCR Engine that correctly loads the custom DeepSeek-OCR model
     and uses its built-in .infer() method.
     It's initialized with the project's root path to dynamically locate model files.
+    `cpu_profile` overrides the CPU profile written by `python -m macos_workflow.cpu_tuning autotune`.
+    `warmup` (default: WARMUP_ENABLED) primes every shape bucket before `ready` is set;
+    "background" does so on a separate thread and returns immediately.
     """
-    def __init__(self, project_root):
+    def __init__(self, project_root, cpu_profile=None, warmup=None):
         print("Initializing OCR Engine...")
         self.project_root = project_root
         self.model_path = os.path.join(self.project_root, "DeepSeek-OCR")
@@ -25,10 +31,34 @@ class OCREngine:
         os.makedirs(self.output_path, exist_ok=True)
 
         self.device = self._get_device()
+        self.cpu_settings = self._configure_cpu(cpu_profile)
         self.tokenizer = None
         self.model = None
+        self.batch_scheduler = None
+        self.priority_scheduler = None
+        self.expert_residency = None
+        self.routing_telemetry = None
+        self.memory_budget = None
+        self.profiler = ProfilerCapture(config.PROFILE_DIR or os.path.join(self.output_path, "profiles"),
+                                        config.PROFILE_ROW_LIMIT)
+        self.profile_next(int(os.environ.get("OCR_PROFILE_NEXT", config.PROFILE_NEXT_REQUESTS)))
+        self.ready = threading.Event()
+        self.warmup_report = None
+        self._warming_up = False
         self._load_model()
 
+        warmup = config.WARMUP_ENABLED if warmup is None else warmup
+        if warmup == "background":
+            threading.Thread(target=self.warmup, name="ocr-warmup", daemon=True).start()
+        elif warmup:
+            self.warmup()
+        else:
+            self.ready.set()
+
+    @property
+    def _expert_paging(self):
+        return config.EXPERT_PAGING_ENABLED and self.device.type == "cpu"
+
     def _get_device(self):
         if config.DEVICE == "mps" and torch.backends.mps.is_available():
             print("MPS backend is available. Using MPS.")
@@ -37,6 +67,14 @@ class OCREngine:
             print("MPS not available or not selected. Using CPU.")
             return torch.device("cpu")
 
+    def _configure_cpu(self, profile):
+        """Applies thread counts and NUMA pinning before anything runs on the CPU."""
+        from .cpu_tuning import apply_cpu_settings
+        settings = apply_cpu_settings(profile)
+        pinned = f", pinned to {len(settings['cpus'])} cores" if settings["cpus"] else ""
+        print(f"CPU: {settings['threads']} intra-op / {settings['interop_threads']} inter-op threads{pinned}.")
+        return settings
+
     def _load_model(self):
         """
         Loads the tokenizer and the model using the custom class and dynamic paths.
@@ -60,42 +98,255 @@ class OCREngine:
             print("Tokenizer loaded successfully.")
 
             print(f"Loading model from {self.model_path} to {self.device}...")
-            self.model = DeepseekOCRForCausalLM.from_pretrained(
-                self.model_path,
-                trust_remote_code=True,
-                torch_dtype=torch.float32
-            ).to(self.device)
+            if self._expert_paging:
+                # The routed experts are never loaded into RAM; they are mapped from the expert cache
+                from .expert_paging import load_without_experts
+                self.model = load_without_experts(DeepseekOCRForCausalLM, self.model_path,
+                                                  getattr(torch, config.MODEL_DTYPE))
+            else:
+                self.model = DeepseekOCRForCausalLM.from_pretrained(
+                    self.model_path,
+                    trust_remote_code=True,
+                    torch_dtype=getattr(torch, config.MODEL_DTYPE)
+                ).to(self.device)
 
             self.model.eval()
             print("Model loaded and set to evaluation mode successfully.")
+            self._configure_model()
 
         except Exception as e:
             logger.error(f"Failed to load model: {e}", exc_info=True)
             raise
 
-    def infer(self, image_path: str, prompt: str):
+    def _configure_model(self):
+        """Applies the workflow options from config_macos to the loaded model."""
+        self.model.reduced_decode = config.REDUCED_RESOLUTION_DECODE
+        self.model.model.blank_tile_memo = config.BLANK_TILE_MEMO
+        self.model.prune_padding = config.PRUNE_PADDING_TOKENS
+        if config.VISION_BACKEND == "onnx":
+            from .vision_onnx import enable_onnx_vision
+            onnx_dir = config.VISION_ONNX_DIR or os.path.join(self.project_root, "onnx_vision")
+            enable_onnx_vision(self.model, onnx_dir, quantized=config.VISION_ONNX_QUANTIZE,
+                               check_parity=config.VISION_ONNX_PARITY_CHECK, min_cosine=config.VISION_ONNX_MIN_COSINE)
+            print(f"Vision encoder running under ONNX Runtime ({'int8' if config.VISION_ONNX_QUANTIZE else 'float32'}).")
+        if self._expert_paging:
+            from .expert_paging import enable_expert_paging
+            cache_dir = config.EXPERT_CACHE_DIR or os.path.join(self.project_root, "expert_cache")
+            self.expert_residency = enable_expert_paging(self.model, cache_dir, config.EXPERT_MAX_RESIDENT,
+                                                         checkpoint=self.model_path)
+            print(f"Expert paging enabled: at most {config.EXPERT_MAX_RESIDENT} experts resident, cache in {cache_dir}.")
+        elif config.MOE_GROUPED_DISPATCH:
+            from .moe import enable_grouped_dispatch
+            layers = enable_grouped_dispatch(self.model)
+            print(f"Grouped MoE dispatch enabled on {layers} decoder layers.")
+        if config.ROUTING_TELEMETRY_ENABLED:
+            from .routing_telemetry import RoutingTelemetry
+            self.routing_telemetry = RoutingTelemetry()
+            layers = self.routing_telemetry.attach(self.model)
+            print(f"Routing telemetry attached to {layers} MoE gates.")
+        if config.MEMORY_BUDGET_GB:
+            from .memory import MemoryBudget, MemoryEstimator
+            self.memory_budget = MemoryBudget(
+                MemoryEstimator(self.model.config, dtype_bytes=torch.finfo(self.model.dtype).bits // 8),
+                int(config.MEMORY_BUDGET_GB * 2 ** 30),
+                allow_downgrade=config.MEMORY_ALLOW_DOWNGRADE,
+                kv_bytes_fn=lambda: self.batch_scheduler.kv_cache_bytes() if self.batch_scheduler else 0,
+            ).start()
+            print(f"Memory budget {config.MEMORY_BUDGET_GB} GB, "
+                  f"{self.memory_budget.capacity / 2 ** 20:.0f} MB above the loaded model.")
+
+    def warmup(self, mode_names=None):
+        """
+        Runs synthetic pages through each resolution mode and crop-grid bucket, then sets `ready`.
+        Returns the per-bucket cold and warm latencies (also kept in `warmup_report`).
+        """
+        from .warmup import warm_up
+        self._warming_up = True
+        try:
+            self.warmup_report = warm_up(self, mode_names or config.WARMUP_MODES)
+        except Exception as e:
+            logger.error(f"Warmup failed; serving cold: {e}", exc_info=True)
+        finally:
+            self._warming_up = False
+            self.ready.set()
+        return self.warmup_report
+
+    def _resolve_mode(self, base_size, image_size, crop_mode):
+        """Fills unset resolution parameters from the config defaults."""
+        return (
+            config.BASE_SIZE if base_size is None else base_size,
+            config.IMAGE_SIZE if image_size is None else image_size,
+            config.CROP_MODE if crop_mode is None else crop_mode,
+        )
+
+    def infer(self, image_path: str, prompt: str, base_size=None, image_size=None, crop_mode=None, max_new_tokens=None,
+              priority="interactive"):
         """
-        Runs inference by calling the model's internal .infer() method.
+        Runs inference on one image. Resolution parameters default to the values in config_macos.
+        With PRIORITY_SCHEDULING_ENABLED the page waits in the priority scheduler under `priority`.
         """
         if not self.model or not self.tokenizer:
             raise RuntimeError("Model or tokenizer is not loaded.")
 
+        mode = self._resolve_mode(base_size, image_size, crop_mode)
+
+        if config.PRIORITY_SCHEDULING_ENABLED:
+            return self.get_scheduler().submit(image_path, prompt, mode, priority, max_new_tokens).result()
+        return self.run_page(image_path, prompt, *mode, max_new_tokens=max_new_tokens)
+
+    def run_page(self, image_path, prompt, base_size, image_size, crop_mode, max_new_tokens=None):
+        """
+        Runs one page right away, by calling the model's internal .infer() method
+        (or through the continuous batching scheduler when it is enabled).
+        The page is profiled if a capture is armed (see `profile_next`). With continuous
+        batching this thread only waits on the scheduler, so the trace shows the scheduler
+        thread's steps while the page is in flight, including those of other batched pages.
+        """
+        with self.profile_capture(os.path.basename(image_path)):
+            return self._run_page(image_path, prompt, base_size, image_size, crop_mode, max_new_tokens)
+
+    def _run_page(self, image_path, prompt, base_size, image_size, crop_mode, max_new_tokens):
+        if config.CONTINUOUS_BATCHING_ENABLED:
+            return self.submit(image_path, prompt, base_size, image_size, crop_mode, max_new_tokens).result()
+
         print("Calling model's internal .infer() method...")
         try:
-            result_text = self.model.infer(
-                tokenizer=self.tokenizer,
-                prompt=prompt,
-                image_file=image_path,
-                output_path=self.output_path, # Use dynamically configured output path
-                base_size=config.BASE_SIZE,
-                image_size=config.IMAGE_SIZE,
-                crop_mode=config.CROP_MODE,
-                save_results=False,
-                test_compress=False,
-                eval_mode=True
-            )
+            reservation = contextlib.nullcontext()
+            if self.memory_budget is not None:
+                (base_size, image_size, crop_mode), estimate = self.memory_budget.plan(
+                    image_path, (base_size, image_size, crop_mode), max_new_tokens)
+                reservation = self.memory_budget.reserve(estimate["total"], os.path.basename(image_path),
+                                                         timeout=config.MEMORY_ADMISSION_TIMEOUT)
+            with reservation, self.routing_context(prompt, (base_size, image_size, crop_mode)):
+                result_text = self.model.infer(
+                    tokenizer=self.tokenizer,
+                    prompt=prompt,
+                    image_file=image_path,
+                    output_path=self.output_path, # Use dynamically configured output path
+                    base_size=base_size,
+                    image_size=image_size,
+                    crop_mode=crop_mode,
+                    save_results=False,
+                    test_compress=False,
+                    eval_mode=True,
+                    max_new_tokens=max_new_tokens
+                )
             print("Inference call complete.")
             return result_text
         except Exception as e:
             logger.error(f"An error occurred during model.infer(): {e}", exc_info=True)
-            raise
\ No newline at end of file
+            raise
+
+    def infer_pages(self, image_paths, prompt: str, base_size=None, image_size=None, crop_mode=None,
+                    priority="bulk", total_pages=None, max_new_tokens=None):
+        """
+        Runs inference over a sequence of page images and yields (index, image_path, result_text)
+        in page order. With PIPELINE_ENABLED the vision stage of the next page overlaps with
+        decoding of the current one. With PRIORITY_SCHEDULING_ENABLED the pages are queued in the
+        priority scheduler instead, so higher-priority work can run between them.
+        """
+        if not self.model or not self.tokenizer:
+            raise RuntimeError("Model or tokenizer is not loaded.")
+
+        mode = self._resolve_mode(base_size, image_size, crop_mode)
+
+        if config.PRIORITY_SCHEDULING_ENABLED:
+            yield from self.get_scheduler().submit_pages(image_paths, prompt, mode, priority, total_pages,
+                                                         max_new_tokens).results()
+            return
+
+        if config.CONTINUOUS_BATCHING_ENABLED:
+            yield from self._infer_pages_batched(image_paths, prompt, mode, max_new_tokens)
+            return
+
+        if not config.PIPELINE_ENABLED:
+            for index, image_path in enumerate(image_paths):
+                yield index, image_path, self.run_page(image_path, prompt, *mode, max_new_tokens=max_new_tokens)
+            return
+
+        from .pipeline import PipelinedOCR
+        pipeline = PipelinedOCR(
+            self,
+            vision_workers=config.PIPELINE_VISION_WORKERS,
+            queue_size=config.PIPELINE_QUEUE_SIZE,
+        )
+        yield from pipeline.run(image_paths, prompt, *mode, max_new_tokens=max_new_tokens)
+
+    def routing_context(self, prompt, mode):
+        """Attributes MoE routing on this thread to the task/mode of `prompt` and `mode`."""
+        if self.routing_telemetry is None:
+            return contextlib.nullcontext()
+        from .routing_telemetry import context_key
+        return self.routing_telemetry.context(context_key(prompt, *mode))
+
+    def export_routing_telemetry(self, path=None):
+        """Writes the routing telemetry as JSON. Returns the path, or None when it is disabled."""
+        if self.routing_telemetry is None:
+            return None
+        path = path or config.ROUTING_TELEMETRY_PATH or os.path.join(self.output_path, "routing_telemetry.json")
+        return self.routing_telemetry.export_json(path)
+
+    def profile_capture(self, label):
+        """Profiles the enclosed page if a capture is armed; warmup pages are never captured."""
+        if self._warming_up:
+            return contextlib.nullcontext()
+        return self.profiler.capture(label)
+
+    def profile_next(self, requests):
+        """Runs the next `requests` pages under torch.profiler. Returns the armed count."""
+        armed = self.profiler.arm(requests)
+        if armed:
+            print(f"Profiling the next {armed} page(s) into {self.profiler.output_dir}.")
+        return armed
+
+    def memory_report(self):
+        """Memory budget status plus estimated versus observed peaks, or None when it is disabled."""
+        if self.memory_budget is None:
+            return None
+        return {**self.memory_budget.status(), **self.memory_budget.report()}
+
+    def get_scheduler(self):
+        """Returns the priority scheduler, starting it on first use."""
+        if self.priority_scheduler is None:
+            from .scheduler import PriorityScheduler
+            workers = config.BATCH_MAX_SIZE if config.CONTINUOUS_BATCHING_ENABLED else 1
+            self.priority_scheduler = PriorityScheduler(self, workers=workers).start()
+        return self.priority_scheduler
+
+    def get_batch_scheduler(self):
+        """Returns the continuous batching scheduler, starting it on first use."""
+        if self.batch_scheduler is None:
+            from .batching import ContinuousBatchScheduler
+            self.batch_scheduler = ContinuousBatchScheduler(
+                self.model,
+                self.tokenizer,
+                max_batch_size=config.BATCH_MAX_SIZE,
+                max_prefills_per_step=config.BATCH_MAX_PREFILLS_PER_STEP,
+                max_new_tokens=config.BATCH_MAX_NEW_TOKENS,
+                telemetry=self.routing_telemetry,
+                memory_budget=self.memory_budget,
+            ).start()
+        return self.batch_scheduler
+
+    def submit(self, image_path: str, prompt: str, base_size=None, image_size=None, crop_mode=None, max_new_tokens=None):
+        """
+        Submits one page to the continuous batching scheduler.
+        Returns a concurrent.futures.Future resolving to the recognized text.
+        """
+        if not self.model or not self.tokenizer:
+            raise RuntimeError("Model or tokenizer is not loaded.")
+
+        base_size, image_size, crop_mode = self._resolve_mode(base_size, image_size, crop_mode)
+        return self.get_batch_scheduler().submit(image_path, prompt, base_size, image_size, crop_mode, max_new_tokens)
+
+    def _infer_pages_batched(self, image_paths, prompt, mode, max_new_tokens):
+        # Keep a bounded window of pages in the scheduler so long documents don't load all at once.
+        window = 2 * config.BATCH_MAX_SIZE
+        in_flight = []
+        for index, image_path in enumerate(image_paths):
+            in_flight.append((index, image_path, self.submit(image_path, prompt, *mode, max_new_tokens)))
+            if len(in_flight) >= window:
+                index, image_path, future = in_flight.pop(0)
+                yield index, image_path, future.result()
+        for index, image_path, future in in_flight:
+            yield index, image_path, future.result()
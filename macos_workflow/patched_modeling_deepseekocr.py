@@ -32,20 +32,19 @@ from .configuration_deepseek_v2 import DeepseekV2Config
 from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutputWithPast
 from typing import List, Optional, Tuple, Union
 from transformers.cache_utils import Cache
-import requests
 from PIL import Image, ImageOps, ImageDraw, ImageFont
-from io import BytesIO
 import torch
 import torch.nn as nn
 from torch.nn import CrossEntropyLoss
-from torchvision import transforms
-from torchvision.transforms.functional import InterpolationMode
 import os
 from .deepencoder import build_sam_vit_b, build_clip_l, MlpProjector
 from addict import Dict
 from transformers import TextStreamer
 from .conversation import get_conv_template
+from .resolution import (candidate_grids, find_closest_aspect_ratio, pruned_window, required_scale,
+                         select_crop_grid, vision_token_count)
 from abc import ABC
+import contextlib
 import math
 import re
 from tqdm import tqdm
@@ -53,10 +52,18 @@ import numpy as np
 import time
 
 
-def load_image(image_path):
-
+def load_image(image_path, base_size=None, image_size=None, crop_mode=None):
+    """
+    Opens an image and applies its EXIF orientation.
+    When the resolution mode is given, JPEGs are decoded at a reduced scale (`draft`) and
+    pyramidal TIFFs are read from a reduced level, as long as the result is still at least as
+    large as what `infer` resizes the image to for that mode.
+    """
     try:
         image = Image.open(image_path)
+
+        if base_size is not None:
+            _reduce_on_decode(image, base_size, image_size, crop_mode)
         
         corrected_image = ImageOps.exif_transpose(image)
         
@@ -70,6 +77,59 @@ def load_image(image_path):
             return None
 
 
+def required_input_size(width, height, base_size=1024, image_size=640, crop_mode=True):
+    """
+    Smallest size with the same aspect ratio at which `infer` still gets every pixel it keeps
+    for this resolution mode. Returns the input size when no reduction is possible.
+    """
+    scale = required_scale(width, height, base_size, image_size, crop_mode)
+    if scale >= 1:
+        return width, height
+    return math.ceil(width * scale), math.ceil(height * scale)
+
+
+def _keeps_crop_grid(size, original_size, crop_mode):
+    return not crop_mode or select_crop_grid(*size) == select_crop_grid(*original_size)
+
+
+def _reduce_on_decode(image, base_size, image_size, crop_mode):
+    width, height = image.size
+    # EXIF orientations 5-8 swap the axes after exif_transpose
+    transposed = image.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+    if transposed:
+        width, height = height, width
+
+    min_width, min_height = required_input_size(width, height, base_size, image_size, crop_mode)
+    if (min_width, min_height) == (width, height):
+        return
+
+    def acceptable(size):
+        oriented = (size[1], size[0]) if transposed else size
+        return oriented[0] >= min_width and oriented[1] >= min_height and \
+            _keeps_crop_grid(oriented, (width, height), crop_mode)
+
+    if image.format == "JPEG":
+        # libjpeg can scale by 1/2, 1/4 or 1/8 while decoding
+        for reduction in (8, 4, 2):
+            size = (math.ceil(image.size[0] / reduction), math.ceil(image.size[1] / reduction))
+            if acceptable(size):
+                image.draft(image.mode, size)
+                return
+
+    elif image.format == "TIFF" and getattr(image, "n_frames", 1) > 1:
+        # Pyramidal TIFFs store reduced-resolution levels as extra frames
+        full_width, full_height = image.size
+        best_frame, best_area = 0, full_width * full_height
+        for frame in range(1, image.n_frames):
+            image.seek(frame)
+            level_width, level_height = image.size
+            is_level = image.tag_v2.get(254, 0) & 1 or \
+                abs(level_width / level_height - full_width / full_height) < 0.01
+            if is_level and level_width * level_height < best_area and acceptable(image.size):
+                best_frame, best_area = frame, level_width * level_height
+        image.seek(best_frame)
+
+
 def re_match(text):
     pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
     matches = re.findall(pattern, text, re.DOTALL)
@@ -181,33 +241,12 @@ def process_image_with_refs(image, ref_texts, output_path):
 
 
 
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    # print(f'width: {width}, height: {height}, best_ratio: {best_ratio}')
-    return best_ratio
-
-
 def dynamic_preprocess(image, min_num=2, max_num=9, image_size=640, use_thumbnail=False):
     orig_width, orig_height = image.size
     aspect_ratio = orig_width / orig_height
 
     # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    target_ratios = candidate_grids(min_num, max_num)
 
     # find the closest aspect ratio to the target
     target_aspect_ratio = find_closest_aspect_ratio(
@@ -241,6 +280,8 @@ def dynamic_preprocess(image, min_num=2, max_num=9, image_size=640, use_thumbnai
 
 
 def normalize_transform(mean, std):
+    # torchvision is only needed once images are preprocessed
+    from torchvision import transforms
     if mean is None and std is None:
         transform = None
     elif mean is None and std is not None:
@@ -293,7 +334,7 @@ def text_encode(tokenizer, text: str, bos: bool = True, eos: bool = False):
 
     return t
 
-def load_pil_images(conversations: List[Dict[str, str]]) -> List[Image.Image]:
+def load_pil_images(conversations: List[Dict[str, str]], base_size=None, image_size=None, crop_mode=None) -> List[Image.Image]:
     """
 
     Args:
@@ -307,6 +348,9 @@ def load_pil_images(conversations: List[Dict[str, str]]) -> List[Image.Image]:
                 {"role": "Assistant", "content": ""},
             ]
 
+        base_size, image_size, crop_mode: the resolution mode, if known, so large images can be
+            decoded at a reduced size (see `load_image`).
+
     Returns:
         pil_images (List[PIL.Image.Image]): the list of PIL images.
 
@@ -325,7 +369,7 @@ def load_pil_images(conversations: List[Dict[str, str]]) -> List[Image.Image]:
             # exit()
             
             # pil_img = Image.open(image_path)
-            pil_img = load_image(image_path)
+            pil_img = load_image(image_path, base_size, image_size, crop_mode)
             pil_img = pil_img.convert("RGB")
             pil_images.append(pil_img)
 
@@ -352,6 +396,7 @@ class BasicImageTransform(BaseTransform):
         std: Optional[Tuple[float, float, float]] = (0.5, 0.5, 0.5),
         normalize: bool = True
     ):
+        from torchvision import transforms
         self.mean = mean
         self.std = std
     
@@ -398,174 +443,203 @@ class DeepseekOCRModel(DeepseekV2Model):
 
 
     
-    def forward(
-        self,
-        input_ids: torch.LongTensor = None,
-        attention_mask: Optional[torch.Tensor] = None,
-        position_ids: Optional[torch.LongTensor] = None,
-        past_key_values: Optional[List[torch.FloatTensor]] = None,
-        inputs_embeds: Optional[torch.FloatTensor] = None,
-        use_cache: Optional[bool] = None,
-        output_attentions: Optional[bool] = None,
-        output_hidden_states: Optional[bool] = None,
-        images: Optional[torch.FloatTensor] = None,
-        images_seq_mask: Optional[torch.FloatTensor] = None,
-        images_spatial_crop: Optional[torch.FloatTensor] = None,
-        return_dict: Optional[bool] = None,
-    ) -> Union[Tuple, BaseModelOutputWithPast]:
-
-
-
-
-        if inputs_embeds is None:
-            # inputs_embeds = self.embed_tokens(input_ids)
-            inputs_embeds = self.get_input_embeddings()(input_ids)
-
-
-
-        sam_model = getattr(self, 'sam_model', None)
-        # sam_model = self.sam_model
-        vision_model = getattr(self, 'vision_model', None)
-
-
+    def _encode_views(self, views):
+        """Runs a batch of same-sized views through SAM, CLIP and the projector."""
+        # An external backend (e.g. ONNX Runtime) may take over view sizes it supports
+        backend = getattr(self, 'vision_backend', None)
+        if backend is not None:
+            features = backend(views)
+            if features is not None:
+                return features
+
+        sam_model = self.sam_model
+        vision_model = self.vision_model
+
+        # Align input dtype with SAM module weights to avoid BF16/FP32 mismatch on MPS
+        try:
+            _sam_dtype = _dsocr_first_param_dtype(sam_model, _dsocr_torch.float32)
+            views = views.to(_sam_dtype)
+        except Exception:
+            pass
+        with torch.profiler.record_function("ocr.sam"):
+            features_1 = sam_model(views)
+        with torch.profiler.record_function("ocr.clip"):
+            features_2 = vision_model(views, features_1)
+        with torch.profiler.record_function("ocr.projector"):
+            features = torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1)
+            return self.projector(features)
+
+    def _encode_views_memoized(self, views):
+        """
+        `_encode_views` with uniform views (blank margin tiles) served from a cache keyed by view
+        size and fill value, so only views with content go through the encoder.
+        """
+        if not getattr(self, 'blank_tile_memo', True):
+            return self._encode_views(views)
+
+        flat = views.flatten(2)
+        uniform = (flat == flat[:, :, :1]).all(dim=2).all(dim=1).tolist()
+        if not any(uniform):
+            return self._encode_views(views)
+
+        cache = self.__dict__.setdefault('_blank_tile_cache', {})
+        keys = [(views.shape[-1], tuple(flat[i, :, 0].tolist())) if u else None for i, u in enumerate(uniform)]
+        new_keys = {}
+        for i, key in enumerate(keys):
+            if key is not None and key not in cache:
+                new_keys.setdefault(key, i)
+        if new_keys:
+            encoded_blank = self._encode_views(views[list(new_keys.values())])
+            for key, features in zip(new_keys, encoded_blank):
+                cache[key] = features
+        blank_features = {key: cache[key] for key in keys if key is not None}
+        if len(cache) > 64:
+            # Not a margin colour in practice; keep the cache small
+            cache.clear()
+
+        content = [i for i, key in enumerate(keys) if key is None]
+        encoded = iter(self._encode_views(views[content]) if content else ())
+        return torch.stack([blank_features[key] if key is not None else next(encoded) for key in keys])
+
+    @staticmethod
+    def _crop_to_window(global_features, crop_shape):
+        """
+        Keeps the token rows/columns of the global view that overlap the image. The window is
+        stored after the crop grid in `images_spatial_crop` when padding pruning is on.
+        """
+        if len(crop_shape) <= 2:
+            return global_features
+        row_start, row_end, col_start, col_end = [int(x) for x in crop_shape[2:6]]
+        return global_features[row_start:row_end, col_start:col_end]
 
-        if sam_model is not None and (input_ids.shape[1] != 1 or self.training) and torch.sum(images[0][1]).item() != 0:
+    def encode_images(self, images, images_spatial_crop):
+        """
+        Encodes every (patches, global view) pair into the flat feature sequence that
+        fills the image-token slots of `images_seq_mask`, one tensor per batch entry.
+        """
+        image_features = []
 
-            idx = 0
-            
-            # sam_model = torch.jit.script(sam_model)
-            
-            # start_time = time.time()
+        with torch.no_grad():
+        # with torch.inference_mode(): 
             for image, crop_shape in zip(images, images_spatial_crop):
-                images_in_this_batch = []
-
                 patches = image[0]
                 image_ori = image[1]
 
-                with torch.no_grad():
-                # with torch.inference_mode(): 
-                    
-                    if torch.sum(patches).item() != 0:
-                        # P, C, H, W = patches.shape
-                        crop_flag = 1
-                        # Align input dtype with SAM module weights to avoid BF16/FP32 mismatch on MPS
-                        try:
-                            _sam_dtype = _dsocr_first_param_dtype(sam_model, _dsocr_torch.float32)
-                            patches = patches.to(_sam_dtype)
-                        except Exception:
-                            pass
-                        local_features_1 = sam_model(patches)
+                if torch.sum(patches).item() != 0:
+                    # P, C, H, W = patches.shape
+                    local_features = self._encode_views_memoized(patches)
+                    global_features = self._encode_views_memoized(image_ori)
 
-                        local_features_2 = vision_model(patches, local_features_1)  
-                        # vit_time = time.time()
-                        local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                        local_features = self.projector(local_features)
+                    print('=====================')
+                    print('BASE: ', global_features.shape)
+                    print('PATCHES: ', local_features.shape)
+                    print('=====================')
 
+                    _, hw, n_dim = global_features.shape
+                    h = w = int(hw ** 0.5)
 
-                        # Align input dtype with SAM module weights to avoid BF16/FP32 mismatch on MPS
-                        try:
-                            _sam_dtype = _dsocr_first_param_dtype(sam_model, _dsocr_torch.float32)
-                            image_ori = image_ori.to(_sam_dtype)
-                        except Exception:
-                            pass
-                        global_features_1 = sam_model(image_ori)
-                        global_features_2 = vision_model(image_ori, global_features_1) 
-                        global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                        global_features = self.projector(global_features)
+                    _2, hw2, n_dim2 = local_features.shape
+                    h2 = w2 = int(hw2 ** 0.5)
 
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('PATCHES: ', local_features.shape)
-                        print('=====================')
+                    width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
 
-                        _, hw, n_dim = global_features.shape
-                        h = w = int(hw ** 0.5)
+                    global_features = self._crop_to_window(global_features.view(h, w, n_dim), crop_shape)
 
-                        _2, hw2, n_dim2 = local_features.shape
-                        h2 = w2 = int(hw2 ** 0.5)
+                    global_features = torch.cat(
+                        [global_features, self.image_newline[None, None, :].expand(global_features.shape[0], 1, n_dim)], dim=1
+                    )
 
-                        width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
+                    global_features = global_features.view(-1, n_dim)
 
-                        global_features = global_features.view(h, w, n_dim)
 
-                        global_features = torch.cat(
-                            [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                        )
+                    local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
+                    local_features = torch.cat(
+                        [local_features, self.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], dim=1
+                    )
+                    local_features = local_features.view(-1, n_dim2)
 
-                        global_features = global_features.view(-1, n_dim)
+                    global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
 
+                else:
+                    global_features = self._encode_views_memoized(image_ori)
+                    print('=====================')
+                    print('BASE: ', global_features.shape)
+                    print('NO PATCHES')
+                    print('=====================')
+                    _, hw, n_dim = global_features.shape
+                    h = w = int(hw ** 0.5)
 
-                        local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
-                        local_features = torch.cat(
-                            [local_features, self.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], dim=1
-                        )
-                        local_features = local_features.view(-1, n_dim2)
 
-                        global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
+                    global_features = self._crop_to_window(global_features.view(h, w, n_dim), crop_shape)
 
-                        # end_time = time.time()
+                    global_features = torch.cat(
+                        [global_features, self.image_newline[None, None, :].expand(global_features.shape[0], 1, n_dim)], dim=1
+                    )
 
-                        # print('sam: ', sam_time - start_time)
-                        # print('vit: ', vit_time - sam_time)
-                        # print('all: ', end_time - start_time)
+                    global_features = global_features.view(-1, n_dim)
 
-                        # exit()
-                   
-                    else:
-                        # Align input dtype with SAM module weights to avoid BF16/FP32 mismatch on MPS
-                        try:
-                            _sam_dtype = _dsocr_first_param_dtype(sam_model, _dsocr_torch.float32)
-                            image_ori = image_ori.to(_sam_dtype)
-                        except Exception:
-                            pass
-                        global_features_1 = sam_model(image_ori)
-                        global_features_2 = vision_model(image_ori, global_features_1) 
-                        global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                        global_features = self.projector(global_features)
-                        print('=====================')
-                        print('BASE: ', global_features.shape)
-                        print('NO PATCHES')
-                        print('=====================')
-                        _, hw, n_dim = global_features.shape
-                        h = w = int(hw ** 0.5)
+                    global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
+                image_features.append(global_local_features)
 
-                        global_features = global_features.view(h, w, n_dim)
+        return image_features
 
-                        global_features = torch.cat(
-                            [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                        )
+    
+    def forward(
+        self,
+        input_ids: torch.LongTensor = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_values: Optional[List[torch.FloatTensor]] = None,
+        inputs_embeds: Optional[torch.FloatTensor] = None,
+        use_cache: Optional[bool] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        images: Optional[torch.FloatTensor] = None,
+        images_seq_mask: Optional[torch.FloatTensor] = None,
+        images_spatial_crop: Optional[torch.FloatTensor] = None,
+        image_features: Optional[List[torch.FloatTensor]] = None,
+        return_dict: Optional[bool] = None,
+    ) -> Union[Tuple, BaseModelOutputWithPast]:
 
-                        global_features = global_features.view(-1, n_dim)
 
-                        global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
-                    images_in_this_batch.append(global_local_features)
-                
 
-                # print(inputs_embeds.shape)
+        if inputs_embeds is None:
+            # inputs_embeds = self.embed_tokens(input_ids)
+            inputs_embeds = self.get_input_embeddings()(input_ids)
 
-                if images_in_this_batch:
-                    images_in_this_batch = torch.cat(images_in_this_batch, dim=0)
-                    # exit()
 
-                    # --- MPS-safe scatter replacement ---
-                    try:
-                        inputs_embeds[idx].masked_scatter_(images_seq_mask[idx].unsqueeze(-1).to(images_in_this_batch.device), images_in_this_batch)
-                    except Exception as _dsocr_e:
-                        _mask = images_seq_mask[idx]
-                        inputs_embeds[idx] = _dsocr_mps_rowwise_assign_(inputs_embeds[idx], _mask, images_in_this_batch)
-                    # --- END MPS-safe scatter replacement ---
 
-                idx += 1
+        sam_model = getattr(self, 'sam_model', None)
+        # sam_model = self.sam_model
+        is_prefill = inputs_embeds.shape[1] != 1 or self.training
+
+        # `image_features` lets a caller encode the images ahead of time (e.g. on another
+        # thread) and only scatter them here.
+        if image_features is None and sam_model is not None and images is not None and is_prefill and torch.sum(images[0][1]).item() != 0:
+            image_features = self.encode_images(images, images_spatial_crop)
+
+        if image_features is not None and is_prefill:
+            for idx, images_in_this_batch in enumerate(image_features):
+                images_in_this_batch = images_in_this_batch.to(device=inputs_embeds.device, dtype=inputs_embeds.dtype)
+
+                # --- MPS-safe scatter replacement ---
+                try:
+                    inputs_embeds[idx].masked_scatter_(images_seq_mask[idx].unsqueeze(-1).to(images_in_this_batch.device), images_in_this_batch)
+                except Exception as _dsocr_e:
+                    _mask = images_seq_mask[idx]
+                    inputs_embeds[idx] = _dsocr_mps_rowwise_assign_(inputs_embeds[idx], _mask, images_in_this_batch)
+                # --- END MPS-safe scatter replacement ---
             
 
-        return super(DeepseekOCRModel, self).forward(
-            input_ids=None, attention_mask=attention_mask, past_key_values=past_key_values,
-            inputs_embeds=inputs_embeds, use_cache=use_cache, position_ids = position_ids,
-            output_attentions=output_attentions, output_hidden_states=output_hidden_states,
-            return_dict=return_dict
-        )
+        with torch.profiler.record_function("ocr.prefill" if is_prefill else "ocr.decode"):
+            return super(DeepseekOCRModel, self).forward(
+                input_ids=None, attention_mask=attention_mask, past_key_values=past_key_values,
+                inputs_embeds=inputs_embeds, use_cache=use_cache, position_ids = position_ids,
+                output_attentions=output_attentions, output_hidden_states=output_hidden_states,
+                return_dict=return_dict
+            )
     
 
 class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
@@ -604,6 +678,7 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
         images: Optional[torch.FloatTensor] = None,
         images_seq_mask: Optional[torch.FloatTensor] = None,
         images_spatial_crop: Optional[torch.FloatTensor] = None,
+        image_features: Optional[List[torch.FloatTensor]] = None,
         return_dict: Optional[bool] = None,
         
     ) -> Union[Tuple, CausalLMOutputWithPast]:
@@ -627,6 +702,7 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
             images=images,
             images_seq_mask = images_seq_mask,
             images_spatial_crop = images_spatial_crop,
+            image_features = image_features,
             return_dict=return_dict
             
         )
@@ -738,6 +814,7 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
                 "images": kwargs.get("images", None),
                 "images_seq_mask": kwargs.get("images_seq_mask", None),
                 "images_spatial_crop": kwargs.get("images_spatial_crop", None),
+                "image_features": kwargs.get("image_features", None),
             }
         )
         return model_inputs
@@ -753,17 +830,61 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
 
 
 
-    def infer(self, tokenizer, prompt='', image_file='', output_path = '', base_size=1024, image_size=640, crop_mode=True, test_compress=False, save_results=False, eval_mode=False):
-        self.disable_torch_init()
+    def _ocr_token_template(self, tokenizer, prompt, base_size, image_size, crop_mode, crop_grids):
+        """
+        `input_ids` and `images_seq_mask` for a formatted prompt whose images use `crop_grids`
+        (rows of `images_spatial_crop`, including the global-view window when padding is pruned).
+        Templates are cached per (prompt, resolution mode, crop grids); callers get copies.
+        """
+        key = (id(tokenizer), prompt, base_size, image_size, crop_mode, crop_grids)
+        cache = self.__dict__.setdefault('_ocr_template_cache', {})
+        template = cache.get(key)
+        if template is None:
+            template = self._build_ocr_template(tokenizer, prompt, base_size, image_size, crop_mode, crop_grids)
+            if len(cache) >= 256:
+                cache.clear()
+            cache[key] = template
+        input_ids, images_seq_mask = template
+        return input_ids.clone(), images_seq_mask.clone()
+
+    @staticmethod
+    def _build_ocr_template(tokenizer, prompt, base_size, image_size, crop_mode, crop_grids):
+        image_token_id = 128815
 
+        """the bos token, then text splits and image tokens"""
+        bos_id = 0
+        token_parts = [torch.tensor([bos_id], dtype=torch.long)]
+        mask_parts = [torch.zeros(1, dtype=torch.bool)]
+
+        def add_text(text_sep):
+            tokenized_sep = torch.tensor(text_encode(tokenizer, text_sep, bos=False, eos=False), dtype=torch.long)
+            token_parts.append(tokenized_sep)
+            mask_parts.append(torch.zeros(len(tokenized_sep), dtype=torch.bool))
+
+        text_splits = prompt.split('<image>')
+        for text_sep, crop_grid in zip(text_splits, crop_grids):
+            add_text(text_sep)
+            num_image_tokens = vision_token_count(base_size, image_size, crop_mode, crop_grid[:2], crop_grid[2:])
+            token_parts.append(torch.full((num_image_tokens,), image_token_id, dtype=torch.long))
+            mask_parts.append(torch.ones(num_image_tokens, dtype=torch.bool))
+        add_text(text_splits[-1])
+
+        return torch.cat(token_parts), torch.cat(mask_parts)
+
+    def prepare_ocr_inputs(self, tokenizer, prompt='', image_file='', base_size=1024, image_size=640, crop_mode=True):
+        """
+        Builds the prompt tokens, `images_seq_mask` and the normalized image views for one request.
+        Everything stays on the CPU, so this can run on a different thread than generation.
+        """
+        with torch.profiler.record_function("ocr.preprocess"):
+            return self._prepare_ocr_inputs(tokenizer, prompt, image_file, base_size, image_size, crop_mode)
+
+    def _prepare_ocr_inputs(self, tokenizer, prompt, image_file, base_size, image_size, crop_mode):
         # 根据模型设备类型选择数据类型
         model_device = next(self.parameters()).device
         
         image_dtype = torch.bfloat16 if model_device.type == "cuda" else torch.float32
 
-        os.makedirs(output_path, exist_ok=True)
-        os.makedirs(f'{output_path}/images', exist_ok=True)
-
         if prompt and image_file:
             conversation = [
                 {
@@ -798,9 +919,10 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
         
         prompt = format_messages(conversations=conversation, sft_format='plain', system_prompt='')
 
-        patch_size = 16
-        downsample_ratio = 4
-        images = load_pil_images(conversation)
+        if getattr(self, 'reduced_decode', False):
+            images = load_pil_images(conversation, base_size, image_size, crop_mode)
+        else:
+            images = load_pil_images(conversation)
 
         valid_img_tokens = 0
         ratio = 1
@@ -813,20 +935,14 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
     
 
         image_transform=BasicImageTransform(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5), normalize=True)
-        images_seq_mask = []
 
-        image_token = '<image>'
-        image_token_id = 128815
-        text_splits = prompt.split(image_token)
+        # Opt-in: drop global-view tokens that only cover the padding added by ImageOps.pad
+        prune_padding = getattr(self, 'prune_padding', False)
 
-        images_list, images_crop_list, images_seq_mask = [], [], []
-        tokenized_str = []
+        images_list, images_crop_list = [], []
         images_spatial_crop = []
-        for text_sep, image in zip(text_splits, images):
-
-            tokenized_sep = text_encode(tokenizer, text_sep, bos=False, eos=False)
-            tokenized_str += tokenized_sep
-            images_seq_mask += [False] * len(tokenized_sep)
+        for image in images:
+            window = pruned_window(*image.size, base_size, image_size, crop_mode) if prune_padding else ()
 
             if crop_mode:
 
@@ -863,7 +979,7 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
 
                 width_crop_num, height_crop_num = crop_ratio
 
-                images_spatial_crop.append([width_crop_num, height_crop_num])
+                images_spatial_crop.append([width_crop_num, height_crop_num, *window])
                 
                 
                 if width_crop_num > 1 or height_crop_num > 1:
@@ -875,24 +991,6 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
                 if image_size == 640:
                     valid_img_tokens += len(images_crop_list) * 100
 
-                num_queries = math.ceil((image_size // patch_size) / downsample_ratio)
-                num_queries_base = math.ceil((base_size // patch_size) / downsample_ratio)
-
-
-
-                """add image tokens"""
-
-                
-
-                tokenized_image = ([image_token_id] * num_queries_base + [image_token_id]) * num_queries_base
-                tokenized_image += [image_token_id]
-                if width_crop_num > 1 or height_crop_num > 1:
-                    tokenized_image += ([image_token_id] * (num_queries * width_crop_num) + [image_token_id]) * (
-                                num_queries * height_crop_num)
-                tokenized_str += tokenized_image
-                images_seq_mask += [True] * len(tokenized_image)
-                # num_image_tokens.append(len(tokenized_image))
-
             else:
                 # best_width, best_height = self.image_size, self.image_size
                 # print(image.size, (best_width, best_height)) # check the select_best_resolutions func
@@ -917,39 +1015,11 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
 
                 width_crop_num, height_crop_num = 1, 1
 
-                images_spatial_crop.append([width_crop_num, height_crop_num])
-
-
-                """add image tokens"""
-                num_queries = math.ceil((image_size // patch_size) / downsample_ratio)
-
-                tokenized_image = ([image_token_id] * num_queries + [image_token_id]) * num_queries
-                tokenized_image += [image_token_id]
-                # tokenized_image += ([self.image_token_id] * (num_queries * width_crop_num) + [self.image_token_id]) * (
-                #             num_queries * height_crop_num)
-                tokenized_str += tokenized_image
-                images_seq_mask += [True] * len(tokenized_image)
-                # num_image_tokens.append(len(tokenized_image))
-        
-
-        """process the last text split"""
-        tokenized_sep = text_encode(tokenizer, text_splits[-1], bos=False, eos=False)
-        tokenized_str += tokenized_sep
-        images_seq_mask += [False] * len(tokenized_sep)
-
-        """add the bos tokens"""
-        bos_id = 0
-        tokenized_str = [bos_id] + tokenized_str 
-        images_seq_mask = [False] + images_seq_mask
+                images_spatial_crop.append([width_crop_num, height_crop_num, *window])
 
-
-
-        input_ids = torch.LongTensor(tokenized_str)
-
-
-        
-
-        images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
+        """add the text and image tokens"""
+        input_ids, images_seq_mask = self._ocr_token_template(
+            tokenizer, prompt, base_size, image_size, crop_mode, tuple(map(tuple, images_spatial_crop)))
 
 
         if len(images_list) == 0:
@@ -967,106 +1037,131 @@ class DeepseekOCRForCausalLM(DeepseekV2ForCausalLM):
 
 
 
-        # 获取模型设备
+        return Dict(
+            conversation=conversation,
+            input_ids=input_ids,
+            images_seq_mask=images_seq_mask,
+            images_crop=images_crop,
+            images_ori=images_ori,
+            images_spatial_crop=images_spatial_crop,
+            image_draw=image_draw,
+            valid_img_tokens=valid_img_tokens,
+        )
+
+    def encode_ocr_inputs(self, inputs):
+        """
+        Runs the vision encoder for inputs built by `prepare_ocr_inputs`.
+        Returns the `image_features` to hand to `generate_ocr`, or None for text-only prompts.
+        """
         model_device = next(self.parameters()).device
-        model_dtype = next(self.parameters()).dtype
 
+        if torch.sum(inputs.images_ori).item() == 0:
+            return None
+
+        images = [(inputs.images_crop.to(model_device), inputs.images_ori.to(model_device))]
+        with self._autocast_context(model_device):
+            return self.model.encode_images(images, inputs.images_spatial_crop)
+
+    def _autocast_context(self, model_device):
         # 根据设备类型选择是否使用 autocast
-        use_autocast = model_device.type == "cuda"
+        if model_device.type == "cuda":
+            return torch.autocast("cuda", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
 
-        if not eval_mode:
-            streamer = NoEOSTextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=False)
-            if use_autocast:
-                with torch.autocast("cuda", dtype=torch.bfloat16):
-                    with torch.no_grad():
-                        output_ids = self.generate(
-                            input_ids.unsqueeze(0).to(model_device),
-                            images=[(images_crop.to(model_device), images_ori.to(model_device))],
-                            images_seq_mask = images_seq_mask.unsqueeze(0).to(model_device),
-                            images_spatial_crop = images_spatial_crop,
-                            # do_sample=False,
-                            # num_beams = 1,
-                            temperature=0.0,
-                            eos_token_id=tokenizer.eos_token_id,
-                            streamer=streamer,
-                            max_new_tokens=8192,
-                            no_repeat_ngram_size = 20,
-                            use_cache = True
-                            )
-            else:
-                with torch.no_grad():
-                    output_ids = self.generate(
-                        input_ids.unsqueeze(0).to(model_device),
-                        images=[(images_crop.to(model_device), images_ori.to(model_device))],
-                        images_seq_mask = images_seq_mask.unsqueeze(0).to(model_device),
-                        images_spatial_crop = images_spatial_crop,
-                        do_sample=False,
-                        num_beams = 1,
-                        temperature=0.0,
-                        eos_token_id=tokenizer.eos_token_id,
-                        pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
-                        streamer=streamer,
-                        max_new_tokens=4096,  # 减少最大token数
-                        min_new_tokens=1,
-                        no_repeat_ngram_size = 20,
-                        repetition_penalty=1.2,  # 添加重复惩罚
-                        use_cache = True
-                        )
+    @staticmethod
+    def ocr_decoding_settings(model_device, eval_mode=False):
+        """
+        The greedy-decoding settings `generate_ocr` uses on `model_device`: no_repeat_ngram_size,
+        max_new_tokens and, off CUDA, min_new_tokens and repetition_penalty.
+        """
+        settings = dict(no_repeat_ngram_size=35 if eval_mode else 20)
+        if model_device.type == "cuda":
+            settings['max_new_tokens'] = 8192
+        else:
+            settings.update(
+                max_new_tokens=4096,  # 减少最大token数
+                min_new_tokens=1,
+                repetition_penalty=1.2,  # 添加重复惩罚
+            )
+        return settings
+
+    def generate_ocr(self, tokenizer, inputs, image_features=None, eval_mode=False, max_new_tokens=None):
+        """
+        Generates the answer for inputs built by `prepare_ocr_inputs`.
+        Pass `image_features` from `encode_ocr_inputs` to skip the vision encoder here.
+        """
+        # 获取模型设备
+        model_device = next(self.parameters()).device
 
+        generation_kwargs = dict(
+            images_seq_mask = inputs.images_seq_mask.unsqueeze(0).to(model_device),
+            images_spatial_crop = inputs.images_spatial_crop,
+            temperature=0.0,
+            eos_token_id=tokenizer.eos_token_id,
+            use_cache = True,
+            **self.ocr_decoding_settings(model_device, eval_mode)
+        )
+        if image_features is not None:
+            generation_kwargs['image_features'] = image_features
         else:
-            if use_autocast:
-                with torch.autocast("cuda", dtype=torch.bfloat16):
-                    with torch.no_grad():
-                        output_ids = self.generate(
-                            input_ids.unsqueeze(0).to(model_device),
-                            images=[(images_crop.to(model_device), images_ori.to(model_device))],
-                            images_seq_mask = images_seq_mask.unsqueeze(0).to(model_device),
-                            images_spatial_crop = images_spatial_crop,
-                            # do_sample=False,
-                            # num_beams = 1,
-                            temperature=0.0,
-                            eos_token_id=tokenizer.eos_token_id,
-                            max_new_tokens=8192,
-                            no_repeat_ngram_size = 35,
-                            use_cache = True
-                            )
-            else:
-                with torch.no_grad():
-                    output_ids = self.generate(
-                        input_ids.unsqueeze(0).to(model_device),
-                        images=[(images_crop.to(model_device), images_ori.to(model_device))],
-                        images_seq_mask = images_seq_mask.unsqueeze(0).to(model_device),
-                        images_spatial_crop = images_spatial_crop,
-                        do_sample=False,
-                        num_beams = 1,
-                        temperature=0.0,
-                        eos_token_id=tokenizer.eos_token_id,
-                        pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
-                        max_new_tokens=4096,  # 减少最大token数
-                        min_new_tokens=1,
-                        no_repeat_ngram_size = 35,
-                        repetition_penalty=1.2,  # 添加重复惩罚
-                        use_cache = True
-                        )
-                
+            generation_kwargs['images'] = [(inputs.images_crop.to(model_device), inputs.images_ori.to(model_device))]
+
+        if model_device.type != "cuda":
+            generation_kwargs.update(
+                do_sample=False,
+                num_beams = 1,
+                pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+            )
+        if max_new_tokens is not None:
+            generation_kwargs['max_new_tokens'] = max_new_tokens
+
+        if not eval_mode:
+            generation_kwargs['streamer'] = NoEOSTextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=False)
+
+        with self._autocast_context(model_device):
+            with torch.no_grad():
+                output_ids = self.generate(
+                    inputs.input_ids.unsqueeze(0).to(model_device),
+                    **generation_kwargs
+                )
+
+        return output_ids
+
+    def decode_ocr_output(self, tokenizer, inputs, output_ids):
+        """Decodes the generated part of `output_ids` and strips the end-of-sentence marker."""
+        input_length = inputs.input_ids.shape[0]
+        outputs = tokenizer.decode(output_ids[0, input_length:])
+        stop_str = '<｜end▁of▁sentence｜>'
+        if outputs.endswith(stop_str):
+            outputs = outputs[:-len(stop_str)]
+        return outputs.strip()
+
+    def infer(self, tokenizer, prompt='', image_file='', output_path = '', base_size=1024, image_size=640, crop_mode=True, test_compress=False, save_results=False, eval_mode=False, max_new_tokens=None):
+        self.disable_torch_init()
+
+        os.makedirs(output_path, exist_ok=True)
+        os.makedirs(f'{output_path}/images', exist_ok=True)
+
+        inputs = self.prepare_ocr_inputs(tokenizer, prompt=prompt, image_file=image_file,
+                                         base_size=base_size, image_size=image_size, crop_mode=crop_mode)
+        output_ids = self.generate_ocr(tokenizer, inputs, eval_mode=eval_mode, max_new_tokens=max_new_tokens)
+
+        conversation = inputs.conversation
+        input_ids = inputs.input_ids
+        image_draw = inputs.image_draw
+        valid_img_tokens = inputs.valid_img_tokens
+        model_device = next(self.parameters()).device
 
         if '<image>' in conversation[0]['content'] and eval_mode:
-                input_length = input_ids.unsqueeze(0).to(model_device).shape[1]
-                outputs = tokenizer.decode(output_ids[0, input_length:])
-                stop_str = '<｜end▁of▁sentence｜>'
-                if outputs.endswith(stop_str):
-                    outputs = outputs[:-len(stop_str)]
                 # re_match
-                outputs = outputs.strip()
-
-                return outputs
+                return self.decode_ocr_output(tokenizer, inputs, output_ids)
 
         if '<image>' in conversation[0]['content'] and test_compress:
             input_length = input_ids.unsqueeze(0).to(model_device).shape[1]
             outputs = tokenizer.decode(output_ids[0, input_length:])
             pure_texts_outputs_token_length = len(text_encode(tokenizer, outputs, bos=False, eos=False))
             print('='*50)
-            print('image size: ', (w, h))
+            print('image size: ', image_draw.size)
             print('valid image tokens: ', int(valid_img_tokens))
             print('output texts tokens (valid): ', pure_texts_outputs_token_length)
             print('compression ratio: ', round(pure_texts_outputs_token_length/valid_img_tokens, 2))
@@ -0,0 +1,153 @@
+"""
+Staged execution for multi-page OCR jobs.
+
+The vision stage (image loading, preprocessing, SAM/CLIP encoding and projection) runs on
+its own thread pool while the language stage (prefill + decode) runs on the calling thread.
+A bounded queue between the two keeps at most `queue_size` encoded pages waiting, so the
+encoder works on page k+1 while the decoder is still generating page k.
+
+Both stages share torch's intra-op thread pool, whose size is process-wide; the split between
+them is set by the number of vision workers, each encoding one page at a time.
+"""
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config_macos as config
+
+logger = logging.getLogger(__name__)
+
+_END_OF_INPUT = object()
+
+
+class PipelinedOCR:
+    """
+    Runs pages through a two-stage pipeline on top of an initialized OCREngine.
+    Results are yielded in input order.
+    """
+    def __init__(self, engine, vision_workers=1, queue_size=2):
+        self.engine = engine
+        self.vision_workers = max(1, vision_workers)
+        self.queue_size = max(1, queue_size)
+
+    def _encode(self, image_path, prompt, base_size, image_size, crop_mode, max_new_tokens):
+        """
+        Vision stage: preprocessing plus SAM/CLIP/projector for one page. With a memory budget
+        the page is admitted here, and its reservation is held until it has been decoded.
+        """
+        model = self.engine.model
+        reservation = None
+        budget = self.engine.memory_budget
+        if budget is not None:
+            (base_size, image_size, crop_mode), estimate = budget.plan(image_path, (base_size, image_size, crop_mode),
+                                                                     max_new_tokens)
+            reservation = budget.reserve(estimate["total"], os.path.basename(image_path),
+                                         timeout=config.MEMORY_ADMISSION_TIMEOUT)
+        try:
+            inputs = model.prepare_ocr_inputs(
+                self.engine.tokenizer,
+                prompt=prompt,
+                image_file=image_path,
+                base_size=base_size,
+                image_size=image_size,
+                crop_mode=crop_mode,
+            )
+            return inputs, model.encode_ocr_inputs(inputs), (base_size, image_size, crop_mode), reservation
+        except BaseException:
+            if reservation is not None:
+                reservation.release()
+            raise
+
+    @staticmethod
+    def _put(pending, item, stop):
+        """Blocks on the bounded queue, giving up once the consumer has stopped."""
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed(self, image_paths, prompt, mode, max_new_tokens, executor, pending, stop):
+        try:
+            for index, image_path in enumerate(image_paths):
+                future = executor.submit(self._encode, image_path, prompt, *mode, max_new_tokens)
+                if not self._put(pending, (index, image_path, future), stop):
+                    future.add_done_callback(self._release_result)
+                    future.cancel()
+                    return
+        except Exception as e:
+            logger.error(f"Failed to read pipeline input: {e}", exc_info=True)
+            self._put(pending, e, stop)
+            return
+        self._put(pending, _END_OF_INPUT, stop)
+
+    @staticmethod
+    def _release_result(future):
+        """Releases the memory reservation of a page that was encoded but will not be decoded."""
+        if not future.cancelled() and future.exception() is None:
+            reservation = future.result()[3]
+            if reservation is not None:
+                reservation.release()
+
+    def _release_pending(self, pending):
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, tuple):
+                item[2].add_done_callback(self._release_result)
+
+    def run(self, image_paths, prompt, base_size, image_size, crop_mode, max_new_tokens=None):
+        """Yields (index, image_path, result_text) for every page in `image_paths`."""
+        model = self.engine.model
+        tokenizer = self.engine.tokenizer
+
+        print(f"Pipeline: {self.vision_workers} vision worker(s), queue size {self.queue_size}.")
+
+        pending = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(
+            max_workers=self.vision_workers,
+            thread_name_prefix="ocr-vision",
+        )
+        feeder = threading.Thread(
+            target=self._feed,
+            args=(iter(image_paths), prompt, (base_size, image_size, crop_mode), max_new_tokens, executor, pending, stop),
+            name="ocr-pipeline-feeder",
+            daemon=True,
+        )
+
+        feeder.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is _END_OF_INPUT:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                index, image_path, future = item
+                inputs, image_features, mode, reservation = future.result()
+                try:
+                    # The page's vision stage ran earlier on a vision worker; the capture holds
+                    # its decode, plus whatever the vision workers run for later pages meanwhile
+                    with self.engine.profile_capture(os.path.basename(image_path)), \
+                            self.engine.routing_context(prompt, mode):
+                        output_ids = model.generate_ocr(tokenizer, inputs, image_features=image_features, eval_mode=True,
+                                                        max_new_tokens=max_new_tokens)
+                    text = model.decode_ocr_output(tokenizer, inputs, output_ids)
+                finally:
+                    if reservation is not None:
+                        reservation.release()
+                yield index, image_path, text
+        finally:
+            stop.set()
+            feeder.join()
+            # Before waiting on the executor: a vision worker may be blocked on the memory budget
+            self._release_pending(pending)
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,96 @@
+"""
+On-demand torch.profiler capture of live requests.
+
+`ProfilerCapture.arm(n)` makes the next n pages run under `torch.profiler`. The model marks
+its phases with record_function ranges (ocr.preprocess, ocr.sam, ocr.clip, ocr.projector,
+ocr.prefill, ocr.decode), so they show up as spans in the trace and as rows in the table.
+Each captured page writes to the output directory:
+
+    <stamp>_<page>.json    Chrome trace (chrome://tracing or https://ui.perfetto.dev)
+    <stamp>_<page>.txt     top operators by self CPU time, and the ocr.* phase totals
+
+Arm it with PROFILE_NEXT_REQUESTS, the OCR_PROFILE_NEXT environment variable, or
+POST /admin/profile on the job API. One page is profiled at a time; pages that start while
+another is being captured run unprofiled and do not use up the count, and warmup pages are
+never captured.
+
+Single pages are captured around `OCREngine.run_page`, pipelined documents around each page's
+decode (its vision stage ran earlier on a vision worker). Under continuous batching the page
+is decoded on the scheduler thread, so its capture holds the whole batch's steps while the
+page is in flight.
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerCapture:
+    def __init__(self, output_dir, row_limit=30):
+        self.output_dir = output_dir
+        self.row_limit = row_limit
+        self.remaining = 0
+        self.captured = []
+        self._lock = threading.Lock()
+        self._active = False
+
+    def arm(self, requests):
+        """Profiles the next `requests` pages (replacing any count still pending)."""
+        with self._lock:
+            self.remaining = max(0, int(requests))
+        return self.remaining
+
+    def status(self):
+        with self._lock:
+            return {"remaining": self.remaining, "active": self._active, "captured": list(self.captured[-20:])}
+
+    def _claim(self):
+        with self._lock:
+            if self.remaining <= 0 or self._active:
+                return False
+            self.remaining -= 1
+            self._active = True
+            return True
+
+    def capture(self, label):
+        """Context manager profiling the enclosed page if the capture is armed."""
+        if not self._claim():
+            return contextlib.nullcontext()
+        return self._profile(label)
+
+    @contextlib.contextmanager
+    def _profile(self, label):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        base = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_{os.path.splitext(label)[0]}")
+        try:
+            with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as profiler:
+                yield
+            self._write(profiler, base, label)
+        finally:
+            with self._lock:
+                self._active = False
+
+    def _write(self, profiler, base, label):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            profiler.export_chrome_trace(base + ".json")
+            averages = profiler.key_averages()
+            phases = [event for event in averages if event.key.startswith("ocr.")]
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(f"{label}\n\nPhases (wall time on the profiled thread):\n")
+                for event in sorted(phases, key=lambda e: e.cpu_time_total, reverse=True):
+                    f.write(f"  {event.key:<16} {event.count:>6} calls  {event.cpu_time_total / 1000:10.1f} ms\n")
+                f.write("\n")
+                f.write(averages.table(sort_by="self_cpu_time_total", row_limit=self.row_limit))
+            with self._lock:
+                self.captured.append(base + ".json")
+            print(f"Profile of {label} written to {base}.json / .txt")
+        except Exception as e:
+            logger.error(f"Failed to write profile for {label}: {e}", exc_info=True)
@@ -0,0 +1,154 @@
+"""
+Geometry of the model's image preprocessing, without importing torch.
+
+patched_modeling_deepseekocr.py uses these functions for its crop grids, global-view windows
+and image-token counts (setup.py copies this module next to it in the model directory), and
+the workflow uses the same ones to plan rasterization, cost and caching decisions before an
+image reaches the model. Only the standard library may be imported here.
+"""
+import math
+
+PATCH_SIZE = 16
+DOWNSAMPLE_RATIO = 4
+MIN_CROPS = 2
+MAX_CROPS = 9
+# Images at or below this size in both dimensions are never tiled in crop mode
+CROP_THRESHOLD = 640
+
+
+def candidate_grids(min_num=MIN_CROPS, max_num=MAX_CROPS):
+    """The (width_tiles, height_tiles) grids `dynamic_preprocess` chooses from, in its order."""
+    grids = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1)
+        if min_num <= i * j <= max_num)
+    return sorted(grids, key=lambda x: x[0] * x[1])
+
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    return best_ratio
+
+
+def select_crop_grid(width, height, image_size=640, crop_mode=True):
+    """Returns the (width_tiles, height_tiles) grid `infer` uses for an image of this size."""
+    if not crop_mode or (width <= CROP_THRESHOLD and height <= CROP_THRESHOLD):
+        return (1, 1)
+    return find_closest_aspect_ratio(width / height, candidate_grids(), width, height, image_size)
+
+
+def num_queries(view_size):
+    """Side length of the vision-token grid for a square view."""
+    return math.ceil((view_size // PATCH_SIZE) / DOWNSAMPLE_RATIO)
+
+
+def global_view_window(width, height, view_size):
+    """
+    (row_start, row_end, col_start, col_end) of the global-view token grid that overlaps the
+    image once `ImageOps.pad` centres it in a `view_size` square.
+    """
+    n = num_queries(view_size)
+    span = view_size / n
+    if width > height:
+        content_width, content_height = view_size, round(height / width * view_size)
+    else:
+        content_width, content_height = round(width / height * view_size), view_size
+    left = round((view_size - content_width) * 0.5)
+    top = round((view_size - content_height) * 0.5)
+    return (math.floor(top / span), math.ceil((top + content_height) / span),
+            math.floor(left / span), math.ceil((left + content_width) / span))
+
+
+def pruned_window(width, height, base_size, image_size, crop_mode):
+    """
+    The global-view window `infer` keeps for a `width` x `height` image when padding tokens are
+    pruned. Views of at most CROP_THRESHOLD without cropping are resized straight to the
+    square, so nothing is padding there.
+    """
+    if crop_mode:
+        return global_view_window(width, height, base_size)
+    if image_size > CROP_THRESHOLD:
+        return global_view_window(width, height, image_size)
+    n = num_queries(image_size)
+    return (0, n, 0, n)
+
+
+def global_tokens(view_size, window=None):
+    """Image tokens of one global view, one newline token per row plus the view separator."""
+    if window:
+        row_start, row_end, col_start, col_end = window
+        return (row_end - row_start) * (col_end - col_start + 1) + 1
+    n = num_queries(view_size)
+    return (n + 1) * n + 1
+
+
+def vision_token_count(base_size, image_size, crop_mode, grid=(1, 1), window=None):
+    """
+    Number of image-token slots `infer` reserves in `images_seq_mask`. `window` is the
+    global-view window (see `pruned_window`) when padding tokens are pruned.
+    """
+    if not crop_mode:
+        return global_tokens(image_size, window)
+
+    tokens = global_tokens(base_size, window)
+    width_tiles, height_tiles = grid
+    if width_tiles > 1 or height_tiles > 1:
+        n = num_queries(image_size)
+        tokens += (n * width_tiles + 1) * (n * height_tiles)
+    return tokens
+
+
+def image_token_count(width, height, base_size, image_size, crop_mode, prune_padding=False):
+    """Image-token slots `infer` reserves for a `width` x `height` image, with or without pruning."""
+    grid = select_crop_grid(width, height, image_size, crop_mode)
+    window = pruned_window(width, height, base_size, image_size, crop_mode) if prune_padding else None
+    return vision_token_count(base_size, image_size, crop_mode, grid, window)
+
+
+def required_scale(width, height, base_size, image_size, crop_mode, grid=None):
+    """
+    Smallest scale factor for a `width` x `height` source below which the model would see
+    fewer pixels than it resizes to. `grid` defaults to the grid chosen at the source size.
+    """
+    if not crop_mode:
+        if image_size <= CROP_THRESHOLD:
+            # Small views are resized straight to a square, so both sides need the full size.
+            return image_size / min(width, height)
+        return image_size / max(width, height)
+
+    scale = base_size / max(width, height)
+    if grid is None:
+        grid = select_crop_grid(width, height, image_size, crop_mode)
+    width_tiles, height_tiles = grid
+    if width_tiles > 1 or height_tiles > 1:
+        scale = max(scale, image_size * width_tiles / width, image_size * height_tiles / height)
+    return scale
+
+
+def plan_render_scale(page_width, page_height, base_size, image_size, crop_mode, reference_scale):
+    """
+    Picks the rasterization scale for a page of `page_width` x `page_height` (PDF points).
+
+    The crop grid is chosen as if the page were rendered at `reference_scale` (the former fixed
+    DPI), and the page is then rendered just large enough for the global view and that grid.
+    If the smaller render would make `infer` choose a different grid, the reference scale is
+    kept so the model sees exactly what it saw before.
+    """
+    ref_width, ref_height = page_width * reference_scale, page_height * reference_scale
+    grid = select_crop_grid(ref_width, ref_height, image_size, crop_mode)
+    scale = required_scale(page_width, page_height, base_size, image_size, crop_mode, grid)
+
+    rendered_grid = select_crop_grid(round(page_width * scale), round(page_height * scale), image_size, crop_mode)
+    if rendered_grid != grid:
+        return reference_scale
+    return scale
@@ -0,0 +1,155 @@
+"""
+Expert-routing telemetry for the DeepseekV2 MoE layers.
+
+A forward hook on every MoE gate counts which experts the router picked. Counts are kept per
+layer and per context (task prompt and resolution mode, see `context_key`), together with the
+number of gate calls ("batches"), the experts active per batch and the load imbalance of each
+batch (busiest expert / mean tokens per expert). Everything is accumulated in tensors on the
+model's device, so the hook never synchronizes; numbers are only materialized by `snapshot`.
+"""
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+import torch
+
+from . import config_macos as config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT = "unattributed"
+
+
+def context_key(prompt, base_size, image_size, crop_mode):
+    """'<task>/<mode>' using the preset names from config_macos where they match."""
+    text = prompt.replace("<image>", "").strip()
+    task = next((name for name, preset in config.PROMPT_PRESETS.items()
+                 if preset.replace("<image>", "").strip() == text), "custom")
+    mode = next((name for name, preset in config.RESOLUTION_PRESETS.items()
+                 if (preset["base_size"], preset["image_size"], preset["crop_mode"]) == (base_size, image_size, crop_mode)),
+                f"{base_size}-{image_size}{'-crop' if crop_mode else ''}")
+    return f"{task}/{mode}"
+
+
+class _LayerStats:
+    def __init__(self, num_experts, device):
+        self.hits = torch.zeros(num_experts, dtype=torch.long, device=device)
+        self.tokens = torch.zeros((), dtype=torch.long, device=device)
+        self.active_experts = torch.zeros((), dtype=torch.long, device=device)
+        self.imbalance_sum = torch.zeros((), dtype=torch.float32, device=device)
+        self.imbalance_max = torch.zeros((), dtype=torch.float32, device=device)
+        self.batches = 0
+
+    def record(self, topk_idx):
+        counts = torch.bincount(topk_idx.reshape(-1), minlength=self.hits.numel())
+        self.hits += counts
+        self.tokens += topk_idx.shape[0]
+        self.active_experts += (counts > 0).sum()
+        imbalance = counts.max().float() / counts.float().mean()
+        self.imbalance_sum += imbalance
+        torch.maximum(self.imbalance_max, imbalance, out=self.imbalance_max)
+        self.batches += 1
+
+    def summary(self):
+        hits = self.hits.tolist()
+        active = self.active_experts.item()
+        routed = sum(hits)
+        return {
+            "tokens": self.tokens.item(),
+            "batches": self.batches,
+            "expert_hits": hits,
+            "mean_active_experts": active / self.batches if self.batches else 0.0,
+            "mean_tokens_per_active_expert": routed / active if active else 0.0,
+            "mean_imbalance": self.imbalance_sum.item() / self.batches if self.batches else 0.0,
+            "max_imbalance": self.imbalance_max.item(),
+        }
+
+
+class RoutingTelemetry:
+    """
+    Collects routing statistics of a model. `attach` installs the gate hooks; `context` (or
+    `batch_context` for a batch of sequences with different contexts) attributes the gate calls
+    made on the current thread.
+    """
+    def __init__(self):
+        self._stats = {}
+        self._handles = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def attach(self, model):
+        """Hooks the gate of every MoE layer. Returns the number of layers hooked."""
+        for name, module in model.named_modules():
+            if hasattr(module, "experts") and hasattr(module, "gate"):
+                hook = lambda gate, inputs, output, layer=name: self._on_gate(layer, gate, inputs, output)
+                self._handles.append(module.gate.register_forward_hook(hook))
+        return len(self._handles)
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    @contextmanager
+    def context(self, key):
+        previous = getattr(self._local, "keys", None)
+        self._local.keys = [key]
+        try:
+            yield
+        finally:
+            self._local.keys = previous
+
+    @contextmanager
+    def batch_context(self, keys):
+        """Attributes row group i of the next gate calls (sequence i of the batch) to keys[i]."""
+        previous = getattr(self._local, "keys", None)
+        self._local.keys = list(keys)
+        try:
+            yield
+        finally:
+            self._local.keys = previous
+
+    def _layer_stats(self, key, layer, num_experts, device):
+        stats = self._stats.get((key, layer))
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault((key, layer), _LayerStats(num_experts, device))
+        return stats
+
+    @torch.no_grad()
+    def _on_gate(self, layer, gate, inputs, output):
+        if gate.training:
+            return
+        topk_idx = output[0]
+        num_experts = getattr(gate, "n_routed_experts", None) or int(topk_idx.max()) + 1
+        keys = getattr(self._local, "keys", None) or [DEFAULT_CONTEXT]
+
+        if len(keys) == 1:
+            self._layer_stats(keys[0], layer, num_experts, topk_idx.device).record(topk_idx)
+            return
+        rows = topk_idx.shape[0] // len(keys)
+        for i, key in enumerate(keys):
+            self._layer_stats(key, layer, num_experts, topk_idx.device).record(topk_idx[i * rows:(i + 1) * rows])
+
+    def snapshot(self):
+        """{context: {"layers": {layer: stats}, "mean_imbalance": ...}} with plain Python values."""
+        with self._lock:
+            items = list(self._stats.items())
+        result = {}
+        for (key, layer), stats in sorted(items, key=lambda item: item[0]):
+            result.setdefault(key, {"layers": {}})["layers"][layer] = stats.summary()
+        for context in result.values():
+            layers = context["layers"].values()
+            context["tokens"] = max(s["tokens"] for s in layers)
+            context["mean_imbalance"] = sum(s["mean_imbalance"] for s in layers) / len(layers)
+        return result
+
+    def export_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        return path
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
@@ -0,0 +1,291 @@
+"""
+Priority and cost-aware scheduling of OCR work in front of the engine.
+
+Work is dispatched one page at a time, so a page of an interactive request is picked up as
+soon as the page currently running finishes, however long the bulk document it interrupts.
+
+    interactive   ordered shortest-first by estimated cost
+    bulk          runs when no interactive page is waiting, and at least at
+                  PRIORITY_BULK_MIN_SHARE of the pages while both are waiting
+
+Within a class, documents with the least estimated remaining cost go first, pages of one
+document in order. A document's remaining cost is read when a page is picked, so it always
+reflects the pages finished and read so far.
+
+A page's cost is its vision-token count (from the resolution mode and the crop grid its size
+leads to, see resolution.py) plus the expected output length of its task, weighted by how
+much more a decoded token costs than a prefilled one.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from PIL import Image
+
+from . import config_macos as config
+from .resolution import select_crop_grid, vision_token_count
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_CLASSES = {"interactive": 0, "bulk": 1}
+
+
+def expected_output_tokens(prompt):
+    """Expected output length for the task preset `prompt` belongs to."""
+    text = prompt.replace("<image>", "").strip()
+    for name, preset in config.PROMPT_PRESETS.items():
+        if preset.replace("<image>", "").strip() == text:
+            return config.EXPECTED_OUTPUT_TOKENS.get(name, config.EXPECTED_OUTPUT_TOKENS["default"])
+    return config.EXPECTED_OUTPUT_TOKENS["default"]
+
+
+def estimate_page_cost(image_path, prompt, base_size, image_size, crop_mode):
+    """Cost of one page in prefill-token units."""
+    with Image.open(image_path) as image:
+        width, height = image.size
+    grid = select_crop_grid(width, height, image_size, crop_mode)
+    vision_tokens = vision_token_count(base_size, image_size, crop_mode, grid)
+    return vision_tokens + config.COST_DECODE_TOKEN_WEIGHT * expected_output_tokens(prompt)
+
+
+class _WorkItem:
+    def __init__(self, image_path, prompt, mode, max_new_tokens, priority, cost, job=None, index=0):
+        self.image_path = image_path
+        self.prompt = prompt
+        self.mode = mode
+        self.max_new_tokens = max_new_tokens
+        self.priority = priority
+        self.cost = cost
+        self.job = job
+        self.index = index
+        self.future = Future()
+        self.submitted_at = time.time()
+
+
+class PageJob:
+    """
+    A multi-page submission. Pages are pulled from the (possibly lazy) iterator a few at a time
+    as earlier ones are dispatched; `results` yields them in page order.
+    """
+    def __init__(self, scheduler, image_paths, prompt, mode, priority, total_pages=None, lookahead=2,
+                 max_new_tokens=None):
+        self.scheduler = scheduler
+        self.prompt = prompt
+        self.mode = mode
+        self.max_new_tokens = max_new_tokens
+        self.priority = priority
+        self.total_pages = total_pages
+        self.lookahead = max(1, lookahead)
+        self.items = []
+        self.exhausted = False
+        self.cancelled = False
+        self._image_paths = iter(image_paths)
+        self._completed_cost = 0.0
+        self._condition = threading.Condition()
+
+    def estimated_remaining_cost(self):
+        """Pending page costs, extrapolated to the pages not read yet when `total_pages` is known."""
+        with self._condition:
+            pending = [item.cost for item in self.items if not item.future.done()]
+            known = len(self.items)
+            mean_cost = sum(item.cost for item in self.items) / known if known else 0.0
+            unread = max(0, (self.total_pages or known) - known)
+        return sum(pending) + unread * mean_cost
+
+    def refill(self):
+        """Queues pages until `lookahead` of them are waiting. Returns the new work items."""
+        new_items = []
+        with self._condition:
+            while not self.exhausted and not self.cancelled and \
+                    sum(not item.future.running() and not item.future.done() for item in self.items) < self.lookahead:
+                try:
+                    image_path = next(self._image_paths)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+                except Exception as e:
+                    logger.error(f"Failed to read page input: {e}", exc_info=True)
+                    self.exhausted = True
+                    failed = _WorkItem(None, self.prompt, self.mode, self.max_new_tokens, self.priority, 0, self,
+                                       len(self.items))
+                    failed.future.set_exception(e)
+                    self.items.append(failed)
+                    break
+                item = _WorkItem(image_path, self.prompt, self.mode, self.max_new_tokens, self.priority,
+                                 estimate_page_cost(image_path, self.prompt, *self.mode), self, len(self.items))
+                self.items.append(item)
+                new_items.append(item)
+            self._condition.notify_all()
+        return new_items
+
+    def results(self):
+        """Yields (index, image_path, result_text) in page order."""
+        index = 0
+        try:
+            while True:
+                with self._condition:
+                    while index >= len(self.items) and not self.exhausted:
+                        self._condition.wait()
+                    if index >= len(self.items):
+                        return
+                    item = self.items[index]
+                yield index, item.image_path, item.future.result()
+                index += 1
+        finally:
+            self.cancel()
+
+    def cancel(self):
+        """Drops the pages that have not started yet."""
+        with self._condition:
+            self.cancelled = True
+            for item in self.items:
+                item.future.cancel()
+            self._condition.notify_all()
+
+
+class PriorityScheduler:
+    """
+    Dispatches pages to the engine by priority class and cost. `workers` pages run at the same
+    time (more than one only helps with continuous batching).
+    """
+    def __init__(self, engine, workers=1, bulk_min_share=None):
+        self.engine = engine
+        self.workers = max(1, workers)
+        self.bulk_min_share = config.PRIORITY_BULK_MIN_SHARE if bulk_min_share is None else bulk_min_share
+        # Per class: single pages in a (cost, seq) heap, and each document's waiting pages in order
+        self._pages = {name: [] for name in PRIORITY_CLASSES}
+        self._jobs = {name: {} for name in PRIORITY_CLASSES}
+        self._seq = itertools.count()
+        self._bulk_credit = 0.0
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopped = False
+        self._waits = {name: [] for name in PRIORITY_CLASSES}
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"ocr-priority-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _push(self, items):
+        with self._condition:
+            for item in items:
+                if item.job is None:
+                    heapq.heappush(self._pages[item.priority], (item.cost, next(self._seq), item))
+                else:
+                    jobs = self._jobs[item.priority]
+                    if item.job not in jobs:
+                        jobs[item.job] = (next(self._seq), deque())
+                    jobs[item.job][1].append(item)
+            self._condition.notify_all()
+
+    def _waiting(self, priority):
+        return bool(self._pages[priority]) or bool(self._jobs[priority])
+
+    def _next_class(self):
+        """
+        The class to take a page from, or None. Bulk pages earn credit while interactive ones
+        run ahead of them, so bulk keeps at least `bulk_min_share` of the pages. Call with the
+        lock held.
+        """
+        if not self._waiting("bulk"):
+            self._bulk_credit = 0.0
+            return "interactive" if self._waiting("interactive") else None
+        if not self._waiting("interactive"):
+            self._bulk_credit = 0.0
+            return "bulk"
+        if self._bulk_credit > 1.0 - 1e-9:
+            self._bulk_credit -= 1.0
+            return "bulk"
+        share = min(max(self.bulk_min_share, 0.0), 0.99)
+        self._bulk_credit += share / (1.0 - share)
+        return "interactive"
+
+    def _pop(self):
+        """The next page to run, or None when nothing is waiting. Call with the lock held."""
+        priority = self._next_class()
+        if priority is None:
+            return None
+        pages, jobs = self._pages[priority], self._jobs[priority]
+        # Remaining costs change as pages finish, so compare documents now rather than when queued
+        job_key = lambda job: (job.estimated_remaining_cost(), jobs[job][0])
+        job = min(jobs, key=job_key) if jobs else None
+        if pages and (job is None or pages[0][:2] <= job_key(job)):
+            return heapq.heappop(pages)[2]
+        items = jobs[job][1]
+        item = items.popleft()
+        if not items:
+            del jobs[job]
+        return item
+
+    def submit(self, image_path, prompt, mode, priority="interactive", max_new_tokens=None):
+        """Queues a single page. Returns a Future for its text."""
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}'")
+        item = _WorkItem(image_path, prompt, mode, max_new_tokens, priority,
+                         estimate_page_cost(image_path, prompt, *mode))
+        self._push([item])
+        return item.future
+
+    def submit_pages(self, image_paths, prompt, mode, priority="bulk", total_pages=None, max_new_tokens=None):
+        """Queues a document. Returns a PageJob; iterate `job.results()` for the pages."""
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}'")
+        job = PageJob(self, image_paths, prompt, mode, priority, total_pages, max_new_tokens=max_new_tokens)
+        self._push(job.refill())
+        return job
+
+    def stats(self):
+        """Mean and max queue wait per priority class, over the last 1000 pages of each."""
+        with self._condition:
+            waits = {name: list(values) for name, values in self._waits.items()}
+            queued = sum(len(pages) for pages in self._pages.values()) + \
+                sum(len(items) for jobs in self._jobs.values() for _, items in jobs.values())
+        return {
+            "queued": queued,
+            **{name: {"pages": len(values),
+                      "mean_wait": sum(values) / len(values) if values else None,
+                      "max_wait": max(values) if values else None}
+               for name, values in waits.items()},
+        }
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return
+                    item = self._pop()
+                    if item is not None:
+                        break
+                    self._condition.wait()
+            if not item.future.set_running_or_notify_cancel():
+                continue
+
+            if item.job is not None:
+                # Keep the document's next pages queued behind this one
+                self._push(item.job.refill())
+
+            with self._condition:
+                waits = self._waits[item.priority]
+                waits.append(time.time() - item.submitted_at)
+                del waits[:-1000]
+            try:
+                item.future.set_result(self.engine.run_page(item.image_path, item.prompt, *item.mode,
+                                                            max_new_tokens=item.max_new_tokens))
+            except Exception as e:
+                logger.error(f"Scheduled page failed: {e}", exc_info=True)
+                item.future.set_exception(e)
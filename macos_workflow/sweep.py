@@ -0,0 +1,249 @@
+"""
+Speed-versus-accuracy sweep for choosing production defaults.
+
+Runs a labelled corpus through every combination of resolution mode, crop setting, weight
+precision and decoding setting, and reports for each document type:
+
+    cer / wer           against the ground truth next to each page (<stem>.md or <stem>.txt)
+    pages/s             mean over the type's pages
+    peak MB             peak RSS above the loaded model while the combination ran
+    vision tokens       mean per page, from the page sizes (resolution.py)
+
+followed by the Pareto frontier of error rate against speed: the combinations no other one
+beats on both. The corpus has one sub-directory per document type:
+
+    corpus/receipts/001.png, corpus/receipts/001.md, ...
+    corpus/papers/p1.png, corpus/papers/p1.md, ...
+
+Decoding settings are the `max_new_tokens` caps and the model options of evaluation.py
+(e.g. prune_padding), each swept off and on. Every precision loads the model afresh from
+the float32 checkpoint.
+
+Usage:
+    python -m macos_workflow.sweep corpus/ --modes gundam base small --crop on off \\
+        --precisions float32 bfloat16 --options prune_padding --output sweep.json
+"""
+import argparse
+import gc
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+_current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(_current_dir)
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from PIL import Image
+
+from macos_workflow import config_macos as config
+from macos_workflow.evaluation import OPTIONS, error_rates, load_reference
+from macos_workflow.memory import current_rss
+from macos_workflow.resolution import image_token_count
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+
+
+def load_corpus(root):
+    """{document type: [(image_path, reference_text)]}. Pages without ground truth are skipped."""
+    corpus = {}
+    for doc_type in sorted(os.listdir(root)):
+        type_dir = os.path.join(root, doc_type)
+        if not os.path.isdir(type_dir):
+            continue
+        pages = []
+        for name in sorted(os.listdir(type_dir)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            image_path = os.path.join(type_dir, name)
+            reference = load_reference(type_dir, image_path)
+            if reference is None:
+                print(f"Skipping {doc_type}/{name}: no ground truth")
+                continue
+            pages.append((image_path, reference))
+        if pages:
+            corpus[doc_type] = pages
+    return corpus
+
+
+def build_grid(mode_names, crop_settings, precisions, max_new_tokens, options):
+    """Every combination as a dict; precision varies slowest so each model is loaded once."""
+    grid = []
+    option_states = list(itertools.product((False, True), repeat=len(options)))
+    for precision, name, crop_mode, tokens, states in itertools.product(
+            precisions, mode_names, crop_settings, max_new_tokens, option_states):
+        preset = config.RESOLUTION_PRESETS[name]
+        grid.append({
+            "mode": name,
+            "base_size": preset["base_size"],
+            "image_size": preset["image_size"],
+            "crop_mode": crop_mode,
+            "precision": precision,
+            "max_new_tokens": tokens,
+            "options": dict(zip(options, states)),
+        })
+    # Presets differing only in crop_mode collapse onto the same setup
+    unique = {}
+    for setup in grid:
+        key = json.dumps({k: v for k, v in setup.items() if k != "mode"}, sort_keys=True)
+        unique.setdefault(key, setup)
+    return list(unique.values())
+
+
+def setup_label(setup):
+    crop = "crop" if setup["crop_mode"] else "nocrop"
+    options = "".join(f"+{name}" for name, enabled in setup["options"].items() if enabled)
+    tokens = f"/{setup['max_new_tokens']}tok" if setup["max_new_tokens"] else ""
+    return f"{setup['mode']}/{crop}/{setup['precision']}{tokens}{options}"
+
+
+class PeakRSS:
+    """Samples RSS on a background thread; `peak` is the highest value seen while entered."""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stopped = threading.Event()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def _vision_tokens(image_path, setup):
+    with Image.open(image_path) as image:
+        width, height = image.size
+    return image_token_count(width, height, setup["base_size"], setup["image_size"], setup["crop_mode"],
+                             setup["options"].get("prune_padding", False))
+
+
+def run_setup(engine, setup, corpus, prompt):
+    """Runs the corpus with one setup. Returns one result row per document type."""
+    previous = {}
+    for name, enabled in setup["options"].items():
+        target = OPTIONS[name](engine)
+        previous[name] = getattr(target, name, None)
+        setattr(target, name, enabled)
+
+    baseline = current_rss()
+    rows = []
+    try:
+        for doc_type, pages in corpus.items():
+            cers, wers, seconds, tokens = [], [], [], []
+            with PeakRSS() as peak:
+                for image_path, reference in pages:
+                    start_time = time.perf_counter()
+                    text = engine.infer(image_path, prompt, setup["base_size"], setup["image_size"], setup["crop_mode"],
+                                        max_new_tokens=setup["max_new_tokens"])
+                    seconds.append(time.perf_counter() - start_time)
+                    cer, wer = error_rates(text, reference)
+                    cers.append(cer)
+                    wers.append(wer)
+                    tokens.append(_vision_tokens(image_path, setup))
+            rows.append({
+                "doc_type": doc_type,
+                "setup": setup_label(setup),
+                **setup,
+                "pages": len(pages),
+                "cer": sum(cers) / len(cers),
+                "wer": sum(wers) / len(wers),
+                "pages_per_second": len(seconds) / sum(seconds),
+                "peak_mb": max(0, peak.peak - baseline) / 2 ** 20,
+                "vision_tokens": sum(tokens) / len(tokens),
+            })
+            row = rows[-1]
+            print(f"  {doc_type:<12} {row['setup']:<44} CER {row['cer']:.4f}  WER {row['wer']:.4f}  "
+                  f"{row['pages_per_second']:.3f} pages/s  {row['peak_mb']:.0f} MB  {row['vision_tokens']:.0f} tokens")
+    finally:
+        for name, value in previous.items():
+            setattr(OPTIONS[name](engine), name, value)
+    return rows
+
+
+def pareto_frontier(rows):
+    """Rows not dominated on (lower CER, higher pages/s), ordered fastest first."""
+    frontier = []
+    for row in rows:
+        dominated = any(
+            other["cer"] <= row["cer"] and other["pages_per_second"] >= row["pages_per_second"]
+            and (other["cer"] < row["cer"] or other["pages_per_second"] > row["pages_per_second"])
+            for other in rows)
+        if not dominated:
+            frontier.append(row)
+    return sorted(frontier, key=lambda r: r["pages_per_second"], reverse=True)
+
+
+def print_frontiers(rows):
+    for doc_type in sorted({row["doc_type"] for row in rows}):
+        print(f"\nPareto frontier for {doc_type}:")
+        print(f"  {'setup':<44} {'CER':>7} {'WER':>7} {'pages/s':>8} {'peak MB':>8} {'tokens':>7}")
+        for row in pareto_frontier([r for r in rows if r["doc_type"] == doc_type]):
+            print(f"  {row['setup']:<44} {row['cer']:7.4f} {row['wer']:7.4f} {row['pages_per_second']:8.3f} "
+                  f"{row['peak_mb']:8.0f} {row['vision_tokens']:7.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep resolution, precision and decoding settings over a labelled corpus.")
+    parser.add_argument("corpus", help="Directory with one sub-directory of pages + ground truth per document type")
+    parser.add_argument("--task", choices=sorted(config.PROMPT_PRESETS), default="free_ocr")
+    parser.add_argument("--modes", nargs="+", choices=sorted(config.RESOLUTION_PRESETS),
+                        default=sorted(config.RESOLUTION_PRESETS))
+    parser.add_argument("--crop", nargs="+", choices=["on", "off", "preset"], default=["preset"],
+                        help="Crop settings to try; 'preset' keeps each mode's own")
+    parser.add_argument("--precisions", nargs="+", choices=["float32", "bfloat16", "float16"], default=["float32"])
+    parser.add_argument("--max-new-tokens", nargs="+", type=int, default=[0],
+                        help="Output caps to try (0: the model's default)")
+    parser.add_argument("--options", nargs="*", choices=sorted(OPTIONS), default=[],
+                        help="Model options to sweep off and on")
+    parser.add_argument("--output", help="Write all rows and frontiers as JSON")
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        parser.error("no pages with ground truth in the corpus")
+    prompt = config.PROMPT_PRESETS[args.task]
+    if "<image>" not in prompt:
+        prompt = f"<image>\n{prompt}"
+
+    crop_settings = sorted({True if c == "on" else False if c == "off" else None for c in args.crop}, key=str)
+    grid = []
+    for name in args.modes:
+        preset_crop = config.RESOLUTION_PRESETS[name]["crop_mode"]
+        crops = sorted({preset_crop if c is None else c for c in crop_settings})
+        grid.extend(build_grid([name], crops, args.precisions, [t or None for t in args.max_new_tokens], args.options))
+    grid.sort(key=lambda s: args.precisions.index(s["precision"]))
+    print(f"{len(grid)} setups x {sum(len(p) for p in corpus.values())} pages in {len(corpus)} document types.")
+
+    from macos_workflow.ocr_engine_macos import OCREngine
+    rows = []
+    for precision, setups in itertools.groupby(grid, key=lambda s: s["precision"]):
+        engine = None  # free the previous precision's weights first
+        gc.collect()
+        config.MODEL_DTYPE = precision
+        engine = OCREngine(project_root=project_root, warmup=False)
+        for setup in setups:
+            rows.extend(run_setup(engine, setup, corpus, prompt))
+
+    print_frontiers(rows)
+    if args.output:
+        frontiers = {doc_type: [row["setup"] for row in pareto_frontier([r for r in rows if r["doc_type"] == doc_type])]
+                     for doc_type in corpus}
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"task": args.task, "rows": rows, "frontiers": frontiers}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,222 @@
 
 import os
-from PIL import Image, ImageDraw, ImageFont
+import shutil
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 import numpy as np
 import re
-from tqdm import tqdm
-import fitz  # PyMuPDF
+import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import io
-import img2pdf
+
+from . import config_macos as config
+from .resolution import plan_render_scale
+
+# Separator placed between per-page results in the aggregated markdown
+PAGE_SEPARATOR = "\n\n<--- Page Split --->\n\n"
+
+# Extensions handled as multi-page documents next to PDF
+TIFF_EXTENSIONS = ('.tif', '.tiff')
 
 # --- PDF Processing Functions ---
+# fitz (PyMuPDF), img2pdf and tqdm are imported where they are used, so that importing this
+# module for image-only work (workers, the API, headless runs on images) does not load them.
+
+def _page_zoom(page, resolution, reference_scale):
+    if not resolution:
+        return reference_scale
+    return plan_render_scale(page.rect.width, page.rect.height, resolution['base_size'],
+                             resolution['image_size'], resolution['crop_mode'], reference_scale)
+
+def _tag_page_image(image, zoom, page_size):
+    image.info["render_scale"] = zoom
+    image.info["page_size"] = page_size
+    return image
+
+# Each rasterization worker opens the document once and keeps it for all its page ranges.
+_raster_document = None
+
+def _init_raster_worker(pdf_path):
+    import fitz  # PyMuPDF
+    global _raster_document
+    _raster_document = fitz.open(pdf_path)
+
+def _render_pages_to_shared_memory(tasks):
+    """
+    Pool worker: renders (page_num, zoom, shm_name, capacity) tasks into shared memory blocks
+    allocated by the parent. Returns (page_num, width, height, overflow) per page, where
+    `overflow` holds the raw samples only if they did not fit into the block.
+    """
+    import fitz
+    rendered = []
+    for page_num, zoom, shm_name, capacity in tasks:
+        page = _raster_document.load_page(page_num)
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        samples = pixmap.samples_mv
+        if len(samples) > capacity:
+            rendered.append((page_num, pixmap.width, pixmap.height, bytes(samples)))
+            continue
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            shm.buf[:len(samples)] = samples
+        finally:
+            shm.close()
+        rendered.append((page_num, pixmap.width, pixmap.height, None))
+    return rendered
 
-def pdf_to_images(pdf_path, dpi=200):
-    """Converts a PDF file to a list of PIL images."""
-    print(f"Converting PDF '{os.path.basename(pdf_path)}' to images at {dpi} DPI...")
-    images = []
+def _iter_pdf_images_sequential(pdf_path, pages):
+    import fitz
+    from tqdm import tqdm
+    pdf_document = fitz.open(pdf_path)
     try:
-        pdf_document = fitz.open(pdf_path)
-        zoom = dpi / 72.0
-        matrix = fitz.Matrix(zoom, zoom)
-        
-        for page_num in tqdm(range(len(pdf_document)), desc="Converting PDF pages"):
+        for page_num in tqdm(range(len(pages)), desc="Converting PDF pages"):
             page = pdf_document.load_page(page_num)
-            pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-            img_data = pixmap.tobytes("png")
-            image = Image.open(io.BytesIO(img_data))
-            images.append(image)
+            zoom = pages[page_num][0]
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+            yield _tag_page_image(image, zoom, pages[page_num][1])
+    finally:
         pdf_document.close()
+
+def _iter_pdf_images_parallel(pdf_path, pages, workers):
+    """
+    Renders page ranges in a process pool. The parent allocates one shared memory block per
+    page, workers write the pixels straight into it, and only a few ranges are in flight at a
+    time so long documents never sit in shared memory all at once.
+    """
+    from tqdm import tqdm
+    chunk_size = max(1, min(8, len(pages) // (workers * 4)))
+    page_ranges = iter([range(i, min(i + chunk_size, len(pages))) for i in range(0, len(pages), chunk_size)])
+    in_flight = deque()
+
+    def submit_next(executor):
+        page_range = next(page_ranges, None)
+        if page_range is None:
+            return
+        tasks, segments = [], []
+        for page_num in page_range:
+            zoom, (page_width, page_height) = pages[page_num]
+            capacity = (math.ceil(page_width * zoom) + 2) * (math.ceil(page_height * zoom) + 2) * 3
+            shm = shared_memory.SharedMemory(create=True, size=capacity)
+            segments.append(shm)
+            tasks.append((page_num, zoom, shm.name, capacity))
+        in_flight.append((executor.submit(_render_pages_to_shared_memory, tasks), segments))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_raster_worker, initargs=(pdf_path,)) as executor:
+        try:
+            for _ in range(workers * 2):
+                submit_next(executor)
+            with tqdm(total=len(pages), desc=f"Converting PDF pages ({workers} workers)") as progress_bar:
+                while in_flight:
+                    future, segments = in_flight.popleft()
+                    try:
+                        for (page_num, width, height, overflow), shm in zip(future.result(), segments):
+                            if overflow is not None:
+                                image = Image.frombytes("RGB", (width, height), overflow)
+                            else:
+                                view = shm.buf[:width * height * 3]
+                                shared_image = Image.frombuffer("RGB", (width, height), view, "raw", "RGB", 0, 1)
+                                image = shared_image.copy()
+                                del shared_image
+                                view.release()
+                            progress_bar.update(1)
+                            yield _tag_page_image(image, pages[page_num][0], pages[page_num][1])
+                    finally:
+                        for shm in segments:
+                            shm.close()
+                            shm.unlink()
+                    submit_next(executor)
+        finally:
+            while in_flight:
+                future, segments = in_flight.popleft()
+                future.cancel()
+                try:
+                    future.result()
+                except Exception:
+                    pass
+                for shm in segments:
+                    shm.close()
+                    shm.unlink()
+
+def iter_pdf_images(pdf_path, dpi=200, resolution=None, workers=None):
+    """
+    Yields the pages of a PDF file as PIL images, in order.
+
+    Without `resolution` every page is rendered at `dpi`. With a resolution preset
+    (base_size/image_size/crop_mode) each page is rendered at the scale that preset needs,
+    using `dpi` as the reference the crop grid is chosen at. The scale used for each page is
+    kept in `image.info["render_scale"]` (pixels per PDF point) next to
+    `image.info["page_size"]` (in points).
+
+    Documents with at least RASTER_PARALLEL_MIN_PAGES pages are rendered by a process pool
+    of `workers` (default RASTER_WORKERS) processes.
+    """
+    import fitz
+    reference_scale = dpi / 72.0
+    with fitz.open(pdf_path) as pdf_document:
+        pages = []
+        for page in pdf_document:
+            pages.append((_page_zoom(page, resolution, reference_scale), (page.rect.width, page.rect.height)))
+
+    if workers is None:
+        workers = config.RASTER_WORKERS or min(4, os.cpu_count() or 1)
+    workers = min(workers, len(pages))
+    if workers > 1 and len(pages) >= config.RASTER_PARALLEL_MIN_PAGES:
+        yield from _iter_pdf_images_parallel(pdf_path, pages, workers)
+    else:
+        yield from _iter_pdf_images_sequential(pdf_path, pages)
+
+def count_pdf_pages(pdf_path):
+    """Counts the pages of a PDF without rendering them. Returns 0 if it cannot be opened."""
+    import fitz
+    try:
+        with fitz.open(pdf_path) as pdf_document:
+            return pdf_document.page_count
+    except Exception as e:
+        print(f"Failed to open PDF: {e}")
+        return 0
+
+def pdf_to_images(pdf_path, dpi=200, resolution=None, workers=None):
+    """Converts a PDF file to a list of PIL images. See `iter_pdf_images` for the options."""
+    if resolution:
+        print(f"Converting PDF '{os.path.basename(pdf_path)}' to images for {resolution['base_size']}/{resolution['image_size']} "
+              f"(crop_mode={resolution['crop_mode']})...")
+    else:
+        print(f"Converting PDF '{os.path.basename(pdf_path)}' to images at {dpi} DPI...")
+    try:
+        images = list(iter_pdf_images(pdf_path, dpi=dpi, resolution=resolution, workers=workers))
     except Exception as e:
         print(f"Failed to convert PDF to images: {e}")
         return []
     print("PDF conversion complete.")
     return images
 
+# --- Multi-page TIFF Functions ---
+
+def _is_reduced_resolution_frame(image):
+    # NewSubfileType bit 0 marks thumbnails / pyramid levels rather than document pages
+    return bool(image.tag_v2.get(254, 0) & 1)
+
+def count_tiff_pages(tiff_path):
+    """Counts the document pages of a (multi-page) TIFF without decoding them."""
+    with Image.open(tiff_path) as tiff:
+        pages = 0
+        for frame in range(getattr(tiff, "n_frames", 1)):
+            tiff.seek(frame)
+            if not _is_reduced_resolution_frame(tiff):
+                pages += 1
+        return pages
+
+def iter_tiff_pages(tiff_path):
+    """Yields the pages of a multi-page TIFF one frame at a time, as oriented RGB images."""
+    with Image.open(tiff_path) as tiff:
+        for frame in range(getattr(tiff, "n_frames", 1)):
+            tiff.seek(frame)
+            if _is_reduced_resolution_frame(tiff):
+                continue
+            yield ImageOps.exif_transpose(tiff).convert("RGB")
+
 def save_images_to_pdf(images, output_path):
     """Saves a list of PIL images to a single PDF file."""
     if not images:
@@ -39,6 +224,8 @@ def save_images_to_pdf(images, output_path):
         return
         
     print(f"Saving {len(images)} annotated pages to '{os.path.basename(output_path)}'...")
+    import img2pdf
+    from tqdm import tqdm
     try:
         # img2pdf requires bytes-like objects
         image_bytes_list = []
@@ -56,6 +243,101 @@ def save_images_to_pdf(images, output_path):
     except Exception as e:
         print(f"Failed to save images to PDF: {e}")
 
+# Stroke colors (RGB, 0-1) for the vector overlay, cycled by label
+_OVERLAY_COLORS = [
+    (0.84, 0.15, 0.16), (0.12, 0.47, 0.71), (0.17, 0.63, 0.17), (1.0, 0.5, 0.05),
+    (0.58, 0.4, 0.74), (0.55, 0.34, 0.29), (0.89, 0.47, 0.76), (0.09, 0.75, 0.81),
+]
+
+# Height of the box labels in the annotated PDF, in points
+_LABEL_HEIGHT = 9
+
+class AnnotatedPDFWriter:
+    """
+    Draws the detected boxes and labels as vector annotations onto a copy of the source PDF,
+    optionally with the recognized text as an invisible, searchable text layer.
+
+    The copy is saved incrementally after every page, so pages are written as their results
+    arrive instead of building the whole document in memory at the end.
+    """
+    def __init__(self, source_pdf, output_path, text_layer=True):
+        import fitz
+        shutil.copyfile(source_pdf, output_path)
+        self.output_path = output_path
+        self.text_layer = text_layer
+        self.document = fitz.open(output_path)
+        self.incremental = self.document.can_save_incrementally()
+        self.label_colors = {}
+
+    def _color(self, label):
+        if label not in self.label_colors:
+            self.label_colors[label] = _OVERLAY_COLORS[len(self.label_colors) % len(_OVERLAY_COLORS)]
+        return self.label_colors[label]
+
+    @staticmethod
+    def _label_rect(rect, label, page_rect):
+        """Where a box's label goes on the displayed page: above the box, or inside its top edge."""
+        import fitz
+        width = 6 * len(label) + 4
+        x0 = max(page_rect.x0, min(rect.x0, page_rect.x1 - width))
+        if rect.y0 - page_rect.y0 >= _LABEL_HEIGHT:
+            return fitz.Rect(x0, rect.y0 - _LABEL_HEIGHT, x0 + width, rect.y0)
+        return fitz.Rect(x0, rect.y0, x0 + width, rect.y0 + _LABEL_HEIGHT)
+
+    def _insert_invisible_text(self, page, rect, content):
+        """Writes `content` invisibly into `rect` (displayed-page coordinates), upright as displayed."""
+        text = re.sub(r'<[^>]+>', ' ', content).strip()
+        if not text:
+            return
+        fontname = "china-s" if any(ord(c) > 255 for c in text) else "helv"
+        fontsize = min(12.0, max(rect.height * 0.8, 1.0))
+        # insert_textbox writes nothing and returns < 0 if the text does not fit
+        while fontsize >= 1.0:
+            if page.insert_textbox(rect * page.derotation_matrix, text, fontsize=fontsize, fontname=fontname,
+                                   render_mode=3, rotate=page.rotation) >= 0:
+                return
+            fontsize /= 1.5
+
+    def add_page(self, page_index, result_text):
+        """Adds the grounded boxes of one page's model output and writes the page."""
+        import fitz
+        page = self.document[page_index]
+        page_width, page_height = page.rect.width, page.rect.height
+
+        for label, boxes, content in iter_grounded_blocks(result_text):
+            color = self._color(label)
+            for x1, y1, x2, y2 in boxes:
+                # Model coordinates are normalized to 0-999 on the displayed page; the PDF
+                # objects are placed in unrotated page space via derotation_matrix
+                rect = fitz.Rect(x1 / 999 * page_width, y1 / 999 * page_height,
+                                 x2 / 999 * page_width, y2 / 999 * page_height)
+                if rect.is_empty:
+                    continue
+                annot = page.add_rect_annot(rect * page.derotation_matrix)
+                annot.set_colors(stroke=color)
+                annot.set_border(width=2 if label == 'title' else 1)
+                annot.set_info(title=label, content=content[:500])
+                annot.update(opacity=0.8)
+
+                label_rect = self._label_rect(rect, label, page.rect) * page.derotation_matrix
+                page.add_freetext_annot(label_rect, label, fontsize=6, text_color=color, rotate=page.rotation)
+
+                if self.text_layer and content:
+                    self._insert_invisible_text(page, rect, content)
+
+        if self.incremental:
+            self.document.saveIncr()
+
+    def close(self):
+        if not self.incremental:
+            tmp_path = self.output_path + ".tmp"
+            self.document.save(tmp_path, garbage=1, deflate=True)
+            self.document.close()
+            os.replace(tmp_path, self.output_path)
+        else:
+            self.document.close()
+        print(f"Annotated PDF saved to '{os.path.basename(self.output_path)}'.")
+
 # --- Post-processing Functions ---
 
 def re_match(text):
@@ -72,75 +354,214 @@ def re_match(text):
             mathes_other.append(a_match)
     return matches, mathes_image, mathes_other
 
+_GROUNDING_PATTERN = re.compile(r'<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>', re.DOTALL)
+# One box of a `<|det|>` payload: the innermost brackets, holding four coordinates
+_BOX_PATTERN = re.compile(r'\[([^\[\]]*)\]')
+_NUMBER_PATTERN = re.compile(r'-?\d+(?:\.\d+)?')
+
+# Layout labels the model emits; ids are stable so colors stay consistent across pages
+GROUNDING_LABELS = ['text', 'title', 'image', 'table', 'figure', 'formula', 'equation', 'caption',
+                    'image_caption', 'table_caption', 'sub_title', 'list', 'header', 'footer']
+
+# Fixed box color table (RGB), indexed by label id
+_BOX_COLORS = np.array([
+    (31, 119, 180), (214, 39, 40), (44, 160, 44), (255, 127, 14), (148, 103, 189), (140, 86, 75),
+    (227, 119, 194), (23, 190, 207), (188, 189, 34), (127, 127, 127), (57, 59, 121), (99, 121, 57),
+    (140, 109, 49), (132, 60, 57), (123, 65, 115), (82, 84, 163),
+], dtype=np.uint8)
+
+def _coordinate(number):
+    """A model coordinate clipped to 0-999 (runaway digit strings would overflow int conversions)."""
+    return int(min(max(float(number), 0.0), 999.0))
+
+def _normalize_box(numbers):
+    """
+    Orders a box's corners as (x1, y1, x2, y2) with x1 <= x2 and y1 <= y2, clipped to 0-999.
+    Returns None for zero-area boxes, which the model occasionally emits.
+    """
+    x1, y1, x2, y2 = (_coordinate(n) for n in numbers)
+    x1, x2 = sorted((x1, x2))
+    y1, y2 = sorted((y1, y2))
+    if x1 == x2 or y1 == y2:
+        return None
+    return x1, y1, x2, y2
+
+def _parse_boxes(det_payload):
+    """
+    Parses a `<|det|>` payload such as `[[x1, y1, x2, y2], ...]` without eval. A bracket that
+    does not hold exactly four numbers is skipped, so it cannot shift the boxes after it.
+    """
+    boxes = []
+    for match in _BOX_PATTERN.finditer(det_payload):
+        numbers = _NUMBER_PATTERN.findall(match.group(1))
+        if len(numbers) == 4:
+            boxes.append(_normalize_box(numbers))
+    return [box for box in boxes if box is not None]
+
+def parse_grounding(text):
+    """
+    Parses all grounded blocks of the model output in a single pass, without eval.
+
+    Returns `(boxes, labels)`: `boxes` is an int16 array of shape (N, 5) with rows
+    (label_id, x1, y1, x2, y2) in the model's 0-999 coordinates, and `labels[label_id]` is
+    the label text. Known labels keep the ids of GROUNDING_LABELS. Inverted boxes are
+    reordered and zero-area boxes dropped, so every row can be drawn and cropped.
+    """
+    labels = list(GROUNDING_LABELS)
+    label_ids = {label: i for i, label in enumerate(labels)}
+    rows = []
+    for match in _GROUNDING_PATTERN.finditer(text):
+        label = match.group(1)
+        label_id = label_ids.get(label)
+        if label_id is None:
+            label_id = label_ids[label] = len(labels)
+            labels.append(label)
+        rows.extend((label_id, *box) for box in _parse_boxes(match.group(2)))
+
+    if not rows:
+        return np.zeros((0, 5), dtype=np.int16), labels
+    return np.array(rows, dtype=np.int16), labels
+
+def scale_boxes(boxes, width, height):
+    """Maps the (N, 5) grounding array to integer pixel boxes (N, 4) for a `width` x `height` image."""
+    scale = np.array([width, height, width, height], dtype=np.float32) / 999
+    coords = (boxes[:, 1:].astype(np.float32) * scale).astype(np.int32)
+    np.clip(coords, 0, [width - 1, height - 1, width - 1, height - 1], out=coords)
+    return coords
+
+def iter_grounded_blocks(text):
+    """
+    Yields (label, boxes, content) for each grounded block of the model output, where
+    `content` is the text that follows the block's detection up to the next block.
+    """
+    matches = list(_GROUNDING_PATTERN.finditer(text))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        yield match.group(1), _parse_boxes(match.group(2)), text[match.end():end].strip()
+
 def extract_coordinates_and_label(ref_text, image_width, image_height):
     """Parses a single reference to get the label and coordinates."""
-    try:
-        label_type = ref_text[1]
-        # Use regex to find the list within the string, as eval is unsafe
-        coord_str_match = re.search(r'\[.*\]', ref_text[2])
-        if not coord_str_match:
-            return None
-        # Safely evaluate the list of coordinates
-        cor_list = eval(coord_str_match.group(0))
-    except Exception as e:
-        print(f"Error parsing coordinates: {e}")
+    boxes = _parse_boxes(ref_text[2])
+    if not boxes:
         return None
-    return (label_type, cor_list)
+    return (ref_text[1], [list(box) for box in boxes])
+
+# Opacity of the box fills and of the label backgrounds in `draw_grounding`
+_FILL_ALPHA = 20 / 255
+_LABEL_BACKGROUND_ALPHA = 160 / 255
+
+def _box_sums(shape, boxes, values):
+    """
+    For an image of `shape` (height, width), the sum of `values` (N, C) over the boxes
+    (N, 4; inclusive x1, y1, x2, y2) covering each pixel. The sums only change at box edges,
+    so they are accumulated on the grid of edges with a 2-D difference array (four scatter-adds
+    and two cumulative sums for all boxes). Returns (cell sums, cell heights, cell widths).
+    """
+    height, width = shape
+    x1, y1, x2, y2 = boxes.T
+    xs = np.unique(np.concatenate([[0, width], x1, x2 + 1]))
+    ys = np.unique(np.concatenate([[0, height], y1, y2 + 1]))
+    columns = np.searchsorted(xs, x1), np.searchsorted(xs, x2 + 1)
+    rows = np.searchsorted(ys, y1), np.searchsorted(ys, y2 + 1)
+
+    sums = np.zeros((len(ys), len(xs), values.shape[1]), dtype=np.float64)
+    np.add.at(sums, (rows[0], columns[0]), values)
+    np.add.at(sums, (rows[0], columns[1]), -values)
+    np.add.at(sums, (rows[1], columns[0]), -values)
+    np.add.at(sums, (rows[1], columns[1]), values)
+    np.cumsum(sums, axis=0, out=sums)
+    np.cumsum(sums, axis=1, out=sums)
+    return sums[:-1, :-1], np.diff(ys), np.diff(xs)
+
+def _label_stamp(text, font):
+    """`text` rendered once as an alpha mask, plus the offset of its top-left from the text anchor."""
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new('L', (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+    return np.asarray(mask, dtype=np.float32) / 255, (left, top)
+
+def _blend_stamp(pixels, origins, alpha, color):
+    """Blends `color` into `pixels` through the (h, w) `alpha` mask placed at every (x, y) of `origins`."""
+    height, width = alpha.shape
+    ys = origins[:, 1, None, None] + np.arange(height)[None, :, None]
+    xs = origins[:, 0, None, None] + np.arange(width)[None, None, :]
+    ys, xs, alpha = np.broadcast_arrays(ys, xs, alpha[None])
+    keep = (ys < pixels.shape[0]) & (xs < pixels.shape[1]) & (alpha > 0)
+    ys, xs, alpha = ys[keep], xs[keep], alpha[keep][:, None]
+    blended = pixels[ys, xs] * (1 - alpha) + np.asarray(color, dtype=np.float32) * alpha
+    pixels[ys, xs] = np.rint(blended).astype(np.uint8)
+
+def draw_grounding(image: Image.Image, boxes, labels):
+    """
+    Draws a parsed grounding array (see `parse_grounding`) onto a copy of the image.
+
+    All boxes are drawn at once. Fills, outlines and label backgrounds are summed per region
+    between box edges (see `_box_sums`) into one color and opacity per region, which a single
+    composite applies: pixels under k boxes blend k fills of the boxes' mean color, and outline
+    pixels take the mean color of the outlines covering them. Each label's text is rendered
+    once and stamped at all of its boxes together.
+    """
+    if not len(boxes):
+        return image.convert('RGB')
+    img_draw = image if image.mode == 'RGB' else image.convert('RGB')
+
+    width, height = img_draw.size
+    coords = scale_boxes(boxes, width, height).astype(np.int64)
+    label_ids = boxes[:, 0].astype(np.int64)
+    colors = _BOX_COLORS[label_ids % len(_BOX_COLORS)].astype(np.float64)
+    ones, zeros = np.ones((len(coords), 1)), np.zeros((len(coords), 1))
+
+    # An outline of width w is the box minus the box inset by w
+    widths = np.where(np.array([label == 'title' for label in labels])[label_ids], 4, 2)[:, None]
+    inner = coords + np.hstack([widths, widths, -widths, -widths])
+    has_inner = (inner[:, 0] <= inner[:, 2]) & (inner[:, 1] <= inner[:, 3])
 
-def draw_bounding_boxes(image: Image.Image, refs, output_path):
-    """Draws bounding boxes on the image based on model output."""
-    image_width, image_height = image.size
-    img_draw = image.copy()
-    draw = ImageDraw.Draw(img_draw)
-    overlay = Image.new('RGBA', img_draw.size, (0, 0, 0, 0))
-    draw2 = ImageDraw.Draw(overlay)
-    
     font = ImageFont.load_default()
-    img_idx = 0
+    label_list, box_label = np.unique(label_ids, return_inverse=True)
+    stamps = [_label_stamp(labels[label_id], font) for label_id in label_list]
+    anchors = np.column_stack([coords[:, 0], np.maximum(0, coords[:, 1] - 15)])
+    origins = anchors + np.array([offset for _, offset in stamps])[box_label]
+    sizes = np.array([alpha.shape[::-1] for alpha, _ in stamps])[box_label]
+    backgrounds = np.column_stack([origins, np.minimum(origins + sizes, [width - 1, height - 1])])
 
-    # print(f"Drawing {len(refs)} bounding box sets...")
-    for i, ref in enumerate(refs):
-        try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if not result:
-                continue
-            
-            label_type, points_list = result
-            color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
-            color_a = color + (20,)
-
-            for points in points_list:
-                x1, y1, x2, y2 = points
-                x1 = int(x1 / 999 * image_width)
-                y1 = int(y1 / 999 * image_height)
-                x2 = int(x2 / 999 * image_width)
-                y2 = int(y2 / 999 * image_height)
-
-                if label_type == 'image':
-                    try:
-                        # The output_path here is the main output dir, let's save sub-images in its 'images' subdir
-                        sub_image_dir = os.path.join(output_path, "images")
-                        os.makedirs(sub_image_dir, exist_ok=True)
-                        cropped = image.crop((x1, y1, x2, y2))
-                        cropped.save(f"{sub_image_dir}/img_{img_idx}.jpg")
-                    except Exception as e:
-                        print(f"Could not save cropped image: {e}")
-                    img_idx += 1
-                
-                # Draw rectangle and label
-                width = 4 if label_type == 'title' else 2
-                draw.rectangle([x1, y1, x2, y2], outline=color, width=width)
-                draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-                
-                text_x = x1
-                text_y = max(0, y1 - 15)
-                text_bbox = draw.textbbox((text_x, text_y), label_type, font=font)
-                draw.rectangle(text_bbox, fill=(255, 255, 255, 80))
-                draw.text((text_x, text_y), label_type, font=font, fill=color)
-
-        except Exception as e:
-            print(f"An error occurred while drawing a box: {e}")
-            continue
-            
-    img_draw.paste(overlay, (0, 0), overlay)
-    return img_draw
+    # Per box: (fill count, fill rgb, outline count, outline rgb, label background count)
+    values = np.vstack([
+        np.hstack([ones, colors, ones, colors, zeros]),
+        np.hstack([zeros, 0 * colors, -ones, -colors, zeros])[has_inner],
+        np.hstack([zeros, 0 * colors, zeros, 0 * colors, ones]),
+    ])
+    regions, cell_heights, cell_widths = _box_sums(
+        (height, width), np.vstack([coords, inner[has_inner], backgrounds]), values)
+    fill_count, outline_count, background_count = regions[..., :1], regions[..., 4:5], regions[..., 8:9]
+
+    # Each region maps a pixel p to p * keep + add
+    keep = (1 - _FILL_ALPHA) ** fill_count
+    add = regions[..., 1:4] / np.maximum(fill_count, 1) * (1 - keep)
+    outlined = outline_count > 0
+    keep = np.where(outlined, 0.0, keep)
+    add = np.where(outlined, regions[..., 5:8] / np.maximum(outline_count, 1), add)
+    background = (1 - _LABEL_BACKGROUND_ALPHA) ** background_count
+    keep, add = keep * background, add * background + 255 * (1 - background)
+
+    opacity = 1 - keep
+    color = np.divide(add, opacity, out=np.zeros_like(add), where=opacity > 0)
+    expand = lambda a: np.repeat(np.repeat(a, cell_heights, axis=0), cell_widths, axis=1)
+    img_draw = Image.composite(Image.fromarray(expand(np.clip(np.rint(color), 0, 255).astype(np.uint8))), img_draw,
+                               Image.fromarray(expand(np.rint(opacity[..., 0] * 255).astype(np.uint8)), 'L'))
+
+    pixels = np.array(img_draw)
+    for index, (label_id, (text_alpha, _)) in enumerate(zip(label_list, stamps)):
+        _blend_stamp(pixels, origins[box_label == index], text_alpha, _BOX_COLORS[label_id % len(_BOX_COLORS)])
+    return Image.fromarray(pixels)
+
+def draw_bounding_boxes(image: Image.Image, refs, output_path):
+    """
+    Draws bounding boxes on the image based on `re_match` references and saves the figure
+    crops under `output_path` (see `figures.FigureExporter`).
+    """
+    from .figures import FigureExporter
+
+    boxes, labels = parse_grounding(''.join(ref[0] for ref in refs))
+    with FigureExporter(output_path) as exporter:
+        exporter.export(image, boxes, labels)
+    return draw_grounding(image, boxes, labels)
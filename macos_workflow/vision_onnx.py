@@ -0,0 +1,179 @@
+"""
+ONNX Runtime backend for the vision encoder (SAM + CLIP + projector).
+
+The encoder is exported once per view size (the 640, 1024 and 1280 views of the resolution
+modes) with a dynamic batch axis, optionally int8-quantized with dynamic quantization, and
+run under ONNX Runtime with all CPU graph optimizations. The backend is installed as
+`model.model.vision_backend`, which `_encode_views` consults before running the eager
+encoder; view sizes without an exported graph keep using PyTorch.
+
+Export and check parity without starting the UI:
+    python -m macos_workflow.vision_onnx --sizes 640 1024 1280 [--int8]
+"""
+import argparse
+import copy
+import logging
+import os
+import sys
+
+import torch
+
+from . import config_macos as config
+
+logger = logging.getLogger(__name__)
+
+VIEW_SIZES = (640, 1024, 1280)
+
+
+def _require_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError("VISION_BACKEND = 'onnx' needs the onnxruntime package: pip install onnxruntime") from e
+    return onnxruntime
+
+
+class VisionEncoder(torch.nn.Module):
+    """The eager encoder of `DeepseekOCRModel._encode_views` as a standalone module for export."""
+    def __init__(self, ocr_model):
+        super().__init__()
+        self.sam_model = ocr_model.sam_model
+        self.vision_model = ocr_model.vision_model
+        self.projector = ocr_model.projector
+
+    def forward(self, views):
+        features_1 = self.sam_model(views)
+        features_2 = self.vision_model(views, features_1)
+        features = torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1)
+        return self.projector(features)
+
+
+def onnx_path(onnx_dir, view_size, quantized=False):
+    return os.path.join(onnx_dir, f"vision_{view_size}{'_int8' if quantized else ''}.onnx")
+
+
+def export_vision_encoder(model, view_size, path, opset=17):
+    """
+    Exports the float32 encoder for `view_size` x `view_size` views, batch axis dynamic.
+    A copy is converted to float32, so a bfloat16 serving model keeps its dtype.
+    """
+    encoder = copy.deepcopy(VisionEncoder(model.model)).float().eval()
+    dummy = torch.zeros(2, 3, view_size, view_size, dtype=torch.float32)
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder, (dummy,), path,
+            input_names=["views"], output_names=["features"],
+            dynamic_axes={"views": {0: "views"}, "features": {0: "views"}},
+            opset_version=opset,
+        )
+    return path
+
+
+def quantize_encoder(path, quantized_path):
+    """Int8 dynamic quantization of the exported graph's MatMul weights."""
+    _require_onnxruntime()
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+class OnnxVisionBackend:
+    """Runs `_encode_views` for the exported view sizes under ONNX Runtime."""
+    def __init__(self, paths, threads=None):
+        ort = _require_onnxruntime()
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.sessions = {
+            size: ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+            for size, path in paths.items()
+        }
+        self.enabled = True
+
+    def __call__(self, views):
+        session = self.sessions.get(views.shape[-1]) if self.enabled else None
+        if session is None or views.shape[-2] != views.shape[-1]:
+            return None
+        features = session.run(None, {"views": views.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(features).to(device=views.device, dtype=views.dtype)
+
+
+@torch.no_grad()
+def parity_check(model, backend, sizes=VIEW_SIZES, batch_size=2, seed=0):
+    """
+    Compares backend and eager outputs on random views. Returns {size: (max_abs_diff, min_cosine)}
+    with cosine similarity taken per output token.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    encoder = VisionEncoder(model.model).eval()
+    dtype = next(encoder.parameters()).dtype
+    results = {}
+    for size in sizes:
+        if size not in backend.sessions:
+            continue
+        views = torch.randn(batch_size, 3, size, size, generator=generator).to(dtype)
+        eager = encoder(views).float()
+        onnx = backend(views).float()
+        cosine = torch.nn.functional.cosine_similarity(eager, onnx, dim=-1)
+        results[size] = ((eager - onnx).abs().max().item(), cosine.min().item())
+    return results
+
+
+def build_backend(model, onnx_dir, sizes=VIEW_SIZES, quantized=False, threads=None):
+    """Exports (and quantizes) missing graphs under `onnx_dir` and loads them."""
+    os.makedirs(onnx_dir, exist_ok=True)
+    paths = {}
+    for size in sizes:
+        path = onnx_path(onnx_dir, size)
+        if not os.path.exists(path):
+            print(f"Exporting vision encoder for {size}px views to {path}...")
+            export_vision_encoder(model, size, path)
+        if quantized:
+            float_path, path = path, onnx_path(onnx_dir, size, quantized=True)
+            if not os.path.exists(path):
+                print(f"Quantizing {float_path} to int8...")
+                quantize_encoder(float_path, path)
+        paths[size] = path
+    return OnnxVisionBackend(paths, threads=threads)
+
+
+def enable_onnx_vision(model, onnx_dir, sizes=VIEW_SIZES, quantized=False, check_parity=True, min_cosine=0.99):
+    """
+    Installs the ONNX Runtime backend on `model`. With `check_parity`, sizes whose outputs
+    drift from the eager encoder (per-token cosine below `min_cosine`) stay on PyTorch.
+    Returns the backend.
+    """
+    backend = build_backend(model, onnx_dir, sizes, quantized)
+    if check_parity:
+        for size, (max_diff, cosine) in parity_check(model, backend, sizes).items():
+            print(f"Vision backend parity at {size}px: max abs diff {max_diff:.3e}, min cosine {cosine:.5f}")
+            if cosine < min_cosine:
+                logger.warning(f"ONNX vision output for {size}px views drifts from eager; keeping PyTorch for it.")
+                del backend.sessions[size]
+    model.model.vision_backend = backend
+    return backend
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the vision encoder to ONNX and check parity.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(VIEW_SIZES))
+    parser.add_argument("--int8", action="store_true", help="Also build int8 dynamically quantized graphs")
+    parser.add_argument("--output", help="Directory for the .onnx files (default: VISION_ONNX_DIR)")
+    args = parser.parse_args(argv)
+
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if project_root not in sys.path:
+        sys.path.insert(0, project_root)
+    from DeepSeek_OCR.modeling_deepseekocr import DeepseekOCRForCausalLM
+
+    model = DeepseekOCRForCausalLM.from_pretrained(
+        os.path.join(project_root, "DeepSeek-OCR"), trust_remote_code=True, torch_dtype=torch.float32).eval()
+    onnx_dir = args.output or config.VISION_ONNX_DIR or os.path.join(project_root, "onnx_vision")
+    backend = build_backend(model, onnx_dir, args.sizes, args.int8)
+    for size, (max_diff, cosine) in parity_check(model, backend, args.sizes).items():
+        print(f"{size}px: max abs diff {max_diff:.3e}, min cosine {cosine:.5f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Engine warmup: runs synthetic pages through every resolution mode and crop-grid shape bucket
+before real traffic, so allocator growth, oneDNN primitive creation and the lazy setup in the
+vision tower happen up front instead of on the first user's request.
+
+A bucket is one encoder input shape: the global view alone, or the global view plus a batch
+of N crop tiles. Each bucket is run twice; the second run is its warm latency.
+"""
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from . import config_macos as config
+from .resolution import CROP_THRESHOLD, candidate_grids, select_crop_grid
+
+logger = logging.getLogger(__name__)
+
+# Width / height of an A4 page, for the representative grid of each tile count
+_PAGE_ASPECT = 1 / 2 ** 0.5
+
+
+def synthetic_page(width=1240, height=1754, seed=0):
+    """A text-like page for calibration and warmup: a title plus rows of word-sized blocks."""
+    rng = np.random.default_rng(seed)
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    margin = width // 12
+    draw.text((margin, margin), "Calibration page", font=font, fill='black')
+    y = margin + 40
+    while y < height - margin:
+        x = margin
+        while x < width - margin:
+            word = ''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyz'), rng.integers(2, 10)))
+            draw.text((x, y), word, font=font, fill='black')
+            x += 8 * len(word) + 8
+        y += 18
+    return image
+
+
+def shape_buckets(mode_names=None):
+    """
+    Returns [(mode name, grid, (page width, page height))]: one page size per encoder input
+    shape of each mode. Crop modes get one bucket per tile count plus the untiled small page.
+    """
+    buckets = []
+    for name in mode_names or config.RESOLUTION_PRESETS:
+        preset = config.RESOLUTION_PRESETS[name]
+        image_size = preset["image_size"]
+        if not preset["crop_mode"]:
+            side = max(preset["base_size"], image_size)
+            buckets.append((name, (1, 1), (int(side * _PAGE_ASPECT), side)))
+            continue
+
+        buckets.append((name, (1, 1), (CROP_THRESHOLD, CROP_THRESHOLD)))
+        by_tiles = {}
+        for grid in candidate_grids():
+            best = by_tiles.get(grid[0] * grid[1])
+            if best is None or abs(grid[0] / grid[1] - _PAGE_ASPECT) < abs(best[0] / best[1] - _PAGE_ASPECT):
+                by_tiles[grid[0] * grid[1]] = grid
+        for tiles, grid in sorted(by_tiles.items()):
+            size = (grid[0] * image_size, grid[1] * image_size)
+            if select_crop_grid(*size, image_size, True) != grid:
+                logger.warning(f"Warmup: no page size maps to grid {grid} in mode '{name}', skipping.")
+                continue
+            buckets.append((name, grid, size))
+    return buckets
+
+
+def warm_up(engine, mode_names=None, prompt=None, max_new_tokens=None):
+    """
+    Runs every shape bucket twice through `engine.run_page`.
+    Returns [{"mode", "grid", "cold_seconds", "warm_seconds"}].
+    """
+    prompt = prompt or config.PROMPT_PRESETS['free_ocr']
+    max_new_tokens = max_new_tokens or config.WARMUP_MAX_NEW_TOKENS
+    buckets = shape_buckets(mode_names)
+    print(f"Warming up {len(buckets)} shape buckets...")
+
+    report = []
+    with tempfile.TemporaryDirectory(prefix="deepseek_ocr_warmup_") as tmp_dir:
+        for name, grid, (width, height) in buckets:
+            preset = config.RESOLUTION_PRESETS[name]
+            image_path = os.path.join(tmp_dir, f"{name}_{grid[0]}x{grid[1]}.png")
+            synthetic_page(width, height).save(image_path)
+
+            timings = []
+            for _ in range(2):
+                start_time = time.perf_counter()
+                engine.run_page(image_path, prompt, preset["base_size"], preset["image_size"], preset["crop_mode"],
+                                max_new_tokens=max_new_tokens)
+                timings.append(time.perf_counter() - start_time)
+            report.append({"mode": name, "grid": grid, "cold_seconds": timings[0], "warm_seconds": timings[1]})
+            print(f"  {name:>7} {grid[0]}x{grid[1]}: cold {timings[0]:.2f}s, warm {timings[1]:.2f}s")
+    return report
@@ -8,6 +8,8 @@ import sys
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(PROJECT_ROOT, "macos_workflow", "config_macos.py")
 PATCH_SOURCE_PATH = os.path.join(PROJECT_ROOT, "macos_workflow", "patched_modeling_deepseekocr.py")
+# Modules the patched file imports, copied next to it
+PATCH_SUPPORT_PATHS = [os.path.join(PROJECT_ROOT, "macos_workflow", "resolution.py")]
 
 # --- Helper Functions ---
 
@@ -47,7 +49,7 @@ def get_model_path_from_user():
             print("请确保您提供的是完整的 'DeepSeek-OCR' 文件夹路径，且其中包含 'modeling_deepseekocr.py' 和 'config.json' 文件。")
 
 def apply_patch(model_path):
-    """Copies the patched modeling file into the user's model directory."""
+    """Copies the patched modeling file (and the modules it imports) into the user's model directory."""
     print("\n步骤 2: 应用macOS兼容性补丁...")
     target_file = os.path.join(model_path, "modeling_deepseekocr.py")
     backup_file = os.path.join(model_path, "modeling_deepseekocr.py.backup")
@@ -58,8 +60,10 @@ def apply_patch(model_path):
             shutil.copy2(target_file, backup_file)
             print(f"  - 已备份原始文件到: {backup_file}")
         
-        # Copy our patched file
+        # Copy our patched file and the modules it imports
         shutil.copy2(PATCH_SOURCE_PATH, target_file)
+        for support_path in PATCH_SUPPORT_PATHS:
+            shutil.copy2(support_path, os.path.join(model_path, os.path.basename(support_path)))
         print_color("  - ✅ 成功应用补丁文件。", "green")
         return True
     except Exception as e:
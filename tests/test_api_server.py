@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("fastapi")
+
+from macos_workflow.api_server import JobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"))
+
+
+def create_job(store):
+    return store.create("/tmp/upload.pdf", "upload.pdf", "<image>\nFree OCR. ", "gundam")
+
+
+def test_cancel_of_a_queued_job_takes_effect_at_once(store):
+    job_id = create_job(store)
+    assert store.request_cancel(job_id)
+    job = store.get(job_id)
+    assert job["status"] == "cancelled" and job["finished_at"] is not None
+    assert store.claim_next() is None
+
+
+def test_cancel_of_a_running_job_waits_for_the_page_boundary(store):
+    job_id = create_job(store)
+    assert store.claim_next()["id"] == job_id
+    assert not store.request_cancel(job_id)
+    assert store.get(job_id)["status"] == "running"
+    assert store.cancel_requested(job_id)
+    assert store.finish_done(job_id) == "cancelled"
+
+
+def test_cancel_leaves_finished_jobs_alone(store):
+    job_id = create_job(store)
+    store.claim_next()
+    assert store.finish_done(job_id) == "done"
+    assert not store.request_cancel(job_id)
+    assert store.get(job_id)["status"] == "done"
+    assert not store.cancel_requested(job_id)
+
+
+def test_cancel_of_an_unknown_job(store):
+    assert not store.request_cancel("missing")
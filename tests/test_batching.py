@@ -0,0 +1,147 @@
+"""
+SlotKVCache row bookkeeping, and continuous batching against the model's own `generate_ocr`.
+The equivalence test builds a small random-weight model from the DeepSeek-OCR code and tokenizer
+set up by setup.py, and is skipped where they are not installed.
+"""
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from macos_workflow.batching import ContinuousBatchScheduler, SlotKVCache
+
+LAYERS, HEADS, HEAD_DIM = 2, 2, 4
+
+
+def prefill_cache(length, seed):
+    """A legacy (key, value) tuple per layer, batch size 1, as a prefill returns it."""
+    generator = torch.Generator().manual_seed(seed)
+    return tuple((torch.randn(1, HEADS, length, HEAD_DIM, generator=generator),
+                  torch.randn(1, HEADS, length, HEAD_DIM, generator=generator)) for _ in range(LAYERS))
+
+
+def assert_row(cache, row, layer_cache):
+    length = layer_cache[0][0].shape[2]
+    assert cache.lengths[row] == length
+    for layer, (key, value) in enumerate(layer_cache):
+        assert torch.equal(cache.keys[layer][row, :, :length], key[0])
+        assert torch.equal(cache.values[layer][row, :, :length], value[0])
+
+
+def test_add_fills_consecutive_rows():
+    cache = SlotKVCache(rows=3, growth=8)
+    first, second = prefill_cache(5, 0), prefill_cache(3, 1)
+    assert cache.add(first) == 0
+    assert cache.add(second) == 1
+    assert cache.capacity == 8
+    assert cache.keys[0].shape == (3, HEADS, 8, HEAD_DIM)
+    assert_row(cache, 0, first)
+    assert_row(cache, 1, second)
+
+
+def test_remove_moves_the_last_row_into_the_freed_one():
+    cache = SlotKVCache(rows=3, growth=8)
+    sequences = [prefill_cache(length, length) for length in (4, 6, 2)]
+    for layer_cache in sequences:
+        cache.add(layer_cache)
+
+    cache.remove(0)
+    assert cache.lengths == [2, 6]
+    assert_row(cache, 0, sequences[2])
+    assert_row(cache, 1, sequences[1])
+
+    cache.remove(1)
+    assert cache.lengths == [2]
+    assert_row(cache, 0, sequences[2])
+
+    cache.remove(0)
+    assert cache.lengths == [] and cache.keys == [] and cache.capacity == 0
+
+
+def test_decode_steps_append_at_each_rows_length_and_grow_the_buffers():
+    cache = SlotKVCache(rows=2, growth=8)
+    sequences = [prefill_cache(7, 0), prefill_cache(2, 1)]
+    for layer_cache in sequences:
+        cache.add(layer_cache)
+    assert cache.capacity == 8
+
+    steps = []
+    for step in range(2):
+        lengths = list(cache.lengths)
+        attention_mask, position_ids = cache.begin_step(torch.device("cpu"))
+        assert position_ids.flatten().tolist() == lengths
+        assert attention_mask.shape == (2, max(lengths) + 1)
+        assert attention_mask.sum(dim=1).tolist() == [length + 1 for length in lengths]
+
+        new_states = prefill_cache(1, 100 + step)
+        for layer, (key, value) in enumerate(new_states):
+            keys, values = cache.update(torch.cat([key, key + 1]), torch.cat([value, value + 1]), layer)
+            assert keys.shape == values.shape == (2, HEADS, max(lengths) + 1, HEAD_DIM)
+        cache.end_step()
+        steps.append(new_states)
+
+    # The second step needed position 8 of the first row, past the initial capacity
+    assert cache.lengths == [9, 4]
+    assert cache.capacity == 16
+    for layer in range(LAYERS):
+        for row, layer_cache in enumerate(sequences):
+            length = layer_cache[0][0].shape[2]
+            assert torch.equal(cache.keys[layer][row, :, :length], layer_cache[layer][0][0])
+            for step, new_states in enumerate(steps):
+                assert torch.equal(cache.keys[layer][row, :, length + step], new_states[layer][0][0, :, 0] + row)
+                assert torch.equal(cache.values[layer][row, :, length + step], new_states[layer][1][0, :, 0] + row)
+
+
+@pytest.fixture(scope="module")
+def tiny_model():
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    modeling = pytest.importorskip("DeepSeek_OCR.modeling_deepseekocr")
+    from transformers import AutoTokenizer
+
+    model_path = os.path.join(project_root, "DeepSeek-OCR")
+    config = modeling.DeepseekOCRConfig.from_pretrained(model_path)
+    # Two decoder layers (one dense, one MoE) with a handful of small experts
+    config.num_hidden_layers = 2
+    config.first_k_dense_replace = 1
+    config.intermediate_size = 256
+    config.moe_intermediate_size = 64
+    config.n_routed_experts = 4
+    config.num_experts_per_tok = 2
+    config.n_group = 1
+    config.topk_group = 1
+    torch.manual_seed(0)
+    model = modeling.DeepseekOCRForCausalLM(config).eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    return model, tokenizer
+
+
+def sequential_text(model, tokenizer, image_path, prompt, max_new_tokens):
+    inputs = model.prepare_ocr_inputs(tokenizer, prompt=prompt, image_file=image_path,
+                                      base_size=640, image_size=640, crop_mode=False)
+    output_ids = model.generate_ocr(tokenizer, inputs, eval_mode=True, max_new_tokens=max_new_tokens)
+    return model.decode_ocr_output(tokenizer, inputs, output_ids)
+
+
+def test_batched_decode_matches_generate_ocr(tiny_model, tmp_path):
+    from macos_workflow.warmup import synthetic_page
+
+    model, tokenizer = tiny_model
+    prompt = "<image>\nFree OCR. "
+    # Different page sizes give the sequences different prompt lengths within the batch
+    image_paths = []
+    for i, size in enumerate([(640, 900), (500, 300), (800, 800)]):
+        image_paths.append(str(tmp_path / f"page{i}.png"))
+        synthetic_page(*size, seed=i).save(image_paths[-1])
+
+    max_new_tokens = 12
+    expected = [sequential_text(model, tokenizer, path, prompt, max_new_tokens) for path in image_paths]
+
+    scheduler = ContinuousBatchScheduler(model, tokenizer, max_batch_size=2, max_prefills_per_step=2,
+                                         max_new_tokens=max_new_tokens).start()
+    try:
+        futures = [scheduler.submit(path, prompt, 640, 640, False) for path in image_paths]
+        assert [future.result(timeout=600) for future in futures] == expected
+    finally:
+        scheduler.stop()
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from macos_workflow.distributed import SQLiteBroker
+
+
+@pytest.fixture
+def broker(tmp_path):
+    return SQLiteBroker(str(tmp_path / "broker.sqlite3"), lease_seconds=60, max_attempts=2)
+
+
+def queue_document(broker, pages=1):
+    doc_id = broker.create_document("<image>\nFree OCR. ", "gundam")
+    broker.add_pages(doc_id, 0, [(b"png", ".png")] * pages)
+    broker.seal_document(doc_id, pages)
+    return doc_id
+
+
+def test_failed_pages_are_retried_until_out_of_attempts(broker):
+    doc_id = queue_document(broker)
+    first = broker.lease("worker-a")
+    assert first.attempts == 1
+    assert broker.fail(first.task_id, first.lease_token, "out of memory")
+
+    second = broker.lease("worker-b")
+    assert (second.task_id, second.attempts) == (first.task_id, 2)
+    # The first lease is gone, so its late result is dropped
+    assert not broker.complete(first.task_id, first.lease_token, "stale")
+    assert broker.fail(second.task_id, second.lease_token, "out of memory")
+
+    assert broker.lease("worker-c") is None
+    document = broker.document(doc_id)
+    assert (document["done"], document["failed"], document["errors"]) == (0, 1, {0: "out of memory"})
+
+
+def test_expired_leases_are_handed_out_again(broker):
+    queue_document(broker)
+    broker.lease_seconds = -1
+    first = broker.lease("worker-a")
+    broker.lease_seconds = 60
+    second = broker.lease("worker-b")
+    assert second.task_id == first.task_id and second.lease_token != first.lease_token
+    assert not broker.renew(first.task_id, first.lease_token)
+    assert broker.complete(second.task_id, second.lease_token, "text")
+
+
+def test_purge_deletes_only_old_finished_documents(broker):
+    old_finished = queue_document(broker)
+    task = broker.lease("worker")
+    broker.complete(task.task_id, task.lease_token, "text")
+    old_running = queue_document(broker)
+    time.sleep(0.05)
+    new_finished = queue_document(broker)
+    assert broker.lease("worker").doc_id == old_running
+    task = broker.lease("worker")
+    broker.complete(task.task_id, task.lease_token, "text")
+
+    assert broker.purge_finished(0.025 / 3600) == 1
+    assert broker.document(old_finished) is None
+    assert broker.document(old_running)["total_pages"] == 1
+    assert broker.document(new_finished)["done"] == 1
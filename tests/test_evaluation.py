@@ -0,0 +1,33 @@
+import pytest
+
+from macos_workflow.evaluation import edit_distance, error_rates, load_reference
+
+
+def test_edit_distance_counts_insertions_deletions_and_substitutions():
+    assert edit_distance("kitten", "sitting") == 3
+    assert edit_distance("", "abc") == edit_distance("abc", "") == 3
+    assert edit_distance(["a", "b"], ["a", "b"]) == 0
+
+
+def test_identical_text_has_no_errors_whatever_the_whitespace():
+    assert error_rates("Total:  12.50\n\nThank you", "Total: 12.50 Thank you") == (0.0, 0.0)
+
+
+def test_error_rates_are_relative_to_the_reference():
+    cer, wer = error_rates("the cat sat", "the cat sat down")
+    assert cer == pytest.approx(5 / 16)
+    assert wer == pytest.approx(1 / 4)
+
+
+def test_empty_reference_does_not_divide_by_zero():
+    assert error_rates("", "") == (0.0, 0.0)
+    assert error_rates("ab", "") == (2.0, 1.0)
+
+
+def test_load_reference_prefers_markdown(tmp_path):
+    (tmp_path / "page.md").write_text("markdown", encoding="utf-8")
+    (tmp_path / "page.txt").write_text("text", encoding="utf-8")
+    (tmp_path / "other.txt").write_text("text", encoding="utf-8")
+    assert load_reference(str(tmp_path), "/scans/page.png") == "markdown"
+    assert load_reference(str(tmp_path), "/scans/other.jpg") == "text"
+    assert load_reference(str(tmp_path), "/scans/missing.png") is None
@@ -0,0 +1,30 @@
+import os
+import time
+
+from macos_workflow.figures import IN_USE_MARKER, purge_job_dirs
+
+
+def make_job_dir(root, name, age_hours, marker_age_hours=None):
+    path = root / name
+    path.mkdir()
+    if marker_age_hours is not None:
+        marker = path / IN_USE_MARKER
+        marker.touch()
+        stamp = time.time() - marker_age_hours * 3600
+        os.utime(marker, (stamp, stamp))
+    stamp = time.time() - age_hours * 3600
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def test_purge_keeps_recent_and_in_use_job_dirs(tmp_path):
+    old = make_job_dir(tmp_path, "job_old", 48)
+    recent = make_job_dir(tmp_path, "job_recent", 1)
+    running = make_job_dir(tmp_path, "job_running", 48, marker_age_hours=0)
+    crashed = make_job_dir(tmp_path, "job_crashed", 48, marker_age_hours=48)
+    other = make_job_dir(tmp_path, "uploads", 48)
+
+    purge_job_dirs(str(tmp_path), 24)
+
+    assert not old.exists() and not crashed.exists()
+    assert recent.exists() and running.exists() and other.exists()
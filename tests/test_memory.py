@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+
+from PIL import Image
+
+from macos_workflow.memory import MemoryBudget, MemoryEstimator
+
+MODE = (1024, 640, True)
+MODEL_CONFIG = SimpleNamespace(num_hidden_layers=12, hidden_size=1280, num_attention_heads=10, vocab_size=129280)
+
+
+def test_batch_size_multiplies_only_the_kv_cache():
+    estimator = MemoryEstimator(MODEL_CONFIG)
+    single = estimator.estimate(1240, 1754, *MODE, 4096)
+    batched = estimator.estimate(1240, 1754, *MODE, 4096, batch_size=4)
+    assert single["total"] == single["activations"] + single["kv"]
+    assert batched["total"] - single["total"] == 3 * single["kv"]
+
+
+def test_plan_uses_the_exif_oriented_size(tmp_path):
+    # Stored landscape, shown (and tiled by the model) as portrait
+    rotated, portrait = str(tmp_path / "rotated.jpg"), str(tmp_path / "portrait.jpg")
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new("RGB", (1754, 1240)).save(rotated, exif=exif)
+    Image.new("RGB", (1240, 1754)).save(portrait)
+
+    budget = MemoryBudget(MemoryEstimator(MODEL_CONFIG), budget_bytes=2 ** 50)
+    _, rotated_estimate = budget.plan(rotated, MODE)
+    _, portrait_estimate = budget.plan(portrait, MODE)
+    assert rotated_estimate["grid"] == portrait_estimate["grid"] == (2, 3)
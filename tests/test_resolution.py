@@ -0,0 +1,87 @@
+import pytest
+
+from macos_workflow.resolution import (candidate_grids, find_closest_aspect_ratio, global_tokens, global_view_window,
+                                       image_token_count, pruned_window, required_scale, select_crop_grid,
+                                       vision_token_count)
+
+A4 = (1240, 1754)
+
+
+def test_crop_grid_follows_the_page_aspect_ratio():
+    assert select_crop_grid(*A4) == (2, 3)
+    assert select_crop_grid(2000, 500) == (4, 1)
+
+
+def test_small_pages_and_no_crop_mode_are_not_tiled():
+    assert select_crop_grid(640, 640) == (1, 1)
+    assert select_crop_grid(600, 400) == (1, 1)
+    assert select_crop_grid(*A4, 1024, crop_mode=False) == (1, 1)
+
+
+def test_ties_go_to_the_larger_grid_only_for_large_images():
+    grids = candidate_grids()
+    assert find_closest_aspect_ratio(1.0, grids, 2000, 2000, 640) == (3, 3)
+    assert find_closest_aspect_ratio(1.0, grids, 1000, 1000, 640) == (2, 2)
+
+
+def test_full_global_view_tokens():
+    # n x n queries, a newline token after each row and the view separator
+    assert global_tokens(512) == 8 * 9 + 1
+    assert global_tokens(640) == 10 * 11 + 1
+    assert global_tokens(1024) == 16 * 17 + 1
+    assert global_tokens(1280) == 20 * 21 + 1
+
+
+def test_vision_tokens_add_the_tiles_in_crop_mode():
+    assert vision_token_count(1024, 640, True) == 273
+    assert vision_token_count(1024, 640, True, (2, 3)) == 273 + (10 * 2 + 1) * (10 * 3)
+    assert vision_token_count(1024, 1024, False) == 273
+    assert vision_token_count(640, 640, False) == 111
+
+
+def test_pruned_window_covers_the_padded_content_only():
+    # 1240x1754 padded into 1024: 724 columns of content starting at 150, in 64-pixel spans
+    assert global_view_window(*A4, 1024) == (0, 16, 2, 14)
+    assert pruned_window(*A4, 1024, 640, True) == (0, 16, 2, 14)
+    assert pruned_window(2000, 500, 1280, 1280, False) == (7, 13, 0, 20)
+    assert vision_token_count(1024, 640, True, (2, 3), (0, 16, 2, 14)) == 16 * 13 + 1 + 21 * 30
+
+
+def test_small_views_without_crop_keep_the_full_window():
+    # They are resized to the square rather than padded
+    assert pruned_window(*A4, 640, 640, False) == (0, 10, 0, 10)
+    assert vision_token_count(640, 640, False, (1, 1), (0, 10, 0, 10)) == global_tokens(640)
+
+
+def test_required_scale_keeps_the_crop_grid():
+    width, height = A4[0] * 2, A4[1] * 2
+    scale = required_scale(width, height, 1024, 640, True)
+    assert scale < 1
+    assert select_crop_grid(round(width * scale), round(height * scale)) == select_crop_grid(width, height)
+
+
+class _CharTokenizer:
+    def encode(self, text, add_special_tokens=False):
+        return [ord(c) % 1000 + 2 for c in text]
+
+
+@pytest.mark.parametrize("size", [(600, 400), A4, (2000, 500), (3000, 3000)])
+@pytest.mark.parametrize("mode", [(1024, 640, True), (1024, 1024, False), (1280, 1280, False), (640, 640, False)])
+@pytest.mark.parametrize("prune", [False, True])
+def test_counts_match_the_model_template(size, mode, prune):
+    pytest.importorskip("torch")
+    modeling = pytest.importorskip("DeepSeek_OCR.modeling_deepseekocr")
+    base_size, image_size, crop_mode = mode
+    grid = select_crop_grid(*size, image_size, crop_mode)
+    window = pruned_window(*size, base_size, image_size, crop_mode) if prune else ()
+    _, images_seq_mask = modeling.DeepseekOCRForCausalLM._build_ocr_template(
+        _CharTokenizer(), "<image>\nFree OCR. ", base_size, image_size, crop_mode, (grid + tuple(window),))
+    assert int(images_seq_mask.sum()) == vision_token_count(base_size, image_size, crop_mode, grid, window or None)
+
+
+def test_image_token_count_prunes_like_the_model():
+    assert image_token_count(*A4, 1024, 640, True) == 903
+    assert image_token_count(*A4, 1024, 640, True, prune_padding=True) == 839
+    # No-crop views: padded above 640, resized (nothing to prune) up to 640
+    assert image_token_count(*A4, 1024, 1024, False, prune_padding=True) == 16 * 13 + 1
+    assert image_token_count(*A4, 640, 640, False, prune_padding=True) == global_tokens(640)
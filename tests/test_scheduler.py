@@ -0,0 +1,78 @@
+"""Dispatch order of the priority scheduler, against an engine that only records the pages it runs."""
+import pytest
+from PIL import Image
+
+from macos_workflow.scheduler import PriorityScheduler, estimate_page_cost
+
+MODE = (1024, 640, True)
+PROMPT = "<image>\nFree OCR. "
+
+
+class RecordingEngine:
+    def __init__(self):
+        self.pages = []
+
+    def run_page(self, image_path, prompt, base_size, image_size, crop_mode, max_new_tokens=None):
+        self.pages.append(image_path)
+        return image_path
+
+
+@pytest.fixture
+def page(tmp_path):
+    """page(name, size) writes a blank page and returns its path."""
+    def make(name, size):
+        path = str(tmp_path / f"{name}.png")
+        Image.new("RGB", size, "white").save(path)
+        return path
+    return make
+
+
+def run(scheduler, futures=(), jobs=()):
+    """Starts the scheduler on what was queued and waits for it all. Returns the jobs' results."""
+    scheduler.start()
+    try:
+        for future in futures:
+            future.result(timeout=10)
+        return [[text for _, _, text in job.results()] for job in jobs]
+    finally:
+        scheduler.stop()
+
+
+def names(engine):
+    return [path.rsplit("/", 1)[-1][:-len(".png")] for path in engine.pages]
+
+
+def test_costs_grow_with_the_crop_grid(page):
+    assert estimate_page_cost(page("small", (600, 400)), PROMPT, *MODE) < \
+        estimate_page_cost(page("a4", (1240, 1754)), PROMPT, *MODE)
+
+
+def test_interactive_pages_go_shortest_first_before_bulk(page):
+    engine = RecordingEngine()
+    scheduler = PriorityScheduler(engine, bulk_min_share=0)
+    job = scheduler.submit_pages([page("doc", (600, 400))], PROMPT, MODE)
+    large = scheduler.submit(page("large", (1240, 1754)), PROMPT, MODE)
+    small = scheduler.submit(page("small", (600, 400)), PROMPT, MODE)
+    run(scheduler, [large, small], [job])
+    assert names(engine) == ["small", "large", "doc"]
+
+
+def test_documents_with_less_remaining_work_go_first(page):
+    engine = RecordingEngine()
+    scheduler = PriorityScheduler(engine)
+    long_pages = [page(f"long{i}", (1240, 1754)) for i in range(4)]
+    long_job = scheduler.submit_pages(iter(long_pages), PROMPT, MODE, total_pages=4)
+    short_page = page("short", (1240, 1754))
+    short_job = scheduler.submit_pages([short_page], PROMPT, MODE, total_pages=1)
+    assert run(scheduler, jobs=[long_job, short_job]) == [long_pages, [short_page]]
+    assert engine.pages == [short_page] + long_pages
+
+
+def test_bulk_keeps_its_minimum_share(page):
+    engine = RecordingEngine()
+    scheduler = PriorityScheduler(engine, bulk_min_share=1 / 3)
+    job = scheduler.submit_pages([page(f"doc{i}", (600, 400)) for i in range(2)], PROMPT, MODE)
+    futures = [scheduler.submit(page(f"img{i}", (600, 400)), PROMPT, MODE) for i in range(4)]
+    run(scheduler, futures, [job])
+    # One bulk page per two interactive ones while both are waiting
+    assert names(engine) == ["img0", "img1", "doc0", "img2", "img3", "doc1"]
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from macos_workflow.utils import GROUNDING_LABELS, AnnotatedPDFWriter, draw_grounding, parse_grounding, scale_boxes
+
+GROUNDED_PAGE = (
+    "<|ref|>title<|/ref|><|det|>[[10, 0, 500, 40]]<|/det|>\nAnnual report\n"
+    "<|ref|>text<|/ref|><|det|>[[100, 500, 900, 600]]<|/det|>\nRevenue grew"
+)
+
+
+@pytest.mark.parametrize("rotation", [0, 90])
+def test_annotated_pdf_labels_boxes_at_the_top_edge_and_keeps_text_upright(tmp_path, rotation):
+    fitz = pytest.importorskip("fitz")
+    source, output = str(tmp_path / "in.pdf"), str(tmp_path / "out.pdf")
+    document = fitz.open()
+    document.new_page(width=595, height=842).set_rotation(rotation)
+    document.save(source)
+
+    writer = AnnotatedPDFWriter(source, output)
+    writer.add_page(0, GROUNDED_PAGE)
+    writer.close()
+
+    with fitz.open(output) as document:
+        page = document[0]
+        labels = {annot.info["content"]: annot.rect * page.rotation_matrix
+                  for annot in page.annots() if annot.type[1] == "FreeText"}
+        # The title box touches the top of the page, so its label goes inside it
+        assert labels["title"].y0 >= 0 and not labels["title"].is_empty
+        assert labels["text"].y1 <= 0.5 * page.rect.height + 1
+
+        lines = [line for block in page.get_text("dict")["blocks"] for line in block.get("lines", [])]
+        texts = {"".join(span["text"] for span in line["spans"]): line["dir"] for line in lines}
+        assert "Annual report" in texts and "Revenue grew" in texts
+        direction = fitz.Point(texts["Revenue grew"]) * fitz.Matrix(rotation)
+        assert (round(direction.x), round(direction.y)) == (1, 0)
+
+
+def test_parse_grounding_returns_label_ids_and_boxes():
+    boxes, labels = parse_grounding(GROUNDED_PAGE)
+    assert boxes.dtype == np.int16
+    assert boxes.tolist() == [[GROUNDING_LABELS.index("title"), 10, 0, 500, 40],
+                              [GROUNDING_LABELS.index("text"), 100, 500, 900, 600]]
+    assert labels[:len(GROUNDING_LABELS)] == GROUNDING_LABELS
+
+
+def test_parse_grounding_appends_unknown_labels():
+    boxes, labels = parse_grounding("<|ref|>stamp<|/ref|><|det|>[[1, 2, 3, 4]]<|/det|>")
+    assert labels[boxes[0, 0]] == "stamp"
+
+
+def test_parse_grounding_normalizes_odd_coordinates():
+    text = ("<|ref|>text<|/ref|><|det|>[[-5, 10.6, 200, 300], [400, 300, 100, 50], "
+            "[5, 5, 5, 90], [12345678901234567890, 1, 2, 3]]<|/det|>")
+    boxes, _ = parse_grounding(text)
+    # Negatives clip to 0, fractions truncate, inverted corners are swapped, zero-area boxes dropped
+    assert boxes[:, 1:].tolist() == [[0, 10, 200, 300], [100, 50, 400, 300], [2, 1, 999, 3]]
+
+
+def test_parse_grounding_skips_malformed_groups_without_shifting_the_rest():
+    text = "<|ref|>text<|/ref|><|det|>[[1, 2, 3], [10, 20, 30, 40], [1, 2, 3, 4, 5], [50, 60, 70, 80]]<|/det|>"
+    boxes, _ = parse_grounding(text)
+    assert boxes[:, 1:].tolist() == [[10, 20, 30, 40], [50, 60, 70, 80]]
+
+
+def test_parse_grounding_without_blocks():
+    boxes, _ = parse_grounding("plain text")
+    assert boxes.shape == (0, 5)
+
+
+def reference_drawing(image, boxes, labels):
+    """The grounding overlay drawn box by box with ImageDraw."""
+    from macos_workflow.utils import _BOX_COLORS
+    from PIL import ImageFont
+
+    result = image.convert("RGB")
+    draw = ImageDraw.Draw(result, "RGBA")
+    font = ImageFont.load_default()
+    coords = scale_boxes(boxes, *image.size).tolist()
+    colors = [tuple(int(c) for c in _BOX_COLORS[label_id % len(_BOX_COLORS)]) for label_id in boxes[:, 0]]
+    for box, color in zip(coords, colors):
+        draw.rectangle(box, fill=(*color, 20))
+    for box, color, label_id in zip(coords, colors, boxes[:, 0]):
+        draw.rectangle(box, outline=color, width=4 if labels[label_id] == "title" else 2)
+    for box, color, label_id in zip(coords, colors, boxes[:, 0]):
+        text_x, text_y = box[0], max(0, box[1] - 15)
+        draw.rectangle(draw.textbbox((text_x, text_y), labels[label_id], font=font), fill=(255, 255, 255, 160))
+        draw.text((text_x, text_y), labels[label_id], font=font, fill=color)
+    return result
+
+
+def test_draw_grounding_matches_drawing_box_by_box():
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (700, 500, 3), dtype=np.uint8))
+    boxes, labels = parse_grounding(GROUNDED_PAGE + "\n<|ref|>table<|/ref|><|det|>[[100, 700, 900, 950]]<|/det|>")
+    drawn = np.asarray(draw_grounding(image, boxes, labels), dtype=np.int16)
+    expected = np.asarray(reference_drawing(image, boxes, labels), dtype=np.int16)
+    # Boxes that do not overlap come out the same, up to rounding
+    assert np.abs(drawn - expected).max() <= 1
+
+
+def test_draw_grounding_blends_overlapping_fills():
+    image = Image.new("RGB", (1000, 1000), "white")
+    boxes, labels = parse_grounding("<|ref|>text<|/ref|><|det|>[[100, 100, 600, 600], [400, 400, 900, 900]]<|/det|>")
+    drawn = np.asarray(draw_grounding(image, boxes, labels), dtype=np.float64)
+    single, double = drawn[300, 300], drawn[500, 500]
+    assert np.all(double < single) and np.all(single < 255)
+    assert draw_grounding(image, boxes[:0], labels).mode == "RGB"